@@ -1,27 +1,138 @@
+import os
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+from . import hashing, metrics, util
 from .account_types import CheckingAccount, SavingsAccount, UserAccount
 from .bank import Bank
+from .batch import Batch
+from .coldstore import Archiver
+from .journal import Journal
+from .leases import IdLeases
+from .rules import AlertLog, RulesEngine
+from .search import SearchIndex
 from .ui import ui_main
 
+parser = ArgumentParser(prog="python -m apcsp.labs.bank")
+parser.add_argument(
+    "--data",
+    default="bank-data",
+    help="directory the bank is saved in (default: %(default)s)",
+)
+parser.add_argument(
+    "--cold-after",
+    type=float,
+    metavar="DAYS",
+    help="keep moving postings older than this out of memory into a file in --data",
+)
+parser.add_argument(
+    "--metrics",
+    metavar="FILE",
+    help="time bank operations and save the results to FILE on exit"
+    " (Prometheus format if it ends in .prom)",
+)
+parser.add_argument(
+    "--batch",
+    metavar="FILE",
+    help="run the operations in FILE (- for stdin) instead of the menus;"
+    " see batch.py",
+)
+parser.add_argument(
+    "--alerts",
+    metavar="FILE",
+    help="check postings against the rules in rules.py and append alerts to FILE",
+)
+parser.add_argument(
+    "--hasher",
+    metavar="SPEC",
+    help="hash new passwords and PINs with SPEC, like scrypt:n=16384,r=8,p=1;"
+    " older ones are rehashed at login (see hashing.py)",
+)
+args = parser.parse_args()
+if args.hasher:
+    try:
+        hashing.set_default_hasher(args.hasher)
+    except ValueError as e:
+        parser.error(str(e))
+if args.metrics:
+    metrics.enable()
+
 bank = Bank()
+# a batch doesn't wait for each change to reach the disk; closing the journal
+# writes out the rest
+journal = Journal(args.data, sync=args.batch is None)
+journal.attach(bank)
+# numbers IDs from blocks leased in the data directory, so they stay unique
+# across restarts
+util.set_id_leases(IdLeases(os.path.join(args.data, "ids.json")))
+alerts = None
+if args.alerts:
+    alerts = AlertLog(args.alerts)
+    RulesEngine(on_alert=alerts).attach(bank)
+
+if args.batch is not None:
+    batch = Batch(bank)
+    start = perf_counter()
+    try:
+        if args.batch == "-":
+            batch.run(sys.stdin)
+        else:
+            with open(args.batch) as f:
+                batch.run(f)
+    finally:
+        journal.close()
+        bank.close()
+        if alerts is not None:
+            alerts.close()
+        recorded = metrics.disable()
+        if recorded is not None:
+            recorded.write(args.metrics)
+    print(
+        f"{batch.done:,} operations, {batch.failed:,} failed,"
+        f" in {perf_counter() - start:.2f}s",
+        file=sys.stderr,
+    )
+    sys.exit(1 if batch.failed else 0)
+
+SearchIndex().attach(bank)
+archiver = None
+if args.cold_after is not None:
+    archiver = Archiver(
+        bank, os.path.join(args.data, "cold.seg"), args.cold_after * 24 * 60 * 60
+    )
+    archiver.start()
 
-alice = bank.register("Alice", "alice", "aaaaaaaa", "1234")
-bob = bank.register("Bob", "bob", "bbbbbbbb", "1234")
-charlie = bank.register("Charlie", "charlie", "cccccccc", "1234")
+if not bank.accounts:
+    alice = bank.register("Alice", "alice", "aaaaaaaa", "1234")
+    bob = bank.register("Bob", "bob", "bbbbbbbb", "1234")
+    charlie = bank.register("Charlie", "charlie", "cccccccc", "1234")
 
-bob_checking = CheckingAccount(bob, "Bob's Checking")
-bob_checking.deposit(1000_00, "Initial deposit")
+    bob_checking = CheckingAccount(bob, "Bob's Checking")
+    bob_checking.deposit(1000_00, "Initial deposit")
 
-charlie_checking = CheckingAccount(charlie, "Charlie's Checking")
-charlie_savings = SavingsAccount(charlie, "Charlie's Savings")
-charlie_savings.deposit(1000000_00, "Initial deposit")
+    charlie_checking = CheckingAccount(charlie, "Charlie's Checking")
+    charlie_savings = SavingsAccount(charlie, "Charlie's Savings")
+    charlie_savings.deposit(1000000_00, "Initial deposit")
 
 """
-Test accounts (username:password:pin):
+Test accounts (username:password:pin), created the first time the bank starts:
 alice:aaaaaaaa:1234 - test user (u0) with no accounts
 bob:bbbbbbbb:1234 - test user (u1) with one checking account (c0)
 charlie:cccccccc:1234 - test user (u2) with one checking (c1) and one savings account (s0)
 
-Feel free to create your own accounts.
+Feel free to create your own accounts. They are saved in the --data directory;
+delete it to start over.
 """
 
-ui_main(bank)
+try:
+    ui_main(bank)
+finally:
+    journal.close()
+    if archiver is not None:
+        archiver.close()
+    if alerts is not None:
+        alerts.close()
+    recorded = metrics.disable()
+    if recorded is not None:
+        recorded.write(args.metrics)
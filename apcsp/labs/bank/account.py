@@ -1,10 +1,64 @@
-from typing import List, Literal, Tuple
+from itertools import count, islice
+from operator import attrgetter
+from threading import RLock
+from typing import (
+    TYPE_CHECKING,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Sequence,
+    Tuple,
+)
 
-from colorama import Fore, Style  # type: ignore
+from .ledger import INT64_MAX, Ledger, Transaction
+from .metrics import timed
+from .util import create_id, format_amount, reserve_id
 
-from .util import create_id, format_amount
+if TYPE_CHECKING:
+    from .account_types import UserAccount
+    from .bank import Bank
 
 
+# number of transactions shown at a time
+HISTORY_PAGE_SIZE = 20
+
+
+# accounts share a fixed set of locks rather than having one each, handed out
+# in turn as accounts are created
+LOCK_STRIPES = 4096
+_stripes = [RLock() for _ in range(LOCK_STRIPES)]
+# shared, so accounts don't each hold their own int
+_stripe_numbers = list(range(LOCK_STRIPES))
+_next_stripe = count()
+
+# locks are always taken in stripe order, so two threads locking overlapping
+# sets of accounts can never deadlock
+_lock_key = attrgetter("_lock_order")
+
+# dependents of an account nothing overdraws from
+_NO_DEPENDENTS: FrozenSet["BalanceAccount"] = frozenset()
+
+
+class locked(object):
+    """Holds the locks of several accounts at once."""
+
+    def __init__(self, accounts: Iterable["BalanceAccount"]) -> None:
+        # each stripe once, however many of the accounts share it, so locking
+        # every account in the bank takes at most LOCK_STRIPES acquires
+        self._locks = [_stripes[i] for i in sorted(set(map(_lock_key, accounts)))]
+
+    def __enter__(self) -> None:
+        for lock in self._locks:
+            lock.acquire()
+
+    def __exit__(self, *exc) -> None:
+        for lock in reversed(self._locks):
+            lock.release()
+
+
+@timed("format_name")
 def format_name(acc: "Account", in_relation_to: "Account | None" = None) -> str:
     if in_relation_to is None:
         return f"{acc.name} ({acc.id})"
@@ -19,40 +73,37 @@ def format_name(acc: "Account", in_relation_to: "Account | None" = None) -> str:
     return f"{acc.name} ({acc.id})"
 
 
+@timed("transfer_msg")
 def transfer_msg(
     source: "BalanceAccount",
     dest: "BalanceAccount",
 ) -> Tuple[str, str]:
-    source_name = format_name(source, dest)
-    dest_name = format_name(dest, source)
+    return transfer_msg_for(format_name(source, dest), format_name(dest, source))
 
-    return (f"Transfer to {dest_name}", f"Transfer from {source_name}")
 
-
-class Transaction:
-    def __init__(self, amount: int, description: str) -> None:
-        self.amount = amount
-        self.description = description
-
-    def str(self, indent=0) -> str:
-        color = Fore.GREEN if self.amount > 0 else Fore.RED
-        return (
-            f"{' ' * indent}{color}{format_amount(self.amount)}{Style.RESET_ALL} -"
-            f" {self.description}"
-        )
+def transfer_msg_for(source_name: str, dest_name: str) -> Tuple[str, str]:
+    """transfer_msg for names already formatted with format_name."""
+    return (f"Transfer to {dest_name}", f"Transfer from {source_name}")
 
 
 class Account:
+    __slots__ = ("_id", "_type", "_name")
+
     _id: str
     _type: str
     _name: str
 
-    def __init__(self, type: str, name: str) -> None:
+    def __init__(self, type: str, name: str, id: str | None = None) -> None:
         assert len(type) > 0, "Account type cannot be empty"
         assert len(name) > 0, "Account name cannot be empty"
         self._type = type
         self._name = name
-        self._id = create_id(type[0])
+        if id is None:
+            self._id = create_id(type[0])
+        else:
+            # restoring a saved account; keep its ID and never hand it out again
+            reserve_id(id)
+            self._id = id
 
     @property
     def id(self) -> str:
@@ -66,6 +117,9 @@ class Account:
     def name(self, name: str) -> None:
         assert len(name) > 0, "Account name cannot be empty"
         self._name = name
+        bank: "Bank | None" = getattr(self, "_bank", None)
+        if bank is not None:
+            bank._emit("rename", self)
 
     @property
     def type(self):
@@ -73,15 +127,69 @@ class Account:
 
 
 class BalanceAccount(Account):
+    __slots__ = (
+        "_balance",
+        "_transactions",
+        "_owner",
+        "_lock",
+        "_lock_order",
+        "_available",
+        "_dependents",
+    )
+
     _balance: int
-    _transactions: List[Transaction]
-    _owner: "Account"
+    _transactions: Ledger
+    _owner: "UserAccount"
 
-    def __init__(self, type: str, name: str) -> None:
-        super().__init__(type, name)
+    def __init__(self, type: str, name: str, id: str | None = None) -> None:
+        super().__init__(type, name, id)
         self._balance = 0
-        self._transactions = []
-        pass
+        self._transactions = Ledger()
+        # held while the balance changes; reentrant so a locked operation can
+        # call another one on the same account
+        self._lock_order = _stripe_numbers[next(_next_stripe) % LOCK_STRIPES]
+        self._lock = _stripes[self._lock_order]
+        # cached `available`, or None once a balance it depends on changes
+        self._available: int | None = None
+        # checking accounts that overdraw from this one; replaced, never changed
+        self._dependents = _NO_DEPENDENTS
+
+    def _withdraw_chain(self) -> List["BalanceAccount"]:
+        """Accounts a withdrawal from this account may touch."""
+        return [self]
+
+    @property
+    def available(self) -> int:
+        """
+        The most that can be withdrawn right now, counting overdraft cover, in
+        cents. Negative if nothing can be withdrawn at all.
+        """
+        available = self._available
+        if available is None:
+            available = self._available = self._compute_available()
+        return available
+
+    def _compute_available(self) -> int:
+        return self._balance
+
+    def _invalidate(self) -> None:
+        # called with this account locked; every account that reads our
+        # `available` has us in its _withdraw_chain, so it holds our lock too
+        self._available = None
+        for dependent in self._dependents:
+            dependent._invalidate()
+
+    def _detach(self) -> None:
+        """Cuts this account out of overdraft chains, as it is being closed."""
+        with locked([self, *self._dependents]):
+            for dependent in self._dependents:
+                dependent._overdraft_source = None  # type: ignore
+                dependent._invalidate()
+            self._dependents = _NO_DEPENDENTS
+
+    @property
+    def _bank(self) -> "Bank | None":
+        return self._owner._bank
 
     @property
     def balance(self) -> int:
@@ -92,46 +200,128 @@ class BalanceAccount(Account):
         return format_amount(self._balance, include_sign="negative")
 
     @property
-    def transactions(self) -> List[Transaction]:
+    def transactions(self) -> Sequence[Transaction]:
         return self._transactions
 
-    def transactions_str(self, indent: int = 0) -> str:
+    def balance_as_of(self, timestamp: int) -> int:
+        """
+        Returns the balance at a point in time.
+        timestamp: nanoseconds since the epoch, as in Transaction.timestamp
+        """
+        return self._transactions.balance_at(timestamp)
+
+    def net_flow(self, start: int, end: int) -> int:
+        """
+        Returns how much the balance changed between two points in time: the sum of
+        the postings after `start`, up to and including `end` (both nanoseconds
+        since the epoch).
+        """
+        return self._transactions.net_flow(start, end)
+
+    def history(self, cursor: int | None = None) -> Iterator[Transaction]:
+        """
+        Yields transactions newest first, starting with the one just before
+        `cursor` (a cursor returned by history_page) or with the newest.
+        """
+        ledger = self._transactions
+        start = len(ledger) if cursor is None else cursor
+        for i in range(start - 1, -1, -1):
+            yield ledger[i]
+
+    @timed("BalanceAccount.history_page")
+    def history_page(
+        self, cursor: int | None = None, size: int = HISTORY_PAGE_SIZE
+    ) -> Tuple[List[Transaction], int | None]:
+        """
+        Returns up to `size` transactions newest first, and the cursor for the
+        next (older) page, or None if there are no older transactions.
+        """
+        length = len(self._transactions)
+        if cursor is not None and not 0 <= cursor <= length:
+            raise ValueError("Invalid cursor")
+        end = length if cursor is None else cursor
+        start = max(end - size, 0)
+        return list(islice(self.history(end), end - start)), start or None
+
+    def transactions_str(self, indent: int = 0, limit: int | None = None) -> str:
+        """Returns the newest `limit` transactions (or all of them), newest first."""
         if len(self._transactions) == 0:
             return ""
 
-        return "\n".join(t.str(indent) for t in self._transactions)
+        history = self.history()
+        if limit is not None:
+            history = islice(history, limit)
+        return "\n".join(t.str(indent) for t in history)
 
-    def account_str(self, indent: int = 0) -> str:
+    def account_str(
+        self, indent: int = 0, limit: int | None = HISTORY_PAGE_SIZE
+    ) -> str:
         header = (
             f"{' ' * indent}{self.name} ({self.type}, {self.id}): {self.balance_str}"
         )
-        if len(self._transactions) > 0:
-            return header + "\n" + self.transactions_str(indent + 4)
-        else:
+        count = len(self._transactions)
+        if count == 0:
             return header
 
-    def _post(self, amount: int, description: str) -> None:
+        lines = header + "\n" + self.transactions_str(indent + 4, limit)
+        if limit is not None and count > limit:
+            lines += f"\n{' ' * (indent + 4)}... {count - limit} older transactions"
+        return lines
+
+    def _check_post(self, amount: int) -> None:
+        """Raises ValueError if posting `amount` would not fit in the ledger."""
+        if not -INT64_MAX <= amount <= INT64_MAX:
+            raise ValueError("Amount is too large")
+        if not -INT64_MAX <= self._balance + amount <= INT64_MAX:
+            raise ValueError("Balance would be too large")
+
+    # every balance change goes through here, so the transaction history always
+    # adds up to the balance and the bank sees every posting
+    def _post(
+        self,
+        amount: int,
+        description: str,
+        timestamp: int | None = None,
+        fee: bool = False,
+    ) -> None:
+        """fee: whether this is an overdraft fee the bank is charging"""
         if amount == 0:
             return
-        self._transactions.append(Transaction(amount, description))
-
+        self._check_post(amount)
+        self._balance += amount
+        self._available = None
+        if self._dependents:
+            self._invalidate()
+        ledger = self._transactions
+        ledger.append(amount, description, timestamp, fee)
+        bank = self._bank
+        if bank is not None:
+            bank._emit("post", self, amount, description, ledger._timestamps[-1], fee)
+
+    @timed("BalanceAccount.deposit")
     def deposit(self, amount: int, description: str | None = None) -> None:
         if amount < 0:
             raise ValueError("Cannot deposit negative amount")
 
-        self._balance += amount
-        self._post(amount, description or "Deposit")
+        with self._lock:
+            self._post(amount, description or "Deposit")
 
+    @timed("BalanceAccount.withdraw")
     def withdraw(self, amount: int, description: str | None = None) -> None:
+        with locked(self._withdraw_chain()):
+            self._withdraw(amount, description)
+
+    # withdraw, with every account in _withdraw_chain already locked
+    def _withdraw(self, amount: int, description: str | None) -> None:
         if amount < 0:
             raise ValueError("Cannot withdraw negative amount")
 
         if amount > self._balance:
             raise ValueError("Insufficient funds")
 
-        self._balance -= amount
         self._post(-amount, description or "Withdrawal")
 
+    @timed("BalanceAccount.transfer")
     def transfer(self, other: "BalanceAccount", amount: int) -> None:
         if self is other:
             raise ValueError("Cannot transfer to self")
@@ -141,10 +331,12 @@ class BalanceAccount(Account):
 
         to_msg, from_msg = transfer_msg(self, other)
 
-        try:
-            self.withdraw(amount, to_msg)
-        except ValueError as e:
-            raise ValueError(to_msg) from e
+        with locked(self._withdraw_chain() + [other]):
+            try:
+                other._check_post(amount)
+                self._withdraw(amount, to_msg)
+            except ValueError as e:
+                raise ValueError(to_msg) from e
 
-        # deposit cannot fail because we already checked for negative amount
-        other.deposit(amount, from_msg)
+            # deposit cannot fail because we already checked the amount
+            other._post(amount, from_msg)
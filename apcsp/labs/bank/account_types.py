@@ -1,67 +1,137 @@
-from hashlib import pbkdf2_hmac
 from secrets import token_bytes
-from typing import List, Optional
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, ValuesView
 
-from .account import Account, BalanceAccount
+from . import hashing
+from .account import HISTORY_PAGE_SIZE, Account, BalanceAccount
+from .hashing import DIGEST_SIZE, LEGACY_SPEC, Hasher, get_hasher
+
+if TYPE_CHECKING:
+    from .bank import Bank
 
 OVERDRAFT_FEE = 25_00
+OVERDRAFT_FEE_MSG = "Fee for overdraft from "
+# longest allowed chain of overdraft sources, counting the account itself
+MAX_OVERDRAFT_DEPTH = 8
 
 
 def _desc(msg: str, desc: str | None = None) -> str:
     return f"{msg} - {desc}" if desc else msg
 
 
+def interest_msg(interest: int) -> str:
+    return f"Interest of {interest // 1000_0}.{interest % 1000_0:02d}%"
+
+
+def check_overdraft_source(
+    owner: "UserAccount",
+    source: BalanceAccount,
+    account: Optional[BalanceAccount] = None,
+) -> None:
+    """
+    Raises ValueError unless `account` (or a new account of `owner`) may
+    overdraw from `source`.
+    """
+    if source._owner is not owner:
+        raise ValueError("Overdraft source must belong to the same user")
+    if owner.get_account(source.id) is not source:
+        raise ValueError("Overdraft source must be an open account")
+    chain = source._withdraw_chain()
+    if account is not None and account in chain:
+        raise ValueError("Overdraft sources cannot form a cycle")
+    if len(chain) >= MAX_OVERDRAFT_DEPTH:
+        raise ValueError(
+            f"Overdraft chains are limited to {MAX_OVERDRAFT_DEPTH} accounts"
+        )
+
+
 class CheckingAccount(BalanceAccount):
+    __slots__ = ("_overdraft_source",)
+
     def __init__(
         self,
         owner: "UserAccount",
         name: Optional[str] = None,
         overdraft_source: Optional[BalanceAccount] = None,
+        id: Optional[str] = None,
     ) -> None:
-        super().__init__("checking", name or "Checking Account")
-        owner._accounts.append(self)
+        super().__init__("checking", name or "Checking Account", id)
         self._owner = owner
-        self._balance = 0
-        self._overdraft_source = overdraft_source
+        self._overdraft_source = None
+        if overdraft_source is not None:
+            check_overdraft_source(owner, overdraft_source, self)
+            with overdraft_source._lock:
+                overdraft_source._dependents |= {self}
+            self._overdraft_source = overdraft_source
+        owner._add_account(self)
 
     @property
     def overdraft_source(self) -> Optional[BalanceAccount]:
         return self._overdraft_source
 
-    def withdraw(self, amount: int, description: str | None = None) -> None:
+    def _withdraw_chain(self) -> List[BalanceAccount]:
+        chain: List[BalanceAccount] = [self]
+        source = self._overdraft_source
+        while source is not None:
+            assert source not in chain, "Overdraft cycle"
+            chain.append(source)
+            source = getattr(source, "_overdraft_source", None)
+        return chain
+
+    def _compute_available(self) -> int:
+        if self._balance < 0:
+            return -1
+        if self._overdraft_source is None:
+            return self._balance
+        return self._balance + max(self._overdraft_source.available, 0)
+
+    def _detach(self) -> None:
+        super()._detach()
+        source = self._overdraft_source
+        if source is not None:
+            with source._lock:
+                source._dependents -= {self}
+
+    def _withdraw(self, amount: int, description: str | None) -> None:
         if self._balance < 0:
             raise ValueError("Currently overdrawn; cannot withdraw")
         if amount < 0:
             raise ValueError("Cannot withdraw negative amount")
 
-        if amount > self._balance:
-            if self._overdraft_source is not None:
-                self._overdraft_source.withdraw(
-                    amount - self._balance,
-                    _desc(f"Overdraft from {self.name}", description),
-                )
-                self._post(-self.balance, _desc("Overdraft partial", description))
-                self._post(
-                    -OVERDRAFT_FEE,
-                    _desc(
-                        f"Fee for overdraft from {self._overdraft_source.name}",
-                        description,
-                    ),
-                )
-                self._balance -= self.balance + OVERDRAFT_FEE
-            else:
-                raise ValueError("Insufficient funds")
-        else:
-            self._balance -= amount
+        if amount <= self._balance:
             self._post(-amount, description or "Withdrawal")
+            return
+
+        # decided up front from the cached cover, so the sources can't refuse
+        if amount > self.available:
+            raise ValueError("Insufficient funds")
+
+        source = self._overdraft_source
+        assert source is not None
+        source._withdraw(
+            amount - self._balance,
+            _desc(f"Overdraft from {self.name}", description),
+        )
+        self._post(-self.balance, _desc("Overdraft partial", description))
+        self._post(
+            -OVERDRAFT_FEE,
+            _desc(f"{OVERDRAFT_FEE_MSG}{source.name}", description),
+            fee=True,
+        )
 
 
 class SavingsAccount(BalanceAccount):
-    def __init__(self, owner: "UserAccount", name: Optional[str] = None) -> None:
-        super().__init__("savings", name or "Savings Account")  # type: ignore
-        owner._accounts.append(self)
+    __slots__ = ()
+
+    def __init__(
+        self,
+        owner: "UserAccount",
+        name: Optional[str] = None,
+        id: Optional[str] = None,
+    ) -> None:
+        super().__init__("savings", name or "Savings Account", id)  # type: ignore
         self._owner = owner
-        self._balance = 0
+        owner._add_account(self)
 
     def add_interest(self, interest: int) -> int:
         """
@@ -69,31 +139,120 @@ class SavingsAccount(BalanceAccount):
         interest: the interest rate to add, in thousandths of a percent
         Returns: the amount of interest added, in cents
         """
-        amount = (self._balance * interest) // 1000_000
-        self._balance += amount
-        self._post(amount, f"Interest of {interest // 1000_0}.{interest % 1000_0:02d}%")
+        with self._lock:
+            amount = (self._balance * interest) // 1000_000
+            self._post(amount, interest_msg(interest))
         return amount
 
 
-PBKDF2_ROUNDS = 100_000
-
 UserHoldableAccount = CheckingAccount | SavingsAccount
 
 
-def pbkdf2(password: str, salt: bytes) -> bytes:
-    return pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PBKDF2_ROUNDS)
+SALT_SIZE = 32
+# held while a user's digests and hashers are read or replaced, so a check never
+# pairs a digest with the wrong hasher and changing both at once can't lose either
+_secrets_lock = Lock()
+
+# the hasher, and a salt followed by the password and PIN digests it derived
+Secrets = Tuple[Hasher, bytes]
+
+
+def derive_secrets(password: str, pin: str) -> Secrets:
+    """Derives the digests of a new user with the default hasher and a new salt."""
+    hasher = hashing.default_hasher
+    salt = token_bytes(SALT_SIZE)
+    return hasher, salt + hasher.derive(password, salt) + hasher.derive(pin, salt)
 
 
 class UserAccount(Account):
-    _accounts: List[UserHoldableAccount]
+    __slots__ = (
+        "_accounts",
+        "_bank",
+        "_username",
+        "_secrets",
+        "_password_hasher",
+        "_pin_hasher",
+    )
+
+    # insertion ordered, so accounts list in the order they were opened
+    _accounts: Dict[str, UserHoldableAccount]
+    # bank this user is registered with, if any; keeps the bank's account index
+    # in sync as accounts are opened and closed
+    _bank: "Bank | None"
+    # salt, password digest and PIN digest, one after another in one object
+    _secrets: bytes
+    # what derived each digest; shared between users, see hashing.get_hasher
+    _password_hasher: Hasher
+    _pin_hasher: Hasher
 
-    def __init__(self, name: str, username: str, password: str, pin: str) -> None:
+    def __init__(
+        self,
+        name: str,
+        username: str,
+        password: str,
+        pin: str,
+        secrets: Secrets | None = None,
+    ) -> None:
+        """secrets: derive_secrets(password, pin), if already worked out"""
         super().__init__("user", name)
-        self._accounts = []
+        self._accounts = {}
+        self._bank = None
         self._username = username
-        self._salt = token_bytes(32)
-        self._password = pbkdf2(password, self._salt)
-        self._pin = pbkdf2(pin, self._salt)
+        hasher, self._secrets = secrets or derive_secrets(password, pin)
+        self._password_hasher = self._pin_hasher = hasher
+
+    @classmethod
+    def restore(
+        cls,
+        name: str,
+        username: str,
+        id: str,
+        salt: bytes,
+        password: bytes,
+        pin: bytes,
+        password_hasher: Hasher | None = None,
+        pin_hasher: Hasher | None = None,
+    ) -> "UserAccount":
+        """
+        Recreates a saved user from its already derived password and PIN. The
+        hashers default to the one used before hashers were recorded.
+        """
+        assert len(salt) == SALT_SIZE, "Wrong salt size"
+        assert len(password) == len(pin) == DIGEST_SIZE, "Wrong digest size"
+        legacy = get_hasher(LEGACY_SPEC)
+        user = cls.__new__(cls)
+        Account.__init__(user, "user", name, id)
+        user._accounts = {}
+        user._bank = None
+        user._username = username
+        user._secrets = salt + password + pin
+        user._password_hasher = password_hasher or legacy
+        user._pin_hasher = pin_hasher or legacy
+        return user
+
+    @property
+    def _salt(self) -> bytes:
+        return self._secrets[:SALT_SIZE]
+
+    @property
+    def _password(self) -> bytes:
+        return self._secrets[SALT_SIZE : SALT_SIZE + DIGEST_SIZE]
+
+    @property
+    def _pin(self) -> bytes:
+        return self._secrets[SALT_SIZE + DIGEST_SIZE :]
+
+    def _store_password(self, digest: bytes, hasher: Hasher) -> None:
+        assert len(digest) == DIGEST_SIZE, "Wrong digest size"
+        with _secrets_lock:
+            self._secrets = self._salt + digest + self._pin
+            self._password_hasher = hasher
+
+    def _store_pin(self, digest: bytes, hasher: Hasher) -> None:
+        assert len(digest) == DIGEST_SIZE, "Wrong digest size"
+        with _secrets_lock:
+            self._secrets = self._salt + self._password + digest
+            self._pin_hasher = hasher
 
     @property
     def username(self) -> str:
@@ -104,28 +263,66 @@ class UserAccount(Account):
         return "user"
 
     @property
-    def accounts(self) -> List[UserHoldableAccount]:
-        return self._accounts
+    def accounts(self) -> ValuesView[UserHoldableAccount]:
+        return self._accounts.values()
+
+    def get_account(self, account_id: str) -> UserHoldableAccount | None:
+        return self._accounts.get(account_id)
 
     def login(self, password: str) -> bool:
-        return self._password == pbkdf2(password, self._salt)
+        with _secrets_lock:
+            hasher, digest = self._password_hasher, self._password
+        if hasher.derive(password, self._salt) != digest:
+            return False
+        if hasher is not hashing.default_hasher:
+            # derived with older parameters; replace it while the password is known
+            self.set_password(password)
+        return True
 
     def set_password(self, password: str) -> None:
-        self._password = pbkdf2(password, self._salt)
+        hasher = hashing.default_hasher
+        self._store_password(hasher.derive(password, self._salt), hasher)
+        if self._bank is not None:
+            self._bank._emit("credentials", self)
 
     def set_pin(self, pin: str) -> None:
-        self._pin = pbkdf2(pin, self._salt)
+        hasher = hashing.default_hasher
+        self._store_pin(hasher.derive(pin, self._salt), hasher)
+        if self._bank is not None:
+            self._bank._emit("credentials", self)
 
     def check_pin(self, pin: str) -> bool:
-        return self._pin == pbkdf2(pin, self._salt)
+        with _secrets_lock:
+            hasher, digest = self._pin_hasher, self._pin
+        if hasher.derive(pin, self._salt) != digest:
+            return False
+        if hasher is not hashing.default_hasher:
+            # derived with older parameters; replace it while the PIN is known
+            self.set_pin(pin)
+        return True
+
+    def _add_account(self, account: UserHoldableAccount) -> None:
+        assert account.id not in self._accounts, "Multiple accounts with same ID"
+        self._accounts[account.id] = account
+        if self._bank is not None:
+            self._bank._index_account(account)
 
     def close_account(self, account: UserHoldableAccount) -> None:
-        self._accounts.remove(account)
+        del self._accounts[account.id]
+        account._detach()
+        if self._bank is not None:
+            self._bank._unindex_account(account)
 
-    def str(self, indent: int = 0) -> str:
+    def str(self, indent: int = 0, limit: int | None = HISTORY_PAGE_SIZE) -> str:
+        """
+        Returns the user's accounts with their newest `limit` transactions each (or
+        all of them).
+        """
         header = f"{' ' * indent}User Account: {self.name} ({self.id})"
         if len(self._accounts) == 0:
             return f"{header}\n{' ' * (indent + 4)}No accounts"
 
-        account_str = "\n".join(acc.account_str(indent + 4) for acc in self._accounts)
+        account_str = "\n".join(
+            acc.account_str(indent + 4, limit) for acc in self.accounts
+        )
         return f"{header}\n{account_str}"
@@ -1,18 +1,486 @@
-from typing import Dict
+import asyncio
+import threading
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from time import monotonic, time_ns
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Set,
+    Tuple,
+)
 
+from .account import (
+    Account,
+    BalanceAccount,
+    Transaction,
+    format_name,
+    locked,
+    transfer_msg_for,
+)
 from .account_types import (
+    OVERDRAFT_FEE,
     CheckingAccount,
     SavingsAccount,
+    Secrets,
     UserAccount,
     UserHoldableAccount,
+    check_overdraft_source,
 )
+from .ledger import INT64_MAX, Ledger, descriptions
+from .metrics import timed
+from .util import format_amount
+
+if TYPE_CHECKING:
+    from .search import SearchIndex
+
+
+class BankListener(object):
+    """
+    Receives every change made to a bank. Subclass and override the events you
+    need, then add an instance to `Bank.listeners`.
+    """
+
+    def on_register(self, user: UserAccount) -> None:
+        pass
+
+    def on_delete(self, user: UserAccount) -> None:
+        pass
+
+    def on_credentials(self, user: UserAccount) -> None:
+        pass
+
+    def on_rename(self, account: Account) -> None:
+        pass
+
+    def on_open(self, account: UserHoldableAccount) -> None:
+        pass
+
+    def on_close(self, account: UserHoldableAccount) -> None:
+        pass
+
+    def on_post(
+        self,
+        account: BalanceAccount,
+        amount: int,
+        description: str,
+        timestamp: int,
+        fee: bool = False,
+    ) -> None:
+        """fee: whether the posting is an overdraft fee charged by the bank"""
+        pass
+
+    def on_batch(self, events: List[Tuple[str, tuple]]) -> None:
+        """Receives the events of a batch operation once all of it succeeded."""
+        for event, args in events:
+            getattr(self, f"on_{event}")(*args)
+
+
+def count_fees(account: BalanceAccount, start: int) -> int:
+    """Total of the overdraft fees in an account's history from `start` on."""
+    ledger = account._transactions
+    if -OVERDRAFT_FEE not in ledger.amounts(start):
+        return 0
+    return OVERDRAFT_FEE * sum(map(descriptions.is_fee, ledger.columns(start)[2]))
+
+
+class BankAggregates(BankListener):
+    """
+    Bank-wide totals, kept up to date as accounts change so they can be read at
+    any time without walking every account. The bank feeds it every event
+    before its listeners, and settles batches in one step.
+    """
+
+    # open accounts by type
+    counts: Dict[str, int]
+    # total balance of open accounts by type, in cents
+    totals: Dict[str, int]
+    # overdraft fees charged to open accounts, in cents
+    overdraft_fees: int
+    # checking accounts with a negative balance
+    _overdrawn: Set[CheckingAccount]
+
+    def __init__(self) -> None:
+        self.counts = {}
+        self.totals = {}
+        self.overdraft_fees = 0
+        self._overdrawn = set()
+        # events arrive from every thread that posts
+        self._lock = threading.Lock()
+
+    @property
+    def total(self) -> int:
+        """Total balance of every open account, in cents."""
+        return sum(self.totals.values())
+
+    @property
+    def overdrawn_count(self) -> int:
+        return len(self._overdrawn)
+
+    @property
+    def overdrawn_total(self) -> int:
+        """How much overdrawn checking accounts owe the bank, in cents."""
+        with self._lock:
+            return -sum(acc.balance for acc in self._overdrawn)
+
+    def _add(self, account: UserHoldableAccount, sign: int) -> None:
+        # called with _lock held
+        type = account.type
+        self.counts[type] = self.counts.get(type, 0) + sign
+        self.totals[type] = self.totals.get(type, 0) + sign * account.balance
+        if isinstance(account, CheckingAccount):
+            if sign > 0 and account.balance < 0:
+                self._overdrawn.add(account)
+            elif sign < 0:
+                self._overdrawn.discard(account)
+            # accounts restored from disk arrive with their history
+            self.overdraft_fees += sign * count_fees(account, 0)
+
+    def _post(self, account: BalanceAccount, amount: int, fee: bool) -> None:
+        # called with _lock held. In a batch the balance is already the one after
+        # the whole batch, which is still right for _overdrawn once it ends
+        type = account._type
+        self.totals[type] = self.totals.get(type, 0) + amount
+        if type == "checking":
+            if account._balance < 0:
+                self._overdrawn.add(account)  # type: ignore
+            else:
+                self._overdrawn.discard(account)  # type: ignore
+            if fee:
+                self.overdraft_fees += OVERDRAFT_FEE
+
+    def post_each(
+        self, accounts: Sequence[BalanceAccount], amounts: Sequence[int]
+    ) -> None:
+        """Catches up with Bank._post_each, without an event per posting."""
+        totals = self.totals
+        with self._lock:
+            for acc, amount in zip(accounts, amounts):
+                type = acc._type
+                if type == "checking":
+                    self._post(acc, amount, False)
+                else:
+                    totals[type] = totals.get(type, 0) + amount
+
+    def on_register(self, user: UserAccount) -> None:
+        # the user's accounts each get an on_open
+        pass
+
+    def on_delete(self, user: UserAccount) -> None:
+        with self._lock:
+            for acc in user.accounts:
+                self._add(acc, -1)
+
+    def on_open(self, account: UserHoldableAccount) -> None:
+        with self._lock:
+            self._add(account, 1)
+
+    def on_close(self, account: UserHoldableAccount) -> None:
+        with self._lock:
+            self._add(account, -1)
+
+    def on_post(
+        self,
+        account: BalanceAccount,
+        amount: int,
+        description: str,
+        timestamp: int,
+        fee: bool = False,
+    ) -> None:
+        with self._lock:
+            self._post(account, amount, fee)
+
+    def settle(
+        self, accounts: List[BalanceAccount], balances: array, lengths: array
+    ) -> None:
+        """
+        Catches up with a batch from the balances and ledger lengths of the
+        accounts it touched from before it ran, instead of from its events.
+        """
+        totals = self.totals
+        with self._lock:
+            for acc, balance, length in zip(accounts, balances, lengths):
+                type = acc._type
+                totals[type] = totals.get(type, 0) + acc._balance - balance
+                if type != "checking":
+                    continue
+                if acc._balance < 0:
+                    self._overdrawn.add(acc)  # type: ignore
+                else:
+                    self._overdrawn.discard(acc)  # type: ignore
+                self.overdraft_fees += count_fees(acc, length)
+
+    def str(self) -> str:
+        lines = [
+            f"{type}: {self.counts[type]:,} accounts,"
+            f" {format_amount(self.totals[type], 'negative')}"
+            for type in sorted(self.counts)
+        ]
+        lines.append(
+            f"overdrawn: {self.overdrawn_count:,} checking accounts,"
+            f" {format_amount(self.overdrawn_total, False)} owed"
+        )
+        lines.append(f"overdraft fees: {format_amount(self.overdraft_fees, False)}")
+        return "\n".join(lines)
 
 
 class Bank(object):
     accounts: Dict[str, UserAccount] = {}
+    listeners: List[BankListener]
+    # running totals over the whole bank; not in `listeners`
+    aggregates: BankAggregates
+    # full-text search over descriptions, if one is attached
+    search: "SearchIndex | None"
+    # every open account of every user, keyed by account ID
+    _index: Dict[str, UserHoldableAccount]
+    # password and PIN checks run here; hashlib releases the GIL while hashing,
+    # so checks on separate threads run in parallel
+    _pool: ThreadPoolExecutor | None
 
-    def __init__(self):
+    def __init__(self, workers: int | None = None):
         self.accounts = {}
+        self.aggregates = BankAggregates()
+        self.listeners = []
+        self.search = None
+        # per thread: events held back until a batch operation finishes
+        self._batch = threading.local()
+        # guards accounts and _index
+        self._lock = threading.RLock()
+        self._index = {}
+        # held while postings move to cold storage, so readers that don't lock
+        # each account (journal snapshots) never see a ledger half moved
+        self._spill_lock = threading.Lock()
+        self._workers = workers
+        self._pool = None
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        pool = self._pool
+        if pool is None:
+            # checked again under the lock, so two threads never both make one
+            with self._lock:
+                pool = self._pool
+                if pool is None:
+                    pool = self._pool = ThreadPoolExecutor(
+                        self._workers, thread_name_prefix="bank-verify"
+                    )
+        return pool
+
+    def close(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    @property
+    def _deferred(self) -> List[Tuple[str, tuple]] | None:
+        return getattr(self._batch, "events", None)
+
+    def _emit(self, event: str, *args) -> None:
+        deferred = self._deferred
+        if deferred is not None:
+            deferred.append((event, args))
+            return
+        method = f"on_{event}"
+        getattr(self.aggregates, method)(*args)
+        for listener in self.listeners:
+            getattr(listener, method)(*args)
+
+    @contextmanager
+    def _atomic(self, accounts: Iterable[BalanceAccount]) -> Iterator[None]:
+        """
+        Locks `accounts` and runs the body all or nothing: if it raises, their
+        balances and histories are put back and listeners never hear about it.
+        """
+        assert self._deferred is None, "Batch operations cannot be nested"
+        saved = list(accounts)
+        with locked(saved):
+            # saved in arrays rather than tuples to keep large batches cheap
+            balances = array("q", [acc._balance for acc in saved])
+            lengths = array("q", [len(acc._transactions) for acc in saved])
+            events = self._batch.events = []
+            try:
+                yield
+            except BaseException:
+                for acc, balance, length in zip(saved, balances, lengths):
+                    acc._balance = balance
+                    acc._transactions.truncate(length)
+                    acc._invalidate()
+                raise
+            finally:
+                self._batch.events = None
+
+            # batch operations may set balances without going through _post
+            for acc, balance in zip(saved, balances):
+                if acc._balance != balance:
+                    acc._invalidate()
+
+            self.aggregates.settle(saved, balances, lengths)
+            for listener in self.listeners:
+                listener.on_batch(events)
+
+    def transfer_batch(self, legs: Iterable[Tuple[str, str, int]]) -> int:
+        """
+        Makes every (source ID, destination ID, amount in cents) transfer, or none
+        of them. Legs are checked together, so a leg may spend money that a later
+        leg brings in. Raises ValueError if any leg fails, and returns the number
+        of legs otherwise.
+        """
+        resolved: List[Tuple[UserHoldableAccount, UserHoldableAccount, int]] = []
+        net: Dict[UserHoldableAccount, int] = {}
+        for i, (source_id, dest_id, amount) in enumerate(legs):
+            source = self._index.get(source_id)
+            dest = self._index.get(dest_id)
+            if source is None:
+                raise ValueError(f"Leg {i}: invalid source account ID {source_id}")
+            if dest is None:
+                raise ValueError(f"Leg {i}: invalid destination account ID {dest_id}")
+            if source is dest:
+                raise ValueError(f"Leg {i}: cannot transfer to self")
+            if amount < 0:
+                raise ValueError(f"Leg {i}: cannot transfer negative amount")
+            if amount > INT64_MAX:
+                raise ValueError(f"Leg {i}: amount is too large")
+            resolved.append((source, dest, amount))
+            net[source] = net.get(source, 0) - amount
+            net[dest] = net.get(dest, 0) + amount
+
+        sources = {source for source, _, _ in resolved}
+        touched: Set[BalanceAccount] = set(net)
+        for acc in sources:
+            touched.update(acc._withdraw_chain())
+
+        # balances are only read once every account involved is locked
+        with self._atomic(touched):
+            for acc, change in net.items():
+                try:
+                    acc._check_post(change)
+                except ValueError as e:
+                    raise ValueError(f"{format_name(acc)}: {e}") from None
+
+            # accounts that can't cover what they send without an overdraft
+            overdrawing = []
+            for acc in sources:
+                if acc._balance >= 0 and acc._balance + net[acc] >= 0:
+                    continue
+                if (
+                    isinstance(acc, CheckingAccount)
+                    and acc._balance >= 0
+                    and acc.overdraft_source is not None
+                ):
+                    overdrawing.append(acc)
+                    continue
+                raise ValueError(f"Insufficient funds in {format_name(acc)}")
+
+            if overdrawing:
+                # overdrafts depend on the order of the legs, so make them one by one
+                for i, (source, dest, amount) in enumerate(resolved):
+                    try:
+                        source.transfer(dest, amount)
+                    except ValueError as e:
+                        raise ValueError(f"Leg {i}: {e}") from e
+            else:
+                self._apply_transfers(resolved, net)
+
+        return len(resolved)
+
+    def _apply_transfers(
+        self,
+        legs: List[Tuple[UserHoldableAccount, UserHoldableAccount, int]],
+        net: Dict[UserHoldableAccount, int],
+    ) -> None:
+        # every leg is known to succeed, so post straight to the ledgers and
+        # settle each balance once; the whole batch shares one timestamp
+        now = time_ns()
+        events = self._deferred if self.listeners else None
+        # format_name only depends on whether the owners differ
+        names: Dict[Tuple[UserHoldableAccount, bool], str] = {}
+        for source, dest, amount in legs:
+            if amount == 0:
+                continue
+            same_owner = source._owner is dest._owner
+            source_name = names.get((source, same_owner))
+            if source_name is None:
+                source_name = names[source, same_owner] = format_name(source, dest)
+            dest_name = names.get((dest, same_owner))
+            if dest_name is None:
+                dest_name = names[dest, same_owner] = format_name(dest, source)
+            to_msg, from_msg = transfer_msg_for(source_name, dest_name)
+
+            source._transactions.append(-amount, to_msg, now)
+            dest._transactions.append(amount, from_msg, now)
+            if events is not None:
+                events.append(("post", (source, -amount, to_msg, now)))
+                events.append(("post", (dest, amount, from_msg, now)))
+
+        for acc, change in net.items():
+            acc._balance += change
+
+    def _post_each(
+        self,
+        accounts: Sequence[BalanceAccount],
+        balances: Sequence[int],
+        amounts: Sequence[int],
+        description: str,
+        timestamp: int,
+    ) -> None:
+        """
+        Posts amounts[i] to accounts[i], whose balance is balances[i], for every
+        i, as one batch with a single timestamp. Call with the accounts locked,
+        once nothing can fail: unlike _atomic, there is no rollback, so there is
+        nothing to save first.
+        """
+        assert self._deferred is None, "Batch operations cannot be nested"
+        Ledger.append_each(
+            [acc._transactions for acc in accounts], amounts, description, timestamp
+        )
+        for acc, balance, amount in zip(accounts, balances, amounts):
+            if amount:
+                acc._balance = balance + amount
+                # _invalidate, without the call for the many with no dependents
+                acc._available = None
+                if acc._dependents:
+                    acc._invalidate()
+
+        self.aggregates.post_each(accounts, amounts)
+        if self.listeners:
+            events: List[Tuple[str, tuple]] = [
+                ("post", (acc, amount, description, timestamp))
+                for acc, amount in zip(accounts, amounts)
+                if amount
+            ]
+            for listener in self.listeners:
+                listener.on_batch(events)
+
+    def _index_account(self, account: UserHoldableAccount) -> None:
+        with self._lock:
+            assert account.id not in self._index, "Multiple accounts with same ID"
+            self._index[account.id] = account
+            self._emit("open", account)
+
+    def _unindex_account(self, account: UserHoldableAccount) -> None:
+        with self._lock:
+            if self._index.pop(account.id, None) is not None:
+                self._emit("close", account)
+
+    def _attach(self, user: UserAccount) -> None:
+        with self._lock:
+            if user.username in self.accounts:
+                raise RuntimeError("Username already taken")
+
+            user._bank = self
+            self.accounts[user.username] = user
+            self._emit("register", user)
+            for acc in user.accounts:
+                self._index_account(acc)
+
+    def find_account(self, account_id: str) -> UserHoldableAccount | None:
+        return self._index.get(account_id)
 
     def login(self, username: str, password: str) -> UserAccount | None:
         if username in self.accounts:
@@ -22,32 +490,162 @@ class Bank(object):
 
         return None
 
+    def submit_login(
+        self, username: str, password: str
+    ) -> "Future[UserAccount | None]":
+        return self.pool.submit(self.login, username, password)
+
+    async def login_async(self, username: str, password: str) -> UserAccount | None:
+        return await asyncio.wrap_future(self.submit_login(username, password))
+
+    def submit_check_pin(self, user: UserAccount, pin: str) -> "Future[bool]":
+        return self.pool.submit(user.check_pin, pin)
+
+    async def check_pin_async(self, user: UserAccount, pin: str) -> bool:
+        return await asyncio.wrap_future(self.submit_check_pin(user, pin))
+
     def register(
-        self, name: str, username: str, password: str, pin: str
+        self,
+        name: str,
+        username: str,
+        password: str,
+        pin: str,
+        secrets: Secrets | None = None,
     ) -> UserAccount:
+        """secrets: derive_secrets(password, pin), if already worked out"""
         if username in self.accounts:
             raise RuntimeError("Username already taken")
 
-        account = UserAccount(name, username, password, pin)
-        self.accounts[username] = account
+        account = UserAccount(name, username, password, pin, secrets)
+        self._attach(account)
+        return account
+
+    def delete(self, username: str) -> UserAccount:
+        with self._lock:
+            account = self.accounts.pop(username)
+            for acc in account.accounts:
+                self._index.pop(acc.id, None)
+            self._emit("delete", account)
+            account._bank = None
         return account
 
 
+# how long a correct PIN is remembered for, in seconds
+PIN_TTL = 5 * 60
+# how long a remembered PIN survives without being used, in seconds
+PIN_IDLE_TIMEOUT = 60
+
+
 class BankState(object):
     user: UserAccount | None
+    # number of PIN key derivations skipped because the PIN was remembered
+    pin_derivations_avoided: int
 
-    def __init__(self, bank: Bank) -> None:
+    def __init__(
+        self,
+        bank: Bank,
+        pin_ttl: float = PIN_TTL,
+        pin_idle_timeout: float = PIN_IDLE_TIMEOUT,
+    ) -> None:
         self.bank = bank
         self.user = None
+        self.pin_ttl = pin_ttl
+        self.pin_idle_timeout = pin_idle_timeout
+        self.pin_derivations_avoided = 0
+        self._pin_granted_at: float | None = None
+        self._pin_used_at = 0.0
+
+    def _set_user(self, user: UserAccount | None) -> None:
+        self.user = user
+        self.revoke_pin()
 
+    @timed("BankState.login")
     def login(self, username: str, password: str) -> UserAccount | None:
         acc = self.bank.login(username, password)
         if acc:
-            self.user = acc
+            self._set_user(acc)
         return acc
 
+    @timed("BankState.login_async")
+    async def login_async(self, username: str, password: str) -> UserAccount | None:
+        acc = await self.bank.login_async(username, password)
+        if acc:
+            self._set_user(acc)
+        return acc
+
+    def _grant_pin(self) -> None:
+        self._pin_granted_at = self._pin_used_at = monotonic()
+
+    def revoke_pin(self) -> None:
+        self._pin_granted_at = None
+
+    def use_pin_grant(self) -> bool:
+        """
+        Returns whether the user entered their PIN recently enough that it does not
+        need to be asked for (and derived) again, and refreshes the idle timeout.
+        """
+        if self._pin_granted_at is None:
+            return False
+
+        now = monotonic()
+        if (
+            now - self._pin_granted_at > self.pin_ttl
+            or now - self._pin_used_at > self.pin_idle_timeout
+        ):
+            self.revoke_pin()
+            return False
+
+        self._pin_used_at = now
+        self.pin_derivations_avoided += 1
+        return True
+
+    @timed("BankState.check_pin")
+    def check_pin(self, pin: str) -> bool:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to check PIN.")
+
+        if not self.user.check_pin(pin):
+            return False
+
+        self._grant_pin()
+        return True
+
+    @timed("BankState.check_pin_async")
+    async def check_pin_async(self, pin: str) -> bool:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to check PIN.")
+
+        if not await self.bank.check_pin_async(self.user, pin):
+            return False
+
+        self._grant_pin()
+        return True
+
+    @timed("BankState.set_pin")
+    def set_pin(self, pin: str) -> None:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to change PIN.")
+
+        self.user.set_pin(pin)
+        self.revoke_pin()
+
+    async def set_password_async(self, password: str) -> None:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to change password.")
+
+        await asyncio.wrap_future(
+            self.bank.pool.submit(self.user.set_password, password)
+        )
+
+    async def set_pin_async(self, pin: str) -> None:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to change PIN.")
+
+        await asyncio.wrap_future(self.bank.pool.submit(self.user.set_pin, pin))
+        self.revoke_pin()
+
     def logout(self) -> None:
-        self.user = None
+        self._set_user(None)
 
     def username_taken(self, username: str) -> bool:
         return username in self.bank.accounts
@@ -56,16 +654,18 @@ class BankState(object):
         if self.user is None:
             raise RuntimeError("Must be logged in to delete an account.")
 
-        self.bank.accounts.pop(self.user.username)
-        self.user = None
+        self.bank.delete(self.user.username)
+        self._set_user(None)
 
+    @timed("BankState.register")
     def register(
         self, name: str, username: str, password: str, pin: str
     ) -> UserAccount:
         acc = self.bank.register(name, username, password, pin)
-        self.user = acc
+        self._set_user(acc)
         return acc
 
+    @timed("BankState.open_account")
     def open_account(
         self,
         account_type: str,
@@ -77,6 +677,9 @@ class BankState(object):
 
         acc: UserHoldableAccount
         if account_type == "checking":
+            if overdraft_source is not None:
+                # before the account exists, so a rejected one uses up no ID
+                check_overdraft_source(self.user, overdraft_source)
             acc = CheckingAccount(self.user, name or None, overdraft_source)
         elif account_type == "savings":
             acc = SavingsAccount(self.user, name or None)
@@ -85,6 +688,7 @@ class BankState(object):
 
         return acc
 
+    @timed("BankState.close_account")
     def close_account(self, account_id: str) -> None:
         if self.user is None:
             raise RuntimeError("Must be logged in to close an account.")
@@ -95,29 +699,30 @@ class BankState(object):
 
         self.user.close_account(acc)
 
+    @timed("BankState.search")
+    def search(
+        self, query: str, cursor: int | None = None
+    ) -> Tuple[List[Tuple[BalanceAccount, Transaction]], int | None]:
+        """SearchIndex.search over the user's accounts."""
+        if self.user is None:
+            raise RuntimeError("Must be logged in to search.")
+        if self.bank.search is None:
+            raise RuntimeError("Search is not enabled.")
+
+        return self.bank.search.search(query, self.user, cursor)
+
+    @timed("BankState.find_account")
     def find_account(self, account_id: str) -> UserHoldableAccount | None:
         acc = self.get_account(account_id)
 
         if not acc:
-            all_accounts = [
-                acc
-                for acclist in self.bank.accounts.values()
-                for acc in acclist.accounts
-            ]
-            matches = list(filter(lambda a: a.id == account_id, all_accounts))
-            if not matches:
-                return None
-            assert len(matches) == 1, "Multiple accounts with same ID"
-            return matches[0]
+            return self.bank.find_account(account_id)
 
         return acc
 
+    @timed("BankState.get_account")
     def get_account(self, account_id: str) -> UserHoldableAccount | None:
         if self.user is None:
             raise RuntimeError("Must be logged in to access an account.")
 
-        acc = list(filter(lambda a: a.id == account_id, self.user.accounts))
-        if not acc:
-            return None
-        assert len(acc) == 1, "Multiple accounts with same ID"
-        return acc[0]
+        return self.user.get_account(account_id)
@@ -0,0 +1,205 @@
+"""
+Runs a file of bank operations without the menus.
+
+There is one operation per line, split like a shell command, so quote
+arguments that contain spaces. Blank lines and anything after a # are
+skipped. Amounts are in dollars, like 12.50.
+
+register NAME USERNAME PASSWORD PIN   registers, then acts as the new user
+login USERNAME PASSWORD               acts as a user, checking the password
+user USERNAME                         acts as a user, without a password
+logout
+open checking|savings [NAME] [OVERDRAFT_SOURCE] [@LABEL]
+close ACCOUNT
+rename ACCOUNT NAME
+deposit ACCOUNT AMOUNT [DESCRIPTION]
+withdraw ACCOUNT AMOUNT [DESCRIPTION]
+transfer SOURCE DEST AMOUNT
+
+Accounts are given by ID, or by a label given to `open`, like @savings. Every
+account except a transfer's destination must belong to the current user.
+Batch files are trusted, so no PINs are asked for.
+
+A line that fails is reported with its line number, and the lines after it
+still run. Keys for upcoming register lines are derived on the bank's pool
+while earlier lines are applied.
+
+Run with `python -m apcsp.labs.bank --batch FILE`.
+"""
+
+import shlex
+import sys
+from collections import deque
+from concurrent.futures import Future
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Deque, Dict, Iterable, List, TextIO, Tuple
+
+from .account_types import UserHoldableAccount, derive_secrets
+from .bank import Bank, BankState
+from .ledger import INT64_MAX
+
+# lines read ahead of the one being applied, so register lines can start
+# deriving keys early
+LOOKAHEAD = 256
+
+# characters that need shlex to split a line
+_SPECIAL = frozenset("\"'\\#")
+
+
+def parse_amount(text: str) -> int:
+    """Returns a dollar amount like 12.50 in cents."""
+    try:
+        cents = Decimal(text) * 100
+    except InvalidOperation:
+        raise RuntimeError(f"Invalid amount: {text}")
+    if not cents.is_finite() or cents != cents.to_integral_value():
+        raise RuntimeError(f"Invalid amount: {text}")
+    if abs(cents) > INT64_MAX:
+        raise RuntimeError(f"Amount too large: {text}")
+    return int(cents)
+
+
+def _name(text: str, what: str) -> str:
+    if not text:
+        raise RuntimeError(f"Empty {what}")
+    return text
+
+
+def _usage(args: List[str], usage: str, required: int, optional: int = 0) -> None:
+    if not required <= len(args) <= required + optional:
+        raise RuntimeError(f"Usage: {usage}")
+
+
+class Batch(object):
+    # number of lines applied, and of those that failed
+    done: int
+    failed: int
+    # account IDs by label
+    labels: Dict[str, str]
+
+    def __init__(self, bank: Bank, errors: TextIO = sys.stderr) -> None:
+        self.bank = bank
+        self.state = BankState(bank)
+        self.errors = errors
+        self.done = 0
+        self.failed = 0
+        self.labels = {}
+        self._operations: Dict[str, Callable[[List[str]], None]] = {
+            "login": self._login,
+            "user": self._user,
+            "logout": self._logout,
+            "open": self._open,
+            "close": self._close,
+            "rename": self._rename,
+            "deposit": self._deposit,
+            "withdraw": self._withdraw,
+            "transfer": self._transfer,
+        }
+
+    def run(self, lines: Iterable[str]) -> None:
+        # (line number, arguments or error, keys being derived for a register)
+        pending: Deque[Tuple[int, List[str] | Exception, Future | None]] = deque()
+        for number, line in enumerate(lines, 1):
+            try:
+                if _SPECIAL.isdisjoint(line):
+                    args: List[str] | Exception = line.split()
+                else:
+                    args = shlex.split(line, comments=True)
+            except ValueError as e:
+                args = e
+            if not args:
+                continue
+
+            keys = None
+            if isinstance(args, list) and args[0] == "register" and len(args) == 5:
+                keys = self.bank.pool.submit(derive_secrets, args[3], args[4])
+            pending.append((number, args, keys))
+            if len(pending) > LOOKAHEAD:
+                self._apply(*pending.popleft())
+        while pending:
+            self._apply(*pending.popleft())
+
+    def _apply(
+        self, number: int, args: List[str] | Exception, keys: Future | None
+    ) -> None:
+        try:
+            if isinstance(args, Exception):
+                raise RuntimeError(f"Cannot split line: {args}")
+            if args[0] == "register":
+                self._register(args[1:], keys)
+            else:
+                operation = self._operations.get(args[0])
+                if operation is None:
+                    raise RuntimeError(f"Unknown operation: {args[0]}")
+                operation(args[1:])
+            self.done += 1
+        except (RuntimeError, ValueError) as e:
+            self.failed += 1
+            # transfer failures say which transfer, and their cause says why
+            reason = f"{e}: {e.__cause__}" if e.__cause__ else str(e)
+            print(f"line {number}: {reason}", file=self.errors)
+
+    def _account(self, id: str) -> UserHoldableAccount:
+        """The current user's account with the ID or label `id`."""
+        acc = self.state.get_account(self.labels.get(id, id))
+        if acc is None:
+            raise RuntimeError(f"Invalid account ID: {id}")
+        return acc
+
+    def _register(self, args: List[str], keys: Future | None) -> None:
+        _usage(args, "register NAME USERNAME PASSWORD PIN", 4)
+        name, username, password, pin = args
+        _name(name, "name")
+        _name(username, "username")
+        secrets = keys.result() if keys is not None else None
+        self.state._set_user(self.bank.register(name, username, password, pin, secrets))
+
+    def _login(self, args: List[str]) -> None:
+        _usage(args, "login USERNAME PASSWORD", 2)
+        if self.state.login(*args) is None:
+            raise RuntimeError("Invalid username or password.")
+
+    def _user(self, args: List[str]) -> None:
+        _usage(args, "user USERNAME", 1)
+        user = self.bank.accounts.get(args[0])
+        if user is None:
+            raise RuntimeError(f"No such user: {args[0]}")
+        self.state._set_user(user)
+
+    def _logout(self, args: List[str]) -> None:
+        _usage(args, "logout", 0)
+        self.state.logout()
+
+    def _open(self, args: List[str]) -> None:
+        label = args.pop() if args and args[-1].startswith("@") else None
+        _usage(args, "open checking|savings [NAME] [OVERDRAFT_SOURCE] [@LABEL]", 1, 2)
+        source = self._account(args[2]) if len(args) == 3 else None
+        acc = self.state.open_account(
+            args[0], args[1] if len(args) > 1 else None, source
+        )
+        if label is not None:
+            self.labels[label] = acc.id
+
+    def _close(self, args: List[str]) -> None:
+        _usage(args, "close ACCOUNT", 1)
+        self.state.close_account(self._account(args[0]).id)
+
+    def _rename(self, args: List[str]) -> None:
+        _usage(args, "rename ACCOUNT NAME", 2)
+        self._account(args[0]).name = _name(args[1], "name")
+
+    def _deposit(self, args: List[str]) -> None:
+        _usage(args, "deposit ACCOUNT AMOUNT [DESCRIPTION]", 2, 1)
+        self._account(args[0]).deposit(parse_amount(args[1]), *args[2:])
+
+    def _withdraw(self, args: List[str]) -> None:
+        _usage(args, "withdraw ACCOUNT AMOUNT [DESCRIPTION]", 2, 1)
+        self._account(args[0]).withdraw(parse_amount(args[1]), *args[2:])
+
+    def _transfer(self, args: List[str]) -> None:
+        _usage(args, "transfer SOURCE DEST AMOUNT", 3)
+        source = self._account(args[0])
+        dest = self.state.find_account(self.labels.get(args[1], args[1]))
+        if dest is None:
+            raise RuntimeError(f"Invalid destination account ID: {args[1]}")
+        source.transfer(dest, parse_amount(args[2]))
@@ -0,0 +1,1102 @@
+"""
+Benchmarks for the bank core.
+
+cd to root of project and run `python -m apcsp.labs.bank.bench <benchmark>`,
+or `python -m apcsp.labs.bank.bench --help` for the list of benchmarks.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import tracemalloc
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from statistics import quantiles
+from time import perf_counter, time_ns
+from typing import Callable, Dict, List, Tuple
+
+from . import account, metrics, util
+from .account import HISTORY_PAGE_SIZE, format_name
+from .account_types import (
+    MAX_OVERDRAFT_DEPTH,
+    OVERDRAFT_FEE,
+    CheckingAccount,
+    SavingsAccount,
+    UserAccount,
+)
+from .bank import Bank, BankState
+from .batch import Batch
+from .coldstore import ColdSegment, archive
+from .export import FORMATS, export
+from .interest import accrue_interest
+from .journal import Journal
+from .leases import IdLeases
+from .ledger import Ledger, Transaction, descriptions
+from .rules import RulesEngine
+from .search import SearchIndex, words
+from .server import BankServer, Client
+from .sharding import ShardedBank, ShardedBankState
+from .workload import DEFAULT_MIX, Workload, parse_mix, summarize
+
+
+def timeit(fn: Callable[[], object], n: int) -> float:
+    """Returns the average time of n calls to fn, in seconds."""
+    start = perf_counter()
+    for _ in range(n):
+        fn()
+    return (perf_counter() - start) / n
+
+
+def report(rows: List[List[str]]) -> None:
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def populate(bank: Bank, users: int, accounts: int) -> List[UserAccount]:
+    """Registers `users` users and spreads `accounts` checking accounts over them."""
+    registered = [
+        bank.register(f"User {i}", f"user{i}", "password", "1234") for i in range(users)
+    ]
+    for i in range(accounts):
+        CheckingAccount(registered[i % users])
+    return registered
+
+
+def bench_transfer(args) -> None:
+    rows = [["accounts", "us/transfer"]]
+    for size in args.sizes:
+        bank = Bank()
+        populate(bank, args.users, size)
+        ids = list(bank._index)
+
+        # the logged in user only holds the source account so the benchmark
+        # measures finding the destination, not the source
+        state = BankState(bank)
+        state.register("Sender", "sender", "password", "1234")
+        source = state.open_account("checking", None)
+        source.deposit(args.transfers)
+
+        rng = random.Random(0)
+        dests = [rng.choice(ids) for _ in range(args.transfers)]
+        it = iter(dests)
+
+        def transfer() -> None:
+            dest = state.find_account(next(it))
+            assert dest is not None
+            source.transfer(dest, 1)
+
+        rows.append([f"{size:,}", f"{timeit(transfer, args.transfers) * 1e6:.2f}"])
+        print(f"{size:,} accounts done")
+
+    report(rows)
+
+
+def bench_login(args) -> None:
+    rows = [["workers", "logins/s"]]
+    for workers in args.workers:
+        bank = Bank(workers)
+        populate(bank, args.users, 0)
+        names = [f"user{i % args.users}" for i in range(args.logins)]
+
+        start = perf_counter()
+        futures = [bank.submit_login(name, "password") for name in names]
+        assert all(f.result() is not None for f in futures)
+        elapsed = perf_counter() - start
+        bank.close()
+
+        rows.append([str(workers), f"{args.logins / elapsed:.1f}"])
+
+    report(rows)
+
+
+def write_journal(path: str, events: int, users: int, accounts: int) -> None:
+    """Writes a journal of `events` entries without going through a bank."""
+    rng = random.Random(0)
+    seq = 0
+    with open(path, "w") as f:
+
+        def write(entry: Dict) -> None:
+            nonlocal seq
+            seq += 1
+            entry["seq"] = seq
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+        for i in range(users):
+            write(
+                {
+                    "op": "register",
+                    "id": f"u{i}",
+                    "name": f"User {i}",
+                    "username": f"user{i}",
+                    "salt": "00" * 32,
+                    "password": "00" * 32,
+                    "pin": "00" * 32,
+                }
+            )
+        for i in range(accounts):
+            write(
+                {
+                    "op": "open",
+                    "id": f"c{i}",
+                    "type": "checking",
+                    "name": "Checking Account",
+                    "owner": f"user{i % users}",
+                }
+            )
+        for _ in range(events - seq):
+            write(
+                {
+                    "op": "post",
+                    "id": f"c{rng.randrange(accounts)}",
+                    "amount": rng.randrange(1, 100_00),
+                    "desc": "Deposit",
+                }
+            )
+
+
+def bench_recovery(args) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        journal = Journal(directory, snapshot_every=0)
+        write_journal(journal.journal_path, args.events, args.users, args.accounts)
+        size = os.path.getsize(journal.journal_path)
+        print(f"journal: {args.events:,} entries, {size / 1e6:,.1f} MB")
+
+        bank = Bank()
+        start = perf_counter()
+        replayed = journal.attach(bank)
+        replay_time = perf_counter() - start
+        print(f"replay: {replay_time:.2f}s ({replayed / replay_time:,.0f} entries/s)")
+
+        start = perf_counter()
+        journal.snapshot()
+        print(f"snapshot: {perf_counter() - start:.2f}s")
+        journal.close()
+
+        start = perf_counter()
+        Journal(directory).attach(Bank())
+        print(f"snapshot load: {perf_counter() - start:.2f}s")
+
+
+def measure(build: Callable[[], object]) -> int:
+    """Returns the bytes allocated (and still held) by build()."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def bench_ledger(args) -> None:
+    rng = random.Random(0)
+    # a realistic mix: plain deposits and transfers to a few other accounts
+    postings = [
+        (rng.randrange(1, 100_00), rng.randrange(-args.counterparties, 1))
+        for _ in range(args.postings)
+    ]
+
+    def describe(dest: int) -> str:
+        # builds a fresh string each time, like transfer_msg does
+        return f"Transfer to c{-dest}" if dest else "Deposit"
+
+    def objects() -> List[Transaction]:
+        # what BalanceAccount used to keep: one object per posting
+        return [Transaction(amount, describe(dest)) for amount, dest in postings]
+
+    def ledger() -> Ledger:
+        ledger = Ledger()
+        for amount, dest in postings:
+            ledger.append(amount, describe(dest))
+        return ledger
+
+    rows = [["storage", "bytes/posting"]]
+    for name, build in (("objects", objects), ("ledger", ledger)):
+        rows.append([name, f"{measure(build) / args.postings:.1f}"])
+    report(rows)
+
+
+def bench_batch(args) -> None:
+    bank = Bank()
+    populate(bank, args.users, args.accounts)
+    ids = list(bank._index)
+    for acc in bank._index.values():
+        acc.deposit(1_000_000_00)
+
+    rng = random.Random(0)
+    legs: List[Tuple[str, str, int]] = []
+    while len(legs) < args.legs:
+        source, dest = rng.choice(ids), rng.choice(ids)
+        if source != dest:
+            legs.append((source, dest, rng.randrange(1, 100_00)))
+
+    start = perf_counter()
+    for source, dest, amount in legs:
+        bank._index[source].transfer(bank._index[dest], amount)
+    loop = perf_counter() - start
+
+    start = perf_counter()
+    bank.transfer_batch(legs)
+    batch = perf_counter() - start
+
+    report(
+        [
+            ["method", "legs/s"],
+            ["transfer loop", f"{args.legs / loop:,.0f}"],
+            ["transfer_batch", f"{args.legs / batch:,.0f}"],
+        ]
+    )
+
+
+def bench_interest(args) -> None:
+    bank = Bank()
+    users = populate(bank, args.users, 0)
+    rng = random.Random(0)
+    accounts = [SavingsAccount(users[i % args.users]) for i in range(args.accounts)]
+    for acc in accounts:
+        acc._post(rng.randrange(1, 1_000_000_00), "Deposit")
+
+    start = perf_counter()
+    preview = accrue_interest(bank, args.rate, dry_run=True)
+    dry_run = perf_counter() - start
+
+    start = perf_counter()
+    accrue_interest(bank, args.rate)
+    posted = perf_counter() - start
+
+    sample = accounts[: min(1000, len(accounts))]
+    start = perf_counter()
+    for acc in sample:
+        acc.add_interest(args.rate)
+    loop = (perf_counter() - start) / len(sample) * len(accounts)
+
+    print(preview.str(limit=3))
+    report(
+        [
+            ["method", "seconds"],
+            ["dry run", f"{dry_run:.3f}"],
+            ["accrue_interest", f"{posted:.3f}"],
+            ["add_interest loop (est.)", f"{loop:.3f}"],
+        ]
+    )
+
+
+def bench_stress(args) -> None:
+    # switch threads as often as possible to shake out races
+    sys.setswitchinterval(1e-6)
+
+    bank = Bank()
+    users = populate(bank, args.users, 0)
+    accounts = []
+    for i in range(args.accounts):
+        owner = users[i % args.users]
+        savings = SavingsAccount(owner)
+        savings.deposit(args.balance)
+        # every other checking account overdraws from a savings account
+        checking = CheckingAccount(owner, None, savings if i % 2 else None)
+        checking.deposit(args.balance)
+        accounts += [savings, checking]
+    initial = sum(acc.balance for acc in accounts)
+
+    ids: List[str] = []
+    errors: List[BaseException] = []
+
+    def worker(seed: int) -> None:
+        rng = random.Random(seed)
+        try:
+            for _ in range(args.transfers):
+                source, dest = rng.sample(accounts, 2)
+                try:
+                    if rng.random() < 0.1:
+                        bank.transfer_batch(
+                            [(source.id, dest.id, rng.randrange(1, args.balance // 10))]
+                        )
+                    else:
+                        source.transfer(dest, rng.randrange(1, args.balance // 10))
+                except ValueError:
+                    pass
+                # open accounts concurrently too, to check IDs stay unique
+                if rng.random() < 0.01:
+                    ids.append(CheckingAccount(users[seed % args.users]).id)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    assert not errors, errors
+    fees = sum(
+        sum(map(descriptions.is_fee, acc._transactions.columns()[2]))
+        for acc in accounts
+    )
+    final = sum(acc.balance for acc in accounts)
+    for acc in accounts:
+        assert acc.balance == sum(t.amount for t in acc.transactions), acc.id
+    assert final == initial - fees * OVERDRAFT_FEE, (initial, final, fees)
+    assert len(set(ids)) == len(ids), "duplicate account IDs"
+    assert bank.aggregates.overdraft_fees == fees * OVERDRAFT_FEE
+    assert bank.aggregates.total == sum(acc.balance for acc in bank._index.values())
+
+    print(
+        f"{args.threads} threads x {args.transfers:,} transfers in {elapsed:.2f}s:"
+        f" money conserved ({fees:,} overdraft fees), {len(ids)} unique new IDs"
+    )
+
+
+def bench_asof(args) -> None:
+    rng = random.Random(0)
+    ledger = Ledger()
+    for i in range(args.postings):
+        # one posting a second, in nanoseconds
+        ledger.append(rng.randrange(-100_00, 100_00), "Posting", i * 1_000_000_000)
+    end = args.postings * 1_000_000_000
+    times = [rng.randrange(0, end) for _ in range(args.queries)]
+
+    def replay(t: int) -> int:
+        # what callers had to do before: sum the history up to t
+        return sum(tr.amount for tr in ledger if tr.timestamp <= t)
+
+    replayed = timeit(lambda: replay(times[0]), max(1, args.queries // 100))
+    indexed = timeit(lambda: [ledger.balance_at(t) for t in times], 1) / args.queries
+    assert replay(times[0]) == ledger.balance_at(times[0])
+    report(
+        [
+            ["method", "us/query"],
+            ["replay", f"{replayed * 1e6:,.1f}"],
+            ["balance_at", f"{indexed * 1e6:,.2f}"],
+        ]
+    )
+
+
+def bench_shards(args) -> None:
+    rows = [["shards", "logins/s", "transfers/s", "cross-shard"]]
+    for shards in range(1, args.shards + 1):
+        bank = ShardedBank(shards)
+        try:
+            # enough client threads to keep every shard busy
+            pool = ThreadPoolExecutor(args.threads)
+            usernames = [f"user{i}" for i in range(args.users)]
+            users = list(
+                pool.map(lambda u: bank.register(u, u, "password", "1234"), usernames)
+            )
+            accounts = []
+            for user in users:
+                state = ShardedBankState(bank)
+                state.user = user
+                acc = state.open_account("savings", None)
+                acc.deposit(1_000_000_00)
+                accounts.append(acc.id)
+
+            rng = random.Random(0)
+            logins = [rng.choice(usernames) for _ in range(args.logins)]
+            start = perf_counter()
+            assert all(pool.map(lambda u: bank.login(u, "password"), logins))
+            login_rate = args.logins / (perf_counter() - start)
+
+            pairs = [rng.sample(accounts, 2) for _ in range(args.transfers)]
+            cross = sum(
+                bank.shard_of_account(a) != bank.shard_of_account(b) for a, b in pairs
+            )
+            start = perf_counter()
+            list(pool.map(lambda pair: bank.transfer(pair[0], pair[1], 1_00), pairs))
+            transfer_rate = args.transfers / (perf_counter() - start)
+            pool.shutdown()
+        finally:
+            bank.close()
+
+        rows.append(
+            [
+                str(shards),
+                f"{login_rate:,.0f}",
+                f"{transfer_rate:,.0f}",
+                f"{cross / args.transfers:.0%}",
+            ]
+        )
+    report(rows)
+
+
+def bench_overdraft(args) -> None:
+    bank = Bank()
+    (user,) = populate(bank, 1, 0)
+    source: SavingsAccount | CheckingAccount = SavingsAccount(user)
+    source.deposit(100_00)
+    rows = [["chain length", "us/refused withdrawal"]]
+    for length in range(2, MAX_OVERDRAFT_DEPTH + 1):
+        source = CheckingAccount(user, None, source)
+        account = source
+
+        def refused() -> None:
+            # more than the whole chain holds, so it is refused
+            try:
+                account.withdraw(1_000_000_00)
+            except ValueError:
+                pass
+
+        rows.append([str(length), f"{timeit(refused, args.withdrawals) * 1e6:.2f}"])
+    report(rows)
+
+
+def bench_memory(args) -> None:
+    def build() -> Bank:
+        bank = Bank()
+        for i in range(args.users):
+            # restored from made-up digests, to skip key derivation
+            user = UserAccount.restore(
+                f"User {i}",
+                f"user{i}",
+                f"u{i}",
+                os.urandom(32),
+                os.urandom(32),
+                os.urandom(32),
+            )
+            savings = None
+            for j in range(args.accounts):
+                if j % 2:
+                    CheckingAccount(user, None, savings)
+                else:
+                    savings = SavingsAccount(user)
+            bank._attach(user)
+        return bank
+
+    total = measure(build)
+    accounts = args.users * args.accounts
+    report(
+        [
+            ["users", "accounts", "MB", "bytes/account"],
+            [
+                f"{args.users:,}",
+                f"{accounts:,}",
+                f"{total / 1e6:,.1f}",
+                # users and the bank's indexes are shared out over their accounts
+                f"{total / accounts:,.0f}",
+            ],
+        ]
+    )
+
+
+def bench_search(args) -> None:
+    bank = Bank()
+    index = SearchIndex()
+    index.attach(bank)
+    populate(bank, args.users, args.accounts)
+    accounts = list(bank._index.values())
+    rng = random.Random(0)
+    memos = ["groceries", "rent", "paycheck", "coffee", "refund", "gift"]
+    for _ in range(args.postings):
+        source, dest = rng.sample(accounts, 2)
+        if rng.random() < 0.5:
+            source.deposit(rng.randrange(1, 100_00), rng.choice(memos))
+        else:
+            source._post(-1, f"Transfer to {format_name(dest, source)}")
+
+    user = accounts[0]._owner
+    queries = ["groceries", "gro*", "owned by user 1", "transfer to c1"]
+
+    def scan(query: str) -> List[Transaction]:
+        # what finding a posting took before: read every description
+        wanted = words(query)
+        return [
+            t
+            for acc in accounts
+            for t in acc.transactions
+            if all(w in words(t.description) for w in wanted)
+        ][:HISTORY_PAGE_SIZE]
+
+    rows = [["query", "scan ms", "index ms", "index ms (one user)"]]
+    for query in queries:
+        scanned = timeit(lambda: scan(query), 1)
+        indexed = timeit(lambda: index.search(query), args.repeat)
+        scoped = timeit(lambda: index.search(query, user), args.repeat)
+        rows.append(
+            [
+                query,
+                f"{scanned * 1e3:,.1f}",
+                f"{indexed * 1e3:.3f}",
+                f"{scoped * 1e3:.3f}",
+            ]
+        )
+    report(rows)
+
+
+def bench_cold(args) -> None:
+    bank = Bank()
+    populate(bank, args.users, args.accounts)
+    accounts = list(bank._index.values())
+    rng = random.Random(0)
+    # spread the postings evenly over the last year
+    now = time_ns()
+    year = 365 * 24 * 60 * 60 * 1_000_000_000
+    for i in range(args.postings):
+        timestamp = now - year + year * i // args.postings
+        rng.choice(accounts)._transactions.append(
+            rng.randrange(-100_00, 100_00), "Posting", timestamp
+        )
+
+    def resident() -> int:
+        return sum(acc._transactions.nbytes() for acc in accounts)
+
+    def read() -> Dict[str, float]:
+        return {
+            "newest page": timeit(lambda: [acc.history_page() for acc in accounts], 1),
+            "full history": timeit(
+                lambda: [list(acc.transactions) for acc in accounts], 1
+            ),
+        }
+
+    hot_bytes, hot_times = resident(), read()
+    with tempfile.TemporaryDirectory() as tmp:
+        segment = ColdSegment(os.path.join(tmp, "cold.seg"))
+        start = perf_counter()
+        moved = archive(bank, segment, args.days * 24 * 60 * 60)
+        took = perf_counter() - start
+        cold_bytes, cold_times = resident(), read()
+        segment.close()
+
+    print(f"archived {moved:,} postings in {took * 1e3:,.0f} ms")
+    rows = [["", "resident MB"] + [f"{name} ms" for name in hot_times]]
+    for name, size, times in (
+        ("all hot", hot_bytes, hot_times),
+        (f"cold after {args.days} days", cold_bytes, cold_times),
+    ):
+        rows.append(
+            [name, f"{size / 1e6:,.1f}"] + [f"{t * 1e3:,.1f}" for t in times.values()]
+        )
+    report(rows)
+
+
+def _api_server(conn, directory: str | None) -> None:
+    # runs in its own process, so the clients don't compete with it for the GIL
+    async def run() -> None:
+        bank = Bank()
+        if directory is not None:
+            Journal(directory).attach(bank)
+        server = await BankServer(bank).start("127.0.0.1", 0)
+        conn.send(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+async def _api_load(port: int, args) -> Dict[str, List[float]]:
+    latencies: Dict[str, List[float]] = {}
+    rng = random.Random(0)
+
+    async def timed(client: Client, name: str, method: str, path: str, body=None):
+        start = perf_counter()
+        response = await client.call(method, path, body)
+        latencies.setdefault(name, []).append(perf_counter() - start)
+        return response
+
+    async def setup(i: int, client: Client) -> str:
+        await timed(
+            client,
+            "register",
+            "POST",
+            "/register",
+            {
+                "name": f"User {i}",
+                "username": f"user{i}",
+                "password": "pw",
+                "pin": "1234",
+            },
+        )
+        acc = await timed(client, "open", "POST", "/open", {"type": "checking"})
+        await timed(
+            client,
+            "deposit",
+            "POST",
+            "/deposit",
+            {"account": acc["id"], "amount": 1000_00, "pin": "1234"},
+        )
+        return acc["id"]
+
+    async def run(client: Client, own: str) -> None:
+        for _ in range(args.requests):
+            pick = rng.random()
+            if pick < 0.6:
+                dest = rng.choice(ids)
+                if dest != own:
+                    await timed(
+                        client,
+                        "transfer",
+                        "POST",
+                        "/transfer",
+                        {"source": own, "dest": dest, "amount": 1, "pin": "1234"},
+                    )
+            elif pick < 0.8:
+                await timed(client, "history", "GET", f"/history?account={own}")
+            else:
+                await timed(client, "accounts", "GET", "/accounts")
+
+    async def login(i: int, client: Client) -> None:
+        await timed(
+            client,
+            "login",
+            "POST",
+            "/login",
+            {"username": f"user{i}", "password": "pw"},
+        )
+
+    clients = [Client("127.0.0.1", port) for _ in range(args.clients)]
+    ids = await asyncio.gather(*(setup(i, c) for i, c in enumerate(clients)))
+    start = perf_counter()
+    await asyncio.gather(*(run(c, own) for c, own in zip(clients, ids)))
+    took = perf_counter() - start
+    await asyncio.gather(*(login(i, c) for i, c in enumerate(clients)))
+    for client in clients:
+        await client.close()
+
+    done = sum(
+        len(latencies.get(name, ())) for name in ("transfer", "history", "accounts")
+    )
+    print(
+        f"{args.clients} clients x {args.requests:,} requests in {took:.2f}s:"
+        f" {done / took:,.0f} requests/s"
+    )
+    return latencies
+
+
+def bench_api(args) -> None:
+    context = multiprocessing.get_context("spawn")
+    conn, child = context.Pipe()
+    with tempfile.TemporaryDirectory() as tmp:
+        server = context.Process(
+            target=_api_server,
+            args=(child, tmp if args.journal else None),
+            daemon=True,
+        )
+        server.start()
+        try:
+            latencies = asyncio.run(_api_load(conn.recv(), args))
+        finally:
+            server.terminate()
+            server.join()
+
+    rows = [["request", "count", "p50 ms", "p99 ms"]]
+    for name, times in latencies.items():
+        cuts = quantiles(times, n=100) if len(times) > 1 else times * 99
+        rows.append(
+            [name, f"{len(times):,}", f"{cuts[49] * 1e3:.2f}", f"{cuts[98] * 1e3:.2f}"]
+        )
+    report(rows)
+
+
+def bench_workload(args) -> None:
+    workload = Workload(
+        args.users,
+        args.accounts,
+        args.operations,
+        parse_mix(args.mix) if args.mix else DEFAULT_MIX,
+        args.skew,
+        args.seed,
+    )
+    took, latencies, failures = workload.run()
+    peaks = workload.peaks() if args.memory else {}
+    summary = summarize(latencies, failures, peaks)
+    print(
+        f"{args.operations:,} operations on {args.users:,} users and"
+        f" {args.accounts:,} accounts in {took:.2f}s:"
+        f" {args.operations / took:,.0f} operations/s"
+    )
+
+    baseline: Dict[str, Dict[str, float]] = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    header = ["operation", "count", "failed", "ops/s", "p50 us", "p99 us"]
+    if args.memory:
+        header.append("peak KiB")
+    if baseline:
+        header.append("ops/s vs baseline")
+    rows = [header]
+    for name, stats in summary.items():
+        row = [
+            name,
+            f"{stats['count']:,}",
+            f"{stats['failed']:,}",
+            f"{stats['per_second']:,.0f}",
+            f"{stats['p50'] * 1e6:,.1f}",
+            f"{stats['p99'] * 1e6:,.1f}",
+        ]
+        if args.memory:
+            row.append(f"{stats['peak'] / 1024:,.1f}")
+        if baseline:
+            before = baseline.get(name)
+            change = stats["per_second"] / before["per_second"] - 1 if before else None
+            row.append("-" if change is None else f"{change:+.0%}")
+        rows.append(row)
+    report(rows)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+def bench_metrics(args) -> None:
+    bank = Bank()
+    populate(bank, 2, 2)
+    source, dest = bank._index.values()
+    source.deposit(args.calls * 2)
+
+    def transfers() -> None:
+        for _ in range(args.calls):
+            source.transfer(dest, 1)
+
+    def format_names() -> None:
+        # looked up each time, as callers in the package do
+        for _ in range(args.calls):
+            account.format_name(source, dest)
+
+    rows = [["operation", "timing off us", "timing on us"]]
+    for name, run in (("format_name", format_names), ("transfer", transfers)):
+        off = timeit(run, 1) / args.calls
+        recorded = metrics.enable()
+        on = timeit(run, 1) / args.calls
+        metrics.disable()
+        assert recorded.histograms, "Nothing was timed"
+        rows.append([name, f"{off * 1e6:.3f}", f"{on * 1e6:.3f}"])
+    report(rows)
+
+
+def bench_script(args) -> None:
+    rng = random.Random(0)
+    # a migration: every user and their accounts, then their history
+    setup: List[str] = []
+    for i in range(args.users):
+        setup.append(f"register 'User {i}' user{i} password 1234")
+        setup.append(f"open savings 'Savings {i}' @s{i}")
+        setup.append(f"open checking 'Checking {i}' @s{i} @c{i}")
+    history: List[str] = []
+    for _ in range(args.postings):
+        i = rng.randrange(args.users)
+        pick = rng.random()
+        history.append(f"user user{i}")
+        if pick < 0.5:
+            history.append(f"deposit @s{i} {rng.randrange(1, 10000)}.00 Payroll")
+        elif pick < 0.8:
+            history.append(
+                f"withdraw @s{i} {rng.randrange(1, 100)}.{rng.randrange(100):02}"
+            )
+        else:
+            history.append(f"transfer @s{i} @c{rng.randrange(args.users)} 1.00")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bank = Bank()
+        journal = None
+        if args.journal:
+            journal = Journal(tmp, sync=False)
+            journal.attach(bank)
+        batch = Batch(bank, open(os.devnull, "w"))
+        rows = [["lines", "count", "s", "lines/s"]]
+        for name, lines in (("setup", setup), ("history", history)):
+            start = perf_counter()
+            batch.run(lines)
+            took = perf_counter() - start
+            rows.append(
+                [name, f"{len(lines):,}", f"{took:.2f}", f"{len(lines) / took:,.0f}"]
+            )
+        if journal is not None:
+            start = perf_counter()
+            journal.close()
+            rows.append(["journal flush", "", f"{perf_counter() - start:.2f}", ""])
+        bank.close()
+    report(rows)
+    print(f"{batch.failed:,} lines failed")
+
+
+def bench_ids(args) -> None:
+    rows = [["allocator", "leases", "ns/ID"]]
+    with tempfile.TemporaryDirectory() as tmp:
+        for block in [None] + args.blocks:
+            leases = None
+            if block is not None:
+                leases = IdLeases(os.path.join(tmp, f"ids-{block}.json"), block)
+            util.set_id_leases(leases)
+            # a namespace of its own, so every run starts from 0
+            namespace = f"bench{block}"
+            took = timeit(lambda: util.create_id(namespace), args.ids)
+            util.set_id_leases(None)
+            rows.append(
+                [
+                    "counter" if leases is None else f"leased, block {block:,}",
+                    "" if leases is None else f"{leases.leases:,}",
+                    f"{took * 1e9:,.0f}",
+                ]
+            )
+    report(rows)
+
+
+def bench_export(args) -> None:
+    bank = Bank()
+    populate(bank, args.users, args.accounts)
+    accounts = list(bank._index.values())
+    rng = random.Random(0)
+    memos = ["Deposit", "Withdrawal", "Payroll", "Groceries", "Rent"]
+    # spread the postings evenly over the last month
+    now = time_ns()
+    month = 30 * 24 * 60 * 60 * 1_000_000_000
+    for i in range(args.postings):
+        rng.choice(accounts)._transactions.append(
+            rng.randrange(-100_00, 100_00),
+            rng.choice(memos),
+            now - month + month * i // args.postings,
+        )
+
+    rows = [["format", "postings", "s", "postings/s", "MB", "peak MB"]]
+    with tempfile.TemporaryDirectory() as tmp:
+        for format in FORMATS:
+            path = os.path.join(tmp, f"statement.{format}")
+            start = perf_counter()
+            written = export(bank, path, format)
+            took = perf_counter() - start
+            # again, since tracing slows allocations down a lot
+            tracemalloc.start()
+            export(bank, path, format)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            rows.append(
+                [
+                    format,
+                    f"{written:,}",
+                    f"{took:.2f}",
+                    f"{written / took:,.0f}",
+                    f"{os.path.getsize(path) / 1e6:,.1f}",
+                    f"{peak / 1e6:,.1f}",
+                ]
+            )
+    report(rows)
+
+
+def bench_rules(args) -> None:
+    bank = Bank()
+    populate(bank, args.users, args.accounts)
+    accounts = list(bank._index.values())
+    for acc in accounts:
+        acc.deposit(args.rounds * args.operations * 100_00)
+    rules = RulesEngine()
+    rng = random.Random(0)
+    # half deposits, half transfers; a transfer posts twice
+    picks = [
+        (rng.random() < 0.5, rng.choice(accounts), rng.choice(accounts))
+        for _ in range(args.operations)
+    ]
+    postings = sum(
+        1 if deposit or source is dest else 2 for deposit, source, dest in picks
+    )
+
+    def run() -> float:
+        start = perf_counter()
+        for deposit, source, dest in picks:
+            if deposit:
+                source.deposit(100)
+            elif source is not dest:
+                source.transfer(dest, 100)
+        return postings / (perf_counter() - start)
+
+    # the same bank with rules off and on in turns, best of each, as throughput
+    # here is noisy
+    off = on = 0.0
+    for _ in range(args.rounds):
+        off = max(off, run())
+        rules.attach(bank)
+        on = max(on, run())
+        bank.listeners.remove(rules)
+    bank.close()
+
+    rows = [["rules", "postings/s"], ["off", f"{off:,.0f}"], ["on", f"{on:,.0f}"]]
+    report(rows)
+    print(
+        f"{rules.raised:,} alerts; rules cost {(off / on - 1) * 100:.1f}%"
+        " of posting throughput"
+    )
+
+
+BENCHMARKS: Dict[str, Callable] = {
+    "transfer": bench_transfer,
+    "login": bench_login,
+    "recovery": bench_recovery,
+    "ledger": bench_ledger,
+    "batch": bench_batch,
+    "interest": bench_interest,
+    "stress": bench_stress,
+    "asof": bench_asof,
+    "shards": bench_shards,
+    "overdraft": bench_overdraft,
+    "memory": bench_memory,
+    "search": bench_search,
+    "cold": bench_cold,
+    "api": bench_api,
+    "workload": bench_workload,
+    "metrics": bench_metrics,
+    "script": bench_script,
+    "ids": bench_ids,
+    "export": bench_export,
+    "rules": bench_rules,
+}
+
+
+def main() -> None:
+    parser = ArgumentParser(prog="python -m apcsp.labs.bank.bench")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("transfer", help="transfer latency vs. total account count")
+    p.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000, 1_000_000],
+        help="total account counts to measure",
+    )
+    p.add_argument(
+        "--users", type=int, default=10, help="users to spread accounts over"
+    )
+    p.add_argument("--transfers", type=int, default=10_000)
+
+    p = sub.add_parser("login", help="login verification throughput vs. workers")
+    p.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({1, 4, os.cpu_count() or 1}),
+        help="worker thread counts to measure",
+    )
+    p.add_argument("--users", type=int, default=8)
+    p.add_argument("--logins", type=int, default=200)
+
+    p = sub.add_parser("recovery", help="journal replay and snapshot load time")
+    p.add_argument("--events", type=int, default=10_000_000)
+    p.add_argument("--users", type=int, default=1_000)
+    p.add_argument("--accounts", type=int, default=10_000)
+
+    p = sub.add_parser("ledger", help="memory used per posting")
+    p.add_argument("--postings", type=int, default=1_000_000)
+    p.add_argument(
+        "--counterparties", type=int, default=100, help="distinct transfer targets"
+    )
+
+    p = sub.add_parser("batch", help="batch transfers vs. one transfer at a time")
+    p.add_argument("--legs", type=int, default=100_000)
+    p.add_argument("--users", type=int, default=10)
+    p.add_argument("--accounts", type=int, default=1_000)
+
+    p = sub.add_parser("interest", help="bank-wide interest accrual")
+    p.add_argument("--accounts", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=10)
+    p.add_argument("--rate", type=int, default=1250, help="rate, as for add_interest")
+
+    p = sub.add_parser("stress", help="concurrent transfers; checks money is conserved")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--transfers", type=int, default=10_000, help="per thread")
+    p.add_argument("--users", type=int, default=4)
+    p.add_argument("--accounts", type=int, default=20)
+    p.add_argument("--balance", type=int, default=1000_00)
+
+    p = sub.add_parser("asof", help="balance-as-of queries: replay vs. index")
+    p.add_argument("--postings", type=int, default=1_000_000)
+    p.add_argument("--queries", type=int, default=10_000)
+
+    p = sub.add_parser("shards", help="sharded bank throughput vs. shard count")
+    p.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--threads", type=int, default=32, help="client threads")
+    p.add_argument("--users", type=int, default=64)
+    p.add_argument("--logins", type=int, default=256)
+    p.add_argument("--transfers", type=int, default=20_000)
+
+    p = sub.add_parser("overdraft", help="withdrawals vs. overdraft chain length")
+    p.add_argument("--withdrawals", type=int, default=10_000)
+
+    p = sub.add_parser("memory", help="memory used per account")
+    p.add_argument("--users", type=int, default=100_000)
+    p.add_argument("--accounts", type=int, default=4, help="per user")
+
+    p = sub.add_parser("search", help="description search: scan vs. index")
+    p.add_argument("--postings", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--accounts", type=int, default=1_000)
+    p.add_argument("--repeat", type=int, default=100)
+
+    p = sub.add_parser("cold", help="resident memory and reads with cold history")
+    p.add_argument("--postings", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--accounts", type=int, default=1_000)
+    p.add_argument("--days", type=int, default=30, help="keep this many days hot")
+
+    p = sub.add_parser("api", help="JSON API latency under load (p50/p99)")
+    p.add_argument("--clients", type=int, default=50, help="concurrent connections")
+    p.add_argument("--requests", type=int, default=200, help="per client")
+    p.add_argument(
+        "--journal", action="store_true", help="journal to disk, with fsyncs"
+    )
+
+    p = sub.add_parser("workload", help="Zipfian mix of bank operations")
+    p.add_argument("--users", type=int, default=10_000)
+    p.add_argument("--accounts", type=int, default=30_000)
+    p.add_argument("--operations", type=int, default=100_000)
+    p.add_argument(
+        "--mix",
+        help='operation weights, like "transfer=40,login=1" (default: %s)'
+        % ",".join(f"{name}={weight:g}" for name, weight in DEFAULT_MIX.items()),
+    )
+    p.add_argument(
+        "--skew", type=float, default=1.0, help="Zipf exponent for account choice"
+    )
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="skip the second run that measures peak memory",
+    )
+    p.add_argument("--save", metavar="FILE", help="save the results as JSON")
+    p.add_argument(
+        "--baseline", metavar="FILE", help="compare with results saved by --save"
+    )
+
+    p = sub.add_parser("metrics", help="cost of operation timing, off and on")
+    p.add_argument("--calls", type=int, default=200_000)
+
+    p = sub.add_parser("script", help="batch mode: lines of operations per second")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--postings", type=int, default=200_000)
+    p.add_argument("--journal", action="store_true", help="journal to disk too")
+
+    p = sub.add_parser("ids", help="ID creation: counter vs. leased blocks")
+    p.add_argument("--ids", type=int, default=100_000)
+    p.add_argument(
+        "--blocks",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100, 1_000],
+        help="lease block sizes to measure",
+    )
+
+    p = sub.add_parser("export", help="whole-bank statement export, CSV and binary")
+    p.add_argument("--postings", type=int, default=2_000_000)
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--accounts", type=int, default=1_000)
+
+    p = sub.add_parser("rules", help="posting throughput with rules off and on")
+    p.add_argument("--operations", type=int, default=50_000, help="per round")
+    p.add_argument("--users", type=int, default=10)
+    p.add_argument("--accounts", type=int, default=1_000)
+    p.add_argument("--rounds", type=int, default=10)
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
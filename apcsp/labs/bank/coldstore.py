@@ -0,0 +1,149 @@
+"""
+Cold storage for old postings.
+
+A segment is an append-only file of fixed-size posting records. Ledgers move
+their oldest postings into it (`Ledger.spill`) and read them back through a
+memory map, so old history costs disk rather than RAM and is only paged in when
+it is read. `Archiver` keeps moving postings as they age, in the background.
+
+Records refer to descriptions by their index in the interned description table
+of this process, so a segment only lives as long as the process that wrote it.
+The journal is still what makes the bank durable.
+"""
+
+import mmap
+import os
+import struct
+import threading
+from time import time_ns
+from typing import TYPE_CHECKING, Any, Iterator, Tuple
+
+if TYPE_CHECKING:
+    from .bank import Bank
+
+# amount, timestamp, balance after, description index
+RECORD = struct.Struct("<qqqI4x")
+
+# move postings older than this many seconds by default
+COLD_AFTER = 30 * 24 * 60 * 60
+# look for postings to move this often, in seconds
+ARCHIVE_EVERY = 60 * 60
+
+
+class ColdSegment(object):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # records written so far
+        self._records = 0
+        self._file = open(path, "w+b")
+        self._map: Any = None
+        # records covered by _map
+        self._mapped = 0
+        # guards the file, _records and _map
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._records
+
+    def close(self) -> None:
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.close()
+        os.remove(self.path)
+
+    def append(self, data: bytes) -> int:
+        """Writes packed records, returning the index of the first."""
+        assert len(data) % RECORD.size == 0, "Partial record"
+        with self._lock:
+            start = self._records
+            self._file.seek(start * RECORD.size)
+            self._file.write(data)
+            self._file.flush()
+            self._records += len(data) // RECORD.size
+            return start
+
+    def _view(self, end: int) -> Any:
+        # called with _lock held; maps the file again once it has outgrown the map
+        if end > self._mapped:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped = self._records
+        return self._map
+
+    def read(self, index: int) -> Tuple[int, int, int, int]:
+        with self._lock:
+            return RECORD.unpack_from(self._view(index + 1), index * RECORD.size)
+
+    def read_run(self, start: int, count: int) -> Iterator[Tuple[int, int, int, int]]:
+        with self._lock:
+            data = self._view(start + count)[
+                start * RECORD.size : (start + count) * RECORD.size
+            ]
+        return RECORD.iter_unpack(data)
+
+
+def archive(bank: "Bank", segment: ColdSegment, older_than: float = COLD_AFTER) -> int:
+    """
+    Moves every posting more than `older_than` seconds old to the segment.
+    Returns the number of postings moved.
+    """
+    before = time_ns() - int(older_than * 1e9)
+    moved = 0
+    with bank._lock:
+        accounts = list(bank._index.values())
+    for acc in accounts:
+        # the account lock keeps out postings, and the spill lock snapshots
+        with acc._lock, bank._spill_lock:
+            moved += acc._transactions.spill(segment, before)
+    return moved
+
+
+class Archiver(object):
+    """
+    Moves old postings of a bank to a cold segment in a background thread, once
+    at start and then every so often, so memory stays bounded while it runs.
+    """
+
+    def __init__(
+        self,
+        bank: "Bank",
+        path: str,
+        older_than: float = COLD_AFTER,
+        every: float = ARCHIVE_EVERY,
+    ) -> None:
+        """
+        path: the segment file, created afresh
+        older_than: age in seconds of the postings to move
+        every: seconds between runs
+        """
+        assert every > 0, "Interval must be positive"
+        self.bank = bank
+        self.segment = ColdSegment(path)
+        self.older_than = older_than
+        self.every = every
+        # postings moved so far
+        self.moved = 0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        assert self._thread is None, "Archiver already started"
+        self._thread = threading.Thread(
+            target=self._run, name="bank-archive", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.moved += archive(self.bank, self.segment, self.older_than)
+            self._stop.wait(self.every)
+
+    def close(self) -> None:
+        """Stops archiving and deletes the segment. Call after the bank is done."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.segment.close()
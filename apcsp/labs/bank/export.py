@@ -0,0 +1,473 @@
+"""
+Statement export.
+
+Streams the postings of an account, a user or the whole bank over a time range
+to a file, as CSV or as a compact binary format. Postings are read a chunk at a
+time with the account locked, so memory stays bounded however much history
+there is, and output goes through a large write buffer.
+
+CSV has a header row, then one row per posting: account ID, timestamp
+(nanoseconds since the epoch), amount and balance after (in cents), and
+description.
+
+The binary format is little-endian:
+
+    MAGIC
+    for each account: SECTION (length of the ID, posting count), the ID in
+        UTF-8, then one RECORD per posting: amount, timestamp, balance after,
+        description index
+    SECTION with length 0 and count 0
+    description count (u32), then each description: length (u32) and UTF-8
+
+Description indexes are into the statement's own table, which holds only the
+descriptions its postings use.
+
+Run with `python -m apcsp.labs.bank.export`. It reads the data directory as it
+writes rather than restoring the bank: postings come from the history file a
+chunk at a time, so memory only holds the accounts, the descriptions, and the
+postings journaled since the last snapshot.
+"""
+
+import csv
+import json
+import os
+import struct
+import sys
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+from itertools import accumulate, islice, repeat
+from typing import BinaryIO, Dict, Iterator, List, Sequence, TextIO, Tuple
+
+from .account import BalanceAccount
+from .account_types import UserAccount
+from .bank import Bank
+from .coldstore import RECORD
+from .journal import HISTORY_FILE, SNAPSHOT_FILE, journaled, read_run, scan_history
+from .ledger import Ledger, descriptions
+
+FORMATS = ("csv", "binary")
+MAGIC = b"BANKSTM1"
+SECTION = struct.Struct("<HQ")
+LENGTH = struct.Struct("<I")
+CSV_HEADER = ["account", "timestamp", "amount", "balance", "description"]
+
+# postings read from an account at a time
+CHUNK = 64 * 1024
+# bytes buffered before each write to the file
+BUFFER_SIZE = 1024 * 1024
+
+# account ID, timestamp, amount, balance after, description
+Posting = Tuple[str, int, int, int, str]
+
+
+class SavedAccount(object):
+    """
+    An account as saved in a data directory, read without restoring the bank:
+    runs of postings in the history file, then the ones journaled since, which
+    are kept in memory.
+    """
+
+    def __init__(
+        self, id: str, owner: str, history: BinaryIO | None, table: List[int]
+    ) -> None:
+        """
+        owner: username of the account's owner
+        history: the directory's history file, if it has one
+        table: the history's description table, as scan_history fills it
+        """
+        self.id = id
+        self.owner = owner
+        self._history = history
+        self._table = table
+        # offset and count of each of its runs in the history
+        self.runs: List[Tuple[int, int]] = []
+        self.journaled = Ledger()
+
+    def __len__(self) -> int:
+        return sum(count for _, count in self.runs) + len(self.journaled)
+
+    def post(
+        self, amount: int, description: str, timestamp: int | None, fee: bool
+    ) -> None:
+        """Adds a journaled posting, as replaying it would."""
+        if amount == 0:
+            return
+        if timestamp is not None and self.runs and not self.journaled:
+            # keep postings in order across the snapshot, as a restored ledger
+            # would
+            offset, count = self.runs[-1]
+            last = self._read(offset, count, count - 1, count)[1][0]
+            timestamp = max(timestamp, last)
+        self.journaled.append(amount, description, timestamp, fee)
+
+    def _read(
+        self, offset: int, count: int, start: int, end: int
+    ) -> Tuple[array, array, array]:
+        assert self._history is not None, "Runs without a history file"
+        return read_run(self._history, offset, count, self._table, start, end)
+
+    def _columns(self) -> Iterator[Tuple[array, array, array]]:
+        # amounts, timestamps and description indexes of every posting, about a
+        # chunk at a time
+        for offset, count in self.runs:
+            for i in range(0, count, CHUNK):
+                yield self._read(offset, count, i, min(i + CHUNK, count))
+        if self.journaled:
+            yield self.journaled.columns()
+
+    def index_at(self, timestamp: int) -> int:
+        """Returns how many postings were made before `timestamp`."""
+        index = 0
+        for _, timestamps, _ in self._columns():
+            if timestamps[-1] >= timestamp:
+                return index + bisect_left(timestamps, timestamp)
+            index += len(timestamps)
+        return index
+
+    def records(
+        self, start: int, end: int
+    ) -> Iterator[Tuple[array, array, array, array]]:
+        """
+        Yields the amounts, timestamps, balances after, and description indexes
+        of postings `start` to `end` - 1, about a chunk at a time.
+        """
+        position = balance = 0
+        for amounts, timestamps, ids in self._columns():
+            if position >= end:
+                break
+            count = len(amounts)
+            if position + count > start:
+                balances = array(
+                    "q", islice(accumulate(amounts, initial=balance), 1, None)
+                )
+                low, high = max(start - position, 0), min(end - position, count)
+                yield (
+                    amounts[low:high],
+                    timestamps[low:high],
+                    balances[low:high],
+                    ids[low:high],
+                )
+            balance += sum(amounts)
+            position += count
+
+
+def saved_accounts(
+    directory: str, history: BinaryIO | None
+) -> Tuple[List[SavedAccount], Dict[str, List[SavedAccount]]]:
+    """
+    Reads the accounts saved in `directory` as a bank restored from it would
+    have them, without restoring it: every open account in order, and each
+    user's accounts by username. Their postings in `history`, the directory's
+    history file if it has one, are only read when they are exported.
+    """
+    # by ID, in order
+    accounts: Dict[str, SavedAccount] = {}
+    # ID and accounts of each user, by username
+    users: Dict[str, Tuple[str, List[SavedAccount]]] = {}
+    table: List[int] = []
+    seq = 0
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            snapshot = json.load(f)
+        seq = snapshot["seq"]
+        for user in snapshot["users"]:
+            owned = []
+            for state in user["accounts"]:
+                acc = SavedAccount(state["id"], user["username"], history, table)
+                if "amounts" in state:
+                    # a snapshot from before the history file, with the
+                    # postings in it
+                    fees = set(state.get("fees", ()))
+                    for i, posting in enumerate(
+                        zip(
+                            state["amounts"], state["descriptions"], state["timestamps"]
+                        )
+                    ):
+                        acc.post(*posting, i in fees)
+                accounts[acc.id] = acc
+                owned.append(acc)
+            users[user["username"]] = (user["id"], owned)
+        if history is not None:
+            for id, count, offset in scan_history(
+                history, snapshot.get("history", 0), table
+            ):
+                found = accounts.get(id)
+                # None if closed since
+                if found is not None:
+                    found.runs.append((offset, count))
+
+    # the journal's changes, skipped as journal.apply skips them
+    for entry in journaled(directory, seq):
+        op = entry["op"]
+        if op == "post":
+            found = accounts.get(entry["id"])
+            if found is not None:
+                found.post(
+                    entry["amount"],
+                    entry["desc"],
+                    entry.get("ts"),
+                    entry.get("fee", False),
+                )
+        elif op == "register":
+            users.setdefault(entry["username"], (entry["id"], []))
+        elif op == "open":
+            owner = users.get(entry["owner"])
+            if owner is not None and entry["id"] not in accounts:
+                acc = SavedAccount(entry["id"], entry["owner"], history, table)
+                accounts[acc.id] = acc
+                owner[1].append(acc)
+        elif op == "close":
+            closed = accounts.pop(entry["id"], None)
+            if closed is not None:
+                users[closed.owner][1].remove(closed)
+        elif op == "delete":
+            deleted = users.get(entry["username"])
+            # entries from before IDs were recorded have none
+            if deleted is not None and deleted[0] == entry.get("id", deleted[0]):
+                del users[entry["username"]]
+                for acc in deleted[1]:
+                    del accounts[acc.id]
+    return list(accounts.values()), {
+        username: owned for username, (_, owned) in users.items()
+    }
+
+
+def statement_accounts(
+    target: BalanceAccount | UserAccount | Bank,
+) -> List[BalanceAccount]:
+    """Returns the accounts a statement for `target` covers, oldest first."""
+    if isinstance(target, Bank):
+        with target._lock:
+            return list(target._index.values())
+    if isinstance(target, UserAccount):
+        return list(target.accounts)
+    return [target]
+
+
+def _range(
+    acc: BalanceAccount | SavedAccount, since: int | None, until: int | None
+) -> Tuple[int, int]:
+    if isinstance(acc, SavedAccount):
+        start = acc.index_at(since) if since is not None else 0
+        end = acc.index_at(until) if until is not None else len(acc)
+        return start, end
+    ledger = acc._transactions
+    with acc._lock:
+        start = ledger.index_at(since) if since is not None else 0
+        end = ledger.index_at(until) if until is not None else len(ledger)
+    return start, end
+
+
+def _chunks(
+    acc: BalanceAccount | SavedAccount, start: int, end: int
+) -> Iterator[Tuple[array, array, array, array]]:
+    if isinstance(acc, SavedAccount):
+        yield from acc.records(start, end)
+        return
+    ledger = acc._transactions
+    for i in range(start, end, CHUNK):
+        with acc._lock:
+            yield ledger.records(i, min(i + CHUNK, end))
+
+
+def write_csv(
+    accounts: Sequence[BalanceAccount | SavedAccount],
+    out: TextIO,
+    since: int | None = None,
+    until: int | None = None,
+) -> int:
+    """
+    Writes the postings made from `since` up to (not including) `until`, both
+    nanoseconds since the epoch, as CSV. Returns how many were written.
+    """
+    writer = csv.writer(out)
+    writer.writerow(CSV_HEADER)
+    written = 0
+    for acc in accounts:
+        for amounts, timestamps, balances, ids in _chunks(
+            acc, *_range(acc, since, until)
+        ):
+            writer.writerows(
+                zip(
+                    repeat(acc.id),
+                    timestamps,
+                    amounts,
+                    balances,
+                    descriptions.lookup(ids),
+                )
+            )
+            written += len(amounts)
+    return written
+
+
+def _renumber(ids: array, table: Dict[int, int]) -> array:
+    """
+    Returns `ids` as indexes into the statement's table, adding the ones it
+    doesn't have yet. `table` maps bank-wide indexes to the statement's.
+    """
+    for id in set(ids).difference(table):
+        table[id] = len(table)
+    return array("q", map(table.__getitem__, ids))
+
+
+def _pack(amounts: array, timestamps: array, balances: array, ids: array) -> bytearray:
+    data = bytearray(len(amounts) * RECORD.size)
+    if sys.byteorder == "little":
+        # a RECORD is four 8-byte slots, the last a u32 and padding, so the
+        # columns can be copied in whole
+        slots = memoryview(data).cast("q")
+        slots[0::4] = amounts
+        slots[1::4] = timestamps
+        slots[2::4] = balances
+        slots[3::4] = ids
+    else:
+        for i, record in enumerate(zip(amounts, timestamps, balances, ids)):
+            RECORD.pack_into(data, i * RECORD.size, *record)
+    return data
+
+
+def write_binary(
+    accounts: Sequence[BalanceAccount | SavedAccount],
+    out: BinaryIO,
+    since: int | None = None,
+    until: int | None = None,
+) -> int:
+    """As write_csv, in the binary format."""
+    assert RECORD.size == 32, "Records no longer fit in four slots"
+    out.write(MAGIC)
+    written = 0
+    table: Dict[int, int] = {}
+    for acc in accounts:
+        id = acc.id.encode("utf-8")
+        start, end = _range(acc, since, until)
+        if start == end:
+            continue
+        out.write(SECTION.pack(len(id), end - start))
+        out.write(id)
+        for amounts, timestamps, balances, ids in _chunks(acc, start, end):
+            out.write(_pack(amounts, timestamps, balances, _renumber(ids, table)))
+        written += end - start
+    out.write(SECTION.pack(0, 0))
+
+    # in the order they were numbered
+    out.write(LENGTH.pack(len(table)))
+    for text in descriptions.lookup(table):
+        encoded = text.encode("utf-8")
+        out.write(LENGTH.pack(len(encoded)))
+        out.write(encoded)
+    return written
+
+
+def read_binary(f: BinaryIO) -> Iterator[Posting]:
+    """Yields the postings in a binary statement, in the order they were written."""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a binary statement")
+    sections: List[Tuple[str, bytes]] = []
+    while True:
+        length, count = SECTION.unpack(f.read(SECTION.size))
+        if length == 0:
+            break
+        sections.append((f.read(length).decode("utf-8"), f.read(count * RECORD.size)))
+
+    (count,) = LENGTH.unpack(f.read(LENGTH.size))
+    table = []
+    for _ in range(count):
+        (length,) = LENGTH.unpack(f.read(LENGTH.size))
+        table.append(f.read(length).decode("utf-8"))
+
+    for id, data in sections:
+        for amount, timestamp, balance, index in RECORD.iter_unpack(data):
+            yield id, timestamp, amount, balance, table[index]
+
+
+def export(
+    target: BalanceAccount | UserAccount | Bank,
+    path: str,
+    format: str = "csv",
+    since: int | None = None,
+    until: int | None = None,
+) -> int:
+    """
+    Saves a statement of `target` to `path` in a format from FORMATS. Returns
+    how many postings it has.
+    """
+    return save_statement(statement_accounts(target), path, format, since, until)
+
+
+def save_statement(
+    accounts: Sequence[BalanceAccount | SavedAccount],
+    path: str,
+    format: str = "csv",
+    since: int | None = None,
+    until: int | None = None,
+) -> int:
+    """As export, for the postings of `accounts`."""
+    if format == "csv":
+        with open(path, "w", newline="", buffering=BUFFER_SIZE) as f:
+            return write_csv(accounts, f, since, until)
+    elif format == "binary":
+        with open(path, "wb", buffering=BUFFER_SIZE) as f:
+            return write_binary(accounts, f, since, until)
+    else:
+        raise ValueError(f"Unknown format: {format}")
+
+
+def parse_date(text: str) -> int:
+    """Returns an ISO date like 2024-01-31 (midnight UTC) in nanoseconds."""
+    date = datetime.fromisoformat(text)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp()) * 1_000_000_000 + date.microsecond * 1000
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        prog="python -m apcsp.labs.bank.export",
+        description="Saves a statement of the bank, a user or an account.",
+    )
+    parser.add_argument("out", help="file to save the statement to")
+    parser.add_argument(
+        "--data",
+        default="bank-data",
+        help="directory the bank is saved in (default: %(default)s)",
+    )
+    scope = parser.add_mutually_exclusive_group()
+    scope.add_argument("--user", metavar="USERNAME")
+    scope.add_argument("--account", metavar="ID")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument(
+        "--since", type=parse_date, metavar="DATE", help="first day, like 2024-01-01"
+    )
+    parser.add_argument(
+        "--until", type=parse_date, metavar="DATE", help="day after the last one"
+    )
+    args = parser.parse_args()
+
+    # read-only, so it works while the bank is running on the same data
+    path = os.path.join(args.data, HISTORY_FILE)
+    history = open(path, "rb") if os.path.exists(path) else None
+    try:
+        accounts, users = saved_accounts(args.data, history)
+        if args.user is not None:
+            owned = users.get(args.user)
+            if owned is None:
+                parser.error(f"No such user: {args.user}")
+            accounts = owned
+        elif args.account is not None:
+            accounts = [acc for acc in accounts if acc.id == args.account]
+            if not accounts:
+                parser.error(f"No such account: {args.account}")
+        written = save_statement(
+            accounts, args.out, args.format, args.since, args.until
+        )
+        print(f"{written:,} postings saved to {args.out}")
+    finally:
+        if history is not None:
+            history.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Password and PIN hashing.
+
+A hasher is a key derivation function plus its cost parameters, written as a
+spec like "pbkdf2:rounds=100000" or "scrypt:n=16384,r=8,p=1". Every user
+records the hasher of their password and of their PIN, so the cost can change
+without breaking stored digests. After a successful `UserAccount.login` or
+`check_pin` with an older hasher, the digest is derived again with
+`default_hasher`.
+
+Add a KDF with `register_hasher`. To pick parameters for this machine, run
+`python -m apcsp.labs.bank.hashing --target-ms 100`, which runs `calibrate`.
+"""
+
+import hashlib
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Dict, Type
+
+from .metrics import timed
+
+# size of a derived digest
+DIGEST_SIZE = 32
+PBKDF2_ROUNDS = 100_000
+
+# hasher of digests saved before hashers were recorded
+LEGACY_SPEC = f"pbkdf2:rounds={PBKDF2_ROUNDS}"
+
+
+class Hasher(ABC):
+    """One KDF with fixed cost parameters. Hashers with the same spec are shared."""
+
+    # registry key, the part of the spec before the colon
+    name = ""
+
+    def __init__(self, **params: int) -> None:
+        self.params = params
+        self.spec = f"{self.name}:" + ",".join(f"{k}={v}" for k, v in params.items())
+
+    @abstractmethod
+    def derive(self, secret: str, salt: bytes) -> bytes:
+        """Returns the digest of `secret` with `salt`."""
+
+    @abstractmethod
+    def stronger(self) -> "Hasher":
+        """Returns the same KDF at about twice the cost."""
+
+    @abstractmethod
+    def weaker(self) -> "Hasher | None":
+        """Returns the same KDF at about half the cost, or None if it is cheapest."""
+
+
+class PBKDF2Hasher(Hasher):
+    name = "pbkdf2"
+
+    def __init__(self, rounds: int = PBKDF2_ROUNDS) -> None:
+        if rounds < 1:
+            raise ValueError("rounds must be positive")
+        super().__init__(rounds=rounds)
+        self.rounds = rounds
+
+    @timed("pbkdf2")
+    def derive(self, secret: str, salt: bytes) -> bytes:
+        return hashlib.pbkdf2_hmac("sha256", secret.encode("utf-8"), salt, self.rounds)
+
+    def stronger(self) -> Hasher:
+        return PBKDF2Hasher(self.rounds * 2)
+
+    def weaker(self) -> Hasher | None:
+        return PBKDF2Hasher(self.rounds // 2) if self.rounds > 1 else None
+
+
+class ScryptHasher(Hasher):
+    name = "scrypt"
+
+    def __init__(self, n: int = 2**14, r: int = 8, p: int = 1) -> None:
+        if n < 2 or n & (n - 1) or r < 1 or p < 1:
+            raise ValueError("n must be a power of 2, and r and p positive")
+        super().__init__(n=n, r=r, p=p)
+        self.n, self.r, self.p = n, r, p
+
+    @timed("scrypt")
+    def derive(self, secret: str, salt: bytes) -> bytes:
+        return hashlib.scrypt(
+            secret.encode("utf-8"),
+            salt=salt,
+            n=self.n,
+            r=self.r,
+            p=self.p,
+            # scrypt needs about 128 * n * r bytes; hashlib refuses over 32 MiB
+            # unless told otherwise
+            maxmem=256 * self.n * self.r + 2**20,
+            dklen=DIGEST_SIZE,
+        )
+
+    def stronger(self) -> Hasher:
+        return ScryptHasher(self.n * 2, self.r, self.p)
+
+    def weaker(self) -> Hasher | None:
+        return ScryptHasher(self.n // 2, self.r, self.p) if self.n > 2 else None
+
+
+_kdfs: Dict[str, Type[Hasher]] = {}
+# every hasher handed out, by spec, so users with the same one share it
+_hashers: Dict[str, Hasher] = {}
+
+
+def register_hasher(kdf: Type[Hasher]) -> Type[Hasher]:
+    """Makes a Hasher subclass available by its name in specs."""
+    _kdfs[kdf.name] = kdf
+    return kdf
+
+
+register_hasher(PBKDF2Hasher)
+register_hasher(ScryptHasher)
+
+
+def _shared(hasher: Hasher) -> Hasher:
+    return _hashers.setdefault(hasher.spec, hasher)
+
+
+def get_hasher(spec: str) -> Hasher:
+    """Returns the hasher for a spec like "scrypt:n=16384,r=8,p=1"."""
+    hasher = _hashers.get(spec)
+    if hasher is not None:
+        return hasher
+
+    name, _, params = spec.partition(":")
+    kdf = _kdfs.get(name)
+    if kdf is None:
+        raise ValueError(f"Unknown hasher: {name}")
+    try:
+        values = {
+            key.strip(): int(value)
+            for key, _, value in (param.partition("=") for param in params.split(","))
+            if key.strip()
+        }
+        return _shared(kdf(**values))
+    except TypeError:
+        raise ValueError(f"Invalid parameters for {name}: {params}")
+
+
+# what new digests are derived with
+default_hasher = get_hasher(LEGACY_SPEC)
+
+
+def set_default_hasher(spec: str) -> Hasher:
+    global default_hasher
+    default_hasher = get_hasher(spec)
+    return default_hasher
+
+
+def verify_time(hasher: Hasher, repeat: int = 3) -> float:
+    """Returns the fastest of `repeat` derivations with `hasher`, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        hasher.derive("password", bytes(DIGEST_SIZE))
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def calibrate(name: str, target: float) -> Hasher:
+    """
+    Returns the costliest hasher of a KDF that derives a digest within `target`
+    seconds on this machine, or its cheapest if none does.
+    """
+    kdf = _kdfs.get(name)
+    if kdf is None:
+        raise ValueError(f"Unknown hasher: {name}")
+
+    hasher: Hasher = kdf()
+    while verify_time(hasher) > target:
+        weaker = hasher.weaker()
+        if weaker is None:
+            break
+        hasher = weaker
+    while True:
+        stronger = hasher.stronger()
+        if verify_time(stronger) > target:
+            break
+        hasher = stronger
+    return _shared(hasher)
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        prog="python -m apcsp.labs.bank.hashing",
+        description="Picks hasher parameters for a target verify time.",
+    )
+    parser.add_argument(
+        "--target-ms", type=float, default=100, help="time to verify a password"
+    )
+    parser.add_argument(
+        "--kdf", choices=sorted(_kdfs), nargs="+", default=sorted(_kdfs)
+    )
+    args = parser.parse_args()
+
+    for name in args.kdf:
+        hasher = calibrate(name, args.target_ms / 1000)
+        print(f"{hasher.spec}  ({verify_time(hasher) * 1000:.1f} ms)")
+    print("use one with --hasher SPEC")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Bank-wide interest accrual.
+
+Works out interest for every savings account at once (with NumPy when it is
+installed) using the same integer math as SavingsAccount.add_interest, then
+posts it in a single pass that appends to every ledger at once
+(`Ledger.append_each`) instead of posting account by account.
+"""
+
+from array import array
+from operator import attrgetter
+from time import time_ns
+from types import ModuleType
+from typing import List, Optional, Sequence
+
+from .account import locked
+from .account_types import SavingsAccount, interest_msg
+from .bank import Bank
+from .ledger import INT64_MAX
+from .util import format_amount
+
+numpy: Optional[ModuleType]
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+_balance = attrgetter("_balance")
+
+
+class AccrualReport(object):
+    accounts: List[SavingsAccount]
+    # balance of each account before the run, in cents
+    balances: List[int]
+    # interest for each account, in cents, in the same order as `accounts`
+    amounts: List[int]
+
+    def __init__(
+        self,
+        interest: int,
+        accounts: List[SavingsAccount],
+        balances: List[int],
+        amounts: List[int],
+        posted: bool,
+    ) -> None:
+        self.interest = interest
+        self.accounts = accounts
+        self.balances = balances
+        self.amounts = amounts
+        self.posted = posted
+
+    @property
+    def total(self) -> int:
+        return sum(self.amounts)
+
+    def str(self, limit: int = 10) -> str:
+        """Summary of the run, listing the `limit` largest amounts."""
+        verb = "Posted" if self.posted else "Would post"
+        lines = [
+            f"{verb} {interest_msg(self.interest).lower()} to"
+            f" {len(self.accounts):,} savings accounts:"
+            f" {format_amount(self.total, include_sign=False)} in total"
+        ]
+        largest = sorted(
+            range(len(self.accounts)), key=lambda i: self.amounts[i], reverse=True
+        )[:limit]
+        for i in largest:
+            lines.append(
+                f"    {self.accounts[i].id}: {format_amount(self.amounts[i])} on"
+                f" {format_amount(self.balances[i], include_sign='negative')}"
+            )
+        return "\n".join(lines)
+
+
+def compute_interest(balances: Sequence[int], interest: int) -> List[int]:
+    """(balance * interest) // 1000_000 for every balance, as add_interest does."""
+    if numpy is not None and balances:
+        if isinstance(balances, array):
+            # shares the array's memory instead of converting each int
+            column = numpy.frombuffer(balances, dtype=numpy.int64)
+        else:
+            column = numpy.array(balances, dtype=numpy.int64)
+        # fall back to Python ints if the product could overflow int64
+        largest = int(numpy.abs(column).max())
+        if largest * abs(interest) <= INT64_MAX:
+            return (column * interest // 1000_000).tolist()
+
+    return [balance * interest // 1000_000 for balance in balances]
+
+
+def accrue_interest(bank: Bank, interest: int, dry_run: bool = False) -> AccrualReport:
+    """
+    Adds interest to every savings account in the bank.
+    interest: the interest rate to add, in thousandths of a percent
+    dry_run: only work out the interest, without posting it
+    """
+    # copied under the lock, as accounts may be opened or closed meanwhile
+    with bank._lock:
+        accounts = [
+            acc for acc in bank._index.values() if isinstance(acc, SavingsAccount)
+        ]
+    if dry_run:
+        before = array("q", map(_balance, accounts))
+        amounts = compute_interest(before, interest)
+        return AccrualReport(interest, accounts, before.tolist(), amounts, posted=False)
+
+    description = interest_msg(interest)
+    now = time_ns()
+    with locked(accounts):
+        before = array("q", map(_balance, accounts))
+        amounts = compute_interest(before, interest)
+        balances = before.tolist()
+        if before:
+            # no balance moves by more than its interest at the largest balance
+            largest = max(max(before), -min(before))
+            if largest + largest * abs(interest) // 1000_000 + 1 > INT64_MAX:
+                raise ValueError("Balance would be too large")
+        bank._post_each(accounts, balances, amounts, description, now)
+
+    return AccrualReport(interest, accounts, balances, amounts, posted=True)
@@ -0,0 +1,775 @@
+"""
+Durable storage for a bank: an append-only journal of every change plus
+periodic snapshots of the whole bank.
+
+Startup loads the latest snapshot and replays the journal entries written after
+it. Entries are written and fsynced by a background thread in groups, so many
+postings share a single fsync.
+
+Postings never change once made, so snapshots are incremental: each appends the
+postings made since the last one to a history file, then rewrites the rest of
+the bank (users, accounts, and how many postings of each the history holds),
+which is small. A snapshot starts from a cut: the journal so far is set aside
+and the postings each account has journaled are counted, which is all writers
+wait for. The rest is done by a background thread while other threads keep
+changing the bank, so a snapshot holds exactly the postings that had journal
+entries by the cut, and may already show other changes (a new user, a closed
+account) whose entries come after it. Replaying those is a no-op.
+
+The history is little-endian, a sequence of blocks:
+
+    b"D", DESCRIPTION (whether it is an overdraft fee, length), the UTF-8: the
+        next description in the history's own table
+    b"P", POSTINGS (length of the account ID, count), the ID in UTF-8, then
+        the amounts (i64), timestamps (i64) and description indexes (u32) of
+        that many postings of the account, a column at a time
+
+It keeps the postings of closed accounts, which are skipped on loading.
+
+Only one process may use a data directory at a time; `attach` locks it.
+"""
+
+import json
+import os
+import shutil
+import struct
+import sys
+import threading
+from array import array
+from typing import Any, BinaryIO, Dict, Iterator, List, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (Windows): nothing stops a second process
+    fcntl = None  # type: ignore
+
+from . import util
+from .account import Account, BalanceAccount
+from .account_types import (
+    CheckingAccount,
+    SavingsAccount,
+    UserAccount,
+    UserHoldableAccount,
+)
+from .bank import Bank, BankListener
+from .hashing import LEGACY_SPEC, get_hasher
+from .ledger import descriptions
+
+JOURNAL_FILE = "journal.log"
+# the journal up to the cut of a snapshot still being taken
+OLD_JOURNAL_FILE = "journal.old.log"
+SNAPSHOT_FILE = "snapshot.json"
+HISTORY_FILE = "history.bin"
+LOCK_FILE = "lock"
+
+DESCRIPTION = struct.Struct("<?I")
+POSTINGS = struct.Struct("<HQ")
+# bytes per posting in a run: amount, timestamp and description index
+POSTING_SIZE = 8 + 8 + 4
+
+# take a snapshot (and empty the journal) after this many entries
+SNAPSHOT_EVERY = 100_000
+
+
+class Journal(BankListener):
+    def __init__(
+        self,
+        directory: str,
+        snapshot_every: int = SNAPSHOT_EVERY,
+        commit_delay: float = 0.0,
+        sync: bool = True,
+    ) -> None:
+        """
+        directory: where the journal and snapshots are kept
+        snapshot_every: entries between snapshots, or 0 to never snapshot
+        commit_delay: seconds to wait for more entries before each fsync
+        sync: whether changes wait until they are on disk before returning
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.commit_delay = commit_delay
+        self.sync = sync
+        self.bank: Bank | None = None
+
+        self._seq = 0
+        self._snapshot_seq = 0
+        self._durable_seq = 0
+        self._pending: List[str] = []
+        self._closed = False
+        # guards _seq, _pending and _durable_seq
+        self._cond = threading.Condition()
+        # guards the journal file
+        self._io_lock = threading.Lock()
+        # postings with a journal entry, by account ID; guarded by _cond
+        self._posted: Dict[str, int] = {}
+        # entries of the batch being delivered on this thread, if any
+        self._local = threading.local()
+        self._file: Any = None
+        self._lock_file: Any = None
+        self._writer: threading.Thread | None = None
+        # the thread taking a snapshot, if one is; guarded by _cond
+        self._snapshotter: threading.Thread | None = None
+        # only used by the thread taking a snapshot
+        self._history = History(os.path.join(directory, HISTORY_FILE))
+
+    @property
+    def journal_path(self) -> str:
+        return os.path.join(self.directory, JOURNAL_FILE)
+
+    @property
+    def old_journal_path(self) -> str:
+        return os.path.join(self.directory, OLD_JOURNAL_FILE)
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.directory, SNAPSHOT_FILE)
+
+    def attach(self, bank: Bank) -> int:
+        """
+        Restores the saved state into an empty bank, then records every later
+        change to it. Returns the number of journal entries replayed.
+        """
+        assert self.bank is None, "Journal already attached"
+        assert not bank.accounts, "Can only restore into an empty bank"
+
+        self._lock_file = open(os.path.join(self.directory, LOCK_FILE), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise RuntimeError(
+                    f"{self.directory} is in use by another process"
+                ) from None
+
+        self._snapshot_seq, self._history = load_snapshot(bank, self.directory)
+        self._seq, replayed, end = replay_all(bank, self.directory, self._snapshot_seq)
+        self._durable_seq = self._seq
+        self._posted = {acc.id: len(acc._transactions) for acc in bank._index.values()}
+        if os.path.exists(self.old_journal_path):
+            # a snapshot was cut but never finished; finish one now, so both
+            # journals can go
+            save_snapshot(bank, self.directory, self._seq, self._posted, self._history)
+            self._snapshot_seq = self._seq
+            os.remove(self.old_journal_path)
+            self._file = open(self.journal_path, "wb")
+        else:
+            self._file = open(self.journal_path, "ab")
+            self._file.truncate(end)
+        self.bank = bank
+        bank.listeners.append(self)
+        self._writer = threading.Thread(
+            target=self._write_loop, name="bank-journal", daemon=True
+        )
+        self._writer.start()
+        return replayed
+
+    def close(self) -> None:
+        if self.bank is None:
+            return
+
+        self.bank.listeners.remove(self)
+        with self._cond:
+            while self._snapshotter is not None:
+                self._cond.wait()
+            self._closed = True
+            self._cond.notify_all()
+        assert self._writer is not None
+        self._writer.join()
+        self._file.close()
+        # closing the file releases the lock
+        self._lock_file.close()
+        self.bank = None
+
+    def _record(self, entry: Dict[str, Any]) -> None:
+        batch = getattr(self._local, "batch", None)
+        if batch is not None:
+            batch.append(entry)
+        else:
+            self._append([entry])
+
+    def _append(self, entries: List[Dict[str, Any]]) -> None:
+        with self._cond:
+            for entry in entries:
+                self._seq += 1
+                entry["seq"] = self._seq
+                self._pending.append(json.dumps(entry, separators=(",", ":")))
+                if entry["op"] == "post":
+                    self._posted[entry["id"]] = self._posted.get(entry["id"], 0) + 1
+            seq = self._seq
+            self._cond.notify_all()
+
+            if (
+                self.snapshot_every
+                and seq - self._snapshot_seq >= self.snapshot_every
+                and self._snapshotter is None
+            ):
+                self._snapshotter = threading.Thread(
+                    target=self._snapshot,
+                    args=self._cut(),
+                    name="bank-snapshot",
+                    daemon=True,
+                )
+                self._snapshotter.start()
+            if self.sync:
+                while self._durable_seq < seq:
+                    self._cond.wait()
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+
+            if self.commit_delay:
+                threading.Event().wait(self.commit_delay)
+
+            with self._cond:
+                lines, self._pending = self._pending, []
+                seq = self._seq
+
+            with self._io_lock:
+                self._file.write(("\n".join(lines) + "\n").encode("utf-8"))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+            with self._cond:
+                self._durable_seq = max(self._durable_seq, seq)
+                self._cond.notify_all()
+
+    def snapshot(self) -> None:
+        """Saves the whole bank and empties the journal, on this thread."""
+        with self._cond:
+            while self._snapshotter is not None:
+                self._cond.wait()
+            self._snapshotter = threading.current_thread()
+            seq, posted = self._cut()
+        self._snapshot(seq, posted)
+
+    def _cut(self) -> Tuple[int, Dict[str, int]]:
+        # called with _cond held, so no entries are added meanwhile. Sets the
+        # journal so far aside and returns where it ends, and the postings each
+        # account has journaled
+        with self._io_lock:
+            self._file.close()
+            if os.path.exists(self.old_journal_path):
+                # the last snapshot failed; this one replaces both journals
+                with open(self.old_journal_path, "ab") as old, open(
+                    self.journal_path, "rb"
+                ) as rest:
+                    shutil.copyfileobj(rest, old)
+                    old.flush()
+                    os.fsync(old.fileno())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.old_journal_path)
+            self._file = open(self.journal_path, "ab")
+        self._snapshot_seq = self._seq
+        return self._seq, dict(self._posted)
+
+    def _snapshot(self, seq: int, posted: Dict[str, int]) -> None:
+        bank = self.bank
+        assert bank is not None
+        try:
+            save_snapshot(bank, self.directory, seq, posted, self._history)
+            # everything set aside is now in the snapshot
+            os.remove(self.old_journal_path)
+        finally:
+            with self._cond:
+                self._snapshotter = None
+                self._cond.notify_all()
+
+    def on_register(self, user: UserAccount) -> None:
+        self._record({"op": "register", **user_state(user)})
+
+    def on_delete(self, user: UserAccount) -> None:
+        self._record({"op": "delete", "username": user.username, "id": user.id})
+
+    def on_credentials(self, user: UserAccount) -> None:
+        self._record(
+            {
+                "op": "credentials",
+                "username": user.username,
+                "password": user._password.hex(),
+                "password_hasher": user._password_hasher.spec,
+                "pin": user._pin.hex(),
+                "pin_hasher": user._pin_hasher.spec,
+            }
+        )
+
+    def on_rename(self, account: Account) -> None:
+        if isinstance(account, UserAccount):
+            self._record(
+                {"op": "rename", "username": account.username, "name": account.name}
+            )
+        else:
+            self._record({"op": "rename", "id": account.id, "name": account.name})
+
+    def on_open(self, account: UserHoldableAccount) -> None:
+        self._record({"op": "open", **account_state(account)})
+
+    def on_close(self, account: UserHoldableAccount) -> None:
+        self._record({"op": "close", "id": account.id})
+
+    def on_post(
+        self,
+        account: BalanceAccount,
+        amount: int,
+        description: str,
+        timestamp: int,
+        fee: bool = False,
+    ) -> None:
+        entry = {
+            "op": "post",
+            "id": account.id,
+            "amount": amount,
+            "desc": description,
+            "ts": timestamp,
+        }
+        if fee:
+            entry["fee"] = True
+        self._record(entry)
+
+    def on_batch(self, events: List[Tuple[str, tuple]]) -> None:
+        # the whole batch gets its sequence numbers at once, so no snapshot falls
+        # inside it, and waits for the disk once
+        entries: List[Dict[str, Any]] = []
+        self._local.batch = entries
+        try:
+            super().on_batch(events)
+        finally:
+            self._local.batch = None
+        if entries:
+            self._append(entries)
+
+    def flush(self) -> None:
+        """Waits until every entry so far is on disk."""
+        with self._cond:
+            seq = self._seq
+            while self._durable_seq < seq:
+                self._cond.wait()
+
+
+def user_state(user: UserAccount) -> Dict[str, Any]:
+    return {
+        "id": user.id,
+        "name": user.name,
+        "username": user.username,
+        "salt": user._salt.hex(),
+        "password": user._password.hex(),
+        "password_hasher": user._password_hasher.spec,
+        "pin": user._pin.hex(),
+        "pin_hasher": user._pin_hasher.spec,
+    }
+
+
+def account_state(account: UserHoldableAccount) -> Dict[str, Any]:
+    state: Dict[str, Any] = {
+        "id": account.id,
+        "type": account.type,
+        "name": account.name,
+        "owner": account._owner.username,
+    }
+    if isinstance(account, CheckingAccount) and account.overdraft_source:
+        state["overdraft"] = account.overdraft_source.id
+    return state
+
+
+def restore_user(entry: Dict[str, Any]) -> UserAccount:
+    return UserAccount.restore(
+        entry["name"],
+        entry["username"],
+        entry["id"],
+        bytes.fromhex(entry["salt"]),
+        bytes.fromhex(entry["password"]),
+        bytes.fromhex(entry["pin"]),
+        # entries from before hashers were recorded have neither
+        get_hasher(entry.get("password_hasher", LEGACY_SPEC)),
+        get_hasher(entry.get("pin_hasher", LEGACY_SPEC)),
+    )
+
+
+def restore_account(bank: Bank, user: UserAccount, entry: Dict[str, Any]) -> None:
+    acc: UserHoldableAccount
+    if entry["type"] == "checking":
+        source = entry.get("overdraft")
+        acc = CheckingAccount(
+            user,
+            entry["name"],
+            (user.get_account(source) or bank.find_account(source)) if source else None,
+            id=entry["id"],
+        )
+    elif entry["type"] == "savings":
+        acc = SavingsAccount(user, entry["name"], id=entry["id"])
+    else:
+        raise ValueError(f"Unknown account type {entry['type']!r}")
+
+    if "amounts" in entry:
+        # a snapshot from before the history file, with the postings in it.
+        # Positions of the overdraft fees
+        fees = set(entry.get("fees", ()))
+        for i, (amount, description, timestamp) in enumerate(
+            zip(entry["amounts"], entry["descriptions"], entry["timestamps"])
+        ):
+            acc._transactions.append(amount, description, timestamp, i in fees)
+        acc._balance = sum(entry["amounts"])
+
+
+def apply(bank: Bank, entry: Dict[str, Any]) -> None:
+    """
+    Replays one journal entry against the bank. Entries for changes a snapshot
+    already shows, like opening an account it has, are skipped.
+    """
+    op = entry["op"]
+    if op == "post":
+        acc = bank.find_account(entry["id"])
+        # None if a later change in the snapshot closed the account
+        if acc is not None:
+            acc._post(
+                entry["amount"], entry["desc"], entry.get("ts"), entry.get("fee", False)
+            )
+    elif op == "register":
+        if entry["username"] not in bank.accounts:
+            bank._attach(restore_user(entry))
+    elif op == "open":
+        owner = bank.accounts.get(entry["owner"])
+        if owner is not None and bank.find_account(entry["id"]) is None:
+            restore_account(bank, owner, entry)
+    elif op == "close":
+        acc = bank.find_account(entry["id"])
+        if acc is not None:
+            acc._owner.close_account(acc)
+    elif op == "delete":
+        deleted = bank.accounts.get(entry["username"])
+        # entries from before IDs were recorded have none
+        if deleted is not None and deleted.id == entry.get("id", deleted.id):
+            bank.delete(entry["username"])
+    elif op == "credentials":
+        user = bank.accounts.get(entry["username"])
+        if user is None:
+            return
+        user._store_password(
+            bytes.fromhex(entry["password"]),
+            get_hasher(entry.get("password_hasher", LEGACY_SPEC)),
+        )
+        user._store_pin(
+            bytes.fromhex(entry["pin"]),
+            get_hasher(entry.get("pin_hasher", LEGACY_SPEC)),
+        )
+    elif op == "rename":
+        named: Account | None
+        if "username" in entry:
+            named = bank.accounts.get(entry["username"])
+        else:
+            named = bank.find_account(entry["id"])
+        if named is not None:
+            named.name = entry["name"]
+    else:
+        raise ValueError(f"Unknown journal entry {op!r}")
+
+
+def _little(column: array) -> bytes:
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _column(typecode: str, data: bytes) -> array:
+    column = array(typecode, data)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+
+def scan_history(
+    f: BinaryIO, end: int, table: List[int]
+) -> Iterator[Tuple[str, int, int]]:
+    """
+    Yields the account ID, count and offset of each run of postings in the
+    first `end` bytes of a history file, oldest first, without reading them.
+    Each description is interned as it is reached, and its index in
+    `descriptions` added to `table`.
+    """
+    position = 0
+    while position < end:
+        f.seek(position)
+        tag = f.read(1)
+        if tag == b"D":
+            fee, length = DESCRIPTION.unpack(f.read(DESCRIPTION.size))
+            table.append(descriptions.intern(f.read(length).decode("utf-8"), fee))
+            position += 1 + DESCRIPTION.size + length
+        elif tag == b"P":
+            length, count = POSTINGS.unpack(f.read(POSTINGS.size))
+            id = f.read(length).decode("utf-8")
+            position += 1 + POSTINGS.size + length
+            yield id, count, position
+            position += count * POSTING_SIZE
+        else:
+            raise ValueError(f"Unknown history block {tag!r} at byte {position}")
+
+
+def read_run(
+    f: BinaryIO,
+    offset: int,
+    count: int,
+    table: List[int],
+    start: int = 0,
+    end: int | None = None,
+) -> Tuple[array, array, array]:
+    """
+    Reads postings `start` to `end` - 1 (all by default) of a run found by
+    scan_history: their amounts, timestamps and description indexes into
+    `descriptions`.
+    """
+    if end is None:
+        end = count
+    f.seek(offset + start * 8)
+    amounts = _column("q", f.read((end - start) * 8))
+    f.seek(offset + (count + start) * 8)
+    timestamps = _column("q", f.read((end - start) * 8))
+    f.seek(offset + count * 16 + start * 4)
+    ids = array("I", map(table.__getitem__, _column("I", f.read((end - start) * 4))))
+    return amounts, timestamps, ids
+
+
+class History(object):
+    """The history file of a data directory, as of the last snapshot."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # bytes of the file the last snapshot covers; anything after is left
+        # over from one that never finished
+        self.end = 0
+        # postings the history holds, by account ID
+        self.saved: Dict[str, int] = {}
+        # index in the history's description table, by index in `descriptions`
+        self._table: Dict[int, int] = {}
+
+    def load(self, accounts: Dict[str, UserHoldableAccount], end: int) -> None:
+        """Appends the postings in the first `end` bytes to `accounts`, by ID."""
+        table: List[int] = []
+        if end:
+            with open(self.path, "rb") as f:
+                for id, count, offset in scan_history(f, end, table):
+                    acc = accounts.get(id)
+                    if acc is None:
+                        # closed since
+                        continue
+                    amounts, timestamps, ids = read_run(f, offset, count, table)
+                    acc._transactions.extend(amounts, timestamps, ids)
+                    acc._balance += sum(amounts)
+                    self.saved[id] = self.saved.get(id, 0) + count
+        self.end = end
+        self._table = {id: i for i, id in enumerate(table)}
+
+    def save(
+        self, bank: Bank, accounts: List[UserHoldableAccount], posted: Dict[str, int]
+    ) -> None:
+        """
+        Appends the postings of `accounts` up to their count in `posted` that it
+        doesn't hold yet, and waits until they are on disk.
+        """
+        assert array("I").itemsize == 4, "Description indexes no longer fit in u32"
+        saved: Dict[str, int] = {}
+        length = self.end
+        with open(self.path, "ab") as f:
+            f.truncate(length)
+            for acc in accounts:
+                start = self.saved.get(acc.id, 0)
+                end = saved[acc.id] = posted.get(acc.id, 0)
+                if end > start:
+                    # the spill lock keeps postings from moving to cold storage
+                    # while they are read
+                    with bank._spill_lock:
+                        amounts, timestamps, ids = acc._transactions.columns(start)
+                    count = end - start
+                    del amounts[count:], timestamps[count:], ids[count:]
+                    length += self._write(f, acc.id, amounts, timestamps, ids)
+            f.flush()
+            os.fsync(f.fileno())
+        self.end = length
+        self.saved = saved
+
+    def _write(
+        self, f: BinaryIO, id: str, amounts: array, timestamps: array, ids: array
+    ) -> int:
+        # returns the bytes written
+        written = 0
+        table = self._table
+        for new in sorted(set(ids).difference(table)):
+            table[new] = len(table)
+            text = descriptions[new].encode("utf-8")
+            written += f.write(
+                b"D" + DESCRIPTION.pack(descriptions.is_fee(new), len(text)) + text
+            )
+        encoded = id.encode("utf-8")
+        written += f.write(b"P" + POSTINGS.pack(len(encoded), len(amounts)) + encoded)
+        written += f.write(_little(amounts))
+        written += f.write(_little(timestamps))
+        written += f.write(_little(array("I", map(table.__getitem__, ids))))
+        return written
+
+
+def save_snapshot(
+    bank: Bank, directory: str, seq: int, posted: Dict[str, int], history: History
+) -> None:
+    """
+    Saves the bank as of journal entry `seq`, when each account had journaled
+    its count of postings in `posted` (accounts not in it had none): adds the
+    new ones to `history`, then saves the rest.
+    """
+    # copied without the bank lock, as a thread may hold it while it waits for
+    # the journal
+    users = [(user, list(user.accounts)) for user in list(bank.accounts.values())]
+    history.save(bank, [acc for _, accounts in users for acc in accounts], posted)
+    snapshot = {
+        "seq": seq,
+        "ids": dict(util.id_counters),
+        "history": history.end,
+        "users": [
+            {
+                **user_state(user),
+                "accounts": [
+                    {**account_state(acc), "posted": history.saved.get(acc.id, 0)}
+                    for acc in accounts
+                ],
+            }
+            for user, accounts in users
+        ],
+    }
+
+    # write to a temporary file first so a crash never leaves half a snapshot
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(json.dumps(snapshot, separators=(",", ":")))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_snapshot(bank: Bank, directory: str) -> Tuple[int, History]:
+    """
+    Restores the snapshot in `directory` into the bank. Returns its journal
+    position and the history it was restored from.
+    """
+    history = History(os.path.join(directory, HISTORY_FILE))
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return 0, history
+
+    with open(path) as f:
+        snapshot = json.load(f)
+
+    for namespace, counter in snapshot["ids"].items():
+        util.id_counters[namespace] = max(util.id_counters.get(namespace, -1), counter)
+
+    users = []
+    accounts: Dict[str, UserHoldableAccount] = {}
+    posted: Dict[str, int] = {}
+    for entry in snapshot["users"]:
+        user = restore_user(entry)
+        for state in entry["accounts"]:
+            restore_account(bank, user, state)
+            # snapshots from before the history file have none
+            posted[state["id"]] = state.get("posted", 0)
+        accounts.update((acc.id, acc) for acc in user.accounts)
+        users.append(user)
+    history.load(accounts, snapshot.get("history", 0))
+    for id, count in posted.items():
+        if history.saved.get(id, 0) != count:
+            raise RuntimeError(
+                f"History has {history.saved.get(id, 0)} postings of {id}, the"
+                f" snapshot {count}"
+            )
+
+    # attach once everything is loaded, so listeners see the restored balances
+    for user in users:
+        bank._attach(user)
+
+    return snapshot["seq"], history
+
+
+def replay(bank: Bank, path: str, seq: int) -> Tuple[int, int, int]:
+    """
+    Replays the journal entries after `seq`. Returns the last entry's position,
+    the number replayed, and the length of the journal up to its last complete
+    entry.
+    """
+    replayed = 0
+    end = 0
+    if not os.path.exists(path):
+        return seq, replayed, end
+
+    with open(path, "rb") as f:
+        for entry, end in _entries(f):
+            if entry["seq"] <= seq:
+                continue
+            _check_follows(seq, entry)
+            apply(bank, entry)
+            seq = entry["seq"]
+            replayed += 1
+    return seq, replayed, end
+
+
+def _entries(f: BinaryIO) -> Iterator[Tuple[Dict[str, Any], int]]:
+    # each complete entry, with the length of the journal up to its end
+    end = 0
+    for line in f:
+        if not line.endswith(b"\n"):
+            # torn write at the end of the journal
+            break
+        end += len(line)
+        yield json.loads(line), end
+
+
+def _check_follows(seq: int, entry: Dict[str, Any]) -> None:
+    if entry["seq"] != seq + 1:
+        raise RuntimeError(
+            f"Journal skips from entry {seq} to {entry['seq']}; a snapshot may have"
+            " been taken while loading"
+        )
+
+
+def replay_all(bank: Bank, directory: str, seq: int) -> Tuple[int, int, int]:
+    """
+    As replay, for the journal set aside by a snapshot still being taken, if
+    any, then the journal. The length returned is the journal's.
+    """
+    replayed = 0
+    old = os.path.join(directory, OLD_JOURNAL_FILE)
+    if os.path.exists(old):
+        seq, replayed, _ = replay(bank, old, seq)
+    seq, more, end = replay(bank, os.path.join(directory, JOURNAL_FILE), seq)
+    return seq, replayed + more, end
+
+
+def journaled(directory: str, seq: int) -> Iterator[Dict[str, Any]]:
+    """Yields the journal entries after `seq`, in the order replay_all applies them."""
+    for name in (OLD_JOURNAL_FILE, JOURNAL_FILE):
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for entry, _ in _entries(f):
+                if entry["seq"] <= seq:
+                    continue
+                _check_follows(seq, entry)
+                seq = entry["seq"]
+                yield entry
+
+
+def load(bank: Bank, directory: str) -> int:
+    """
+    Restores the state saved in `directory` into an empty bank without changing
+    any files or recording later changes, so it works while another process has
+    the directory. Returns the number of journal entries replayed.
+    """
+    assert not bank.accounts, "Can only restore into an empty bank"
+    seq, _ = load_snapshot(bank, directory)
+    return replay_all(bank, directory, seq)[1]
@@ -0,0 +1,76 @@
+"""
+Leased blocks of ID numbers.
+
+A state file records, for each ID namespace, the highest number any process
+has leased. A process leases a block of numbers by moving that mark forward
+under a file lock, then creates IDs from the block without touching the file
+again. Processes sharing the file never get the same number, and since the mark
+is on disk, neither does a process that restarts and loses its in-memory
+counters.
+
+Turn leasing on with `util.set_id_leases(IdLeases(path))`.
+"""
+
+import json
+import os
+from typing import Dict
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (Windows): only safe for one process per state file
+    fcntl = None  # type: ignore
+
+# IDs leased at a time
+LEASE_BLOCK = 100
+
+
+class IdLeases(object):
+    def __init__(self, path: str, block: int = LEASE_BLOCK) -> None:
+        """
+        path: the state file, shared by every process that creates IDs for the
+        same bank
+        block: IDs leased at a time; larger blocks touch the file less often
+        but skip more numbers when a process stops
+        """
+        assert block > 0, "Block must be positive"
+        self.path = path
+        self.block = block
+        # leases so far, for benchmarks
+        self.leases = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _read(self) -> Dict[str, int]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, marks: Dict[str, int]) -> None:
+        # replaced whole, so a crash never leaves half a file
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(marks, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def lease(self, namespace: str, low: int, size: int) -> int:
+        """
+        Leases `size` numbers in a row in `namespace`, none below `low` or leased
+        before, returning the first.
+        """
+        # the state file is replaced on every write, so lock a separate file
+        with open(self.path + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            marks = self._read()
+            start = max(low, marks.get(namespace, -1) + 1)
+            marks[namespace] = start + size - 1
+            self._write(marks)
+            self.leases += 1
+            # closing the file releases the lock
+        return start
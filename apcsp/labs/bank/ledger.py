@@ -0,0 +1,436 @@
+"""
+Compact transaction storage.
+
+A ledger keeps an account's postings column by column in typed arrays instead of
+one Python object per posting. Descriptions are interned into a table shared by
+every ledger, so a description repeated across postings ("Deposit", "Transfer to
+...") is only stored once. `Transaction` objects are only created on access.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, islice
+from threading import Lock
+from time import time_ns
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, overload
+
+from colorama import Fore, Style  # type: ignore
+
+from .coldstore import RECORD, ColdSegment
+from .util import format_amount
+
+
+class Transaction:
+    __slots__ = ("amount", "description", "timestamp")
+
+    def __init__(self, amount: int, description: str, timestamp: int = 0) -> None:
+        self.amount = amount
+        self.description = description
+        # nanoseconds since the epoch
+        self.timestamp = timestamp
+
+    def str(self, indent=0) -> str:
+        color = Fore.GREEN if self.amount > 0 else Fore.RED
+        return (
+            f"{' ' * indent}{color}{format_amount(self.amount)}{Style.RESET_ALL} -"
+            f" {self.description}"
+        )
+
+
+class DescriptionTable(object):
+    _strings: List[str]
+    _ids: Dict[str, int]
+    # overdraft fees are interned apart from other descriptions, so no
+    # description a user types can pass for one
+    _fee_ids: Dict[str, int]
+    # for each index, whether it is a fee's
+    _fees: bytearray
+
+    def __init__(self) -> None:
+        self._strings = []
+        self._ids = {}
+        self._fee_ids = {}
+        self._fees = bytearray()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._strings)
+
+    def intern(self, description: str, fee: bool = False) -> int:
+        ids = self._fee_ids if fee else self._ids
+        id = ids.get(description)
+        if id is None:
+            with self._lock:
+                id = ids.get(description)
+                if id is None:
+                    self._strings.append(description)
+                    self._fees.append(fee)
+                    id = ids[description] = len(self._strings) - 1
+        return id
+
+    def is_fee(self, id: int) -> bool:
+        """Whether the description at `id` was interned as an overdraft fee."""
+        return self._fees[id] == 1
+
+    def __getitem__(self, id: int) -> str:
+        return self._strings[id]
+
+    def lookup(self, ids: Iterable[int]) -> Iterator[str]:
+        """Yields the description of each index in `ids`."""
+        return map(self._strings.__getitem__, ids)
+
+
+descriptions = DescriptionTable()
+
+# largest amount or balance a ledger holds; columns are 64-bit
+INT64_MAX = 2**63 - 1
+
+
+# never appended to; see Ledger.__init__
+_EMPTY_Q = array("q")
+_EMPTY_I = array("I")
+
+
+class ColdRuns(object):
+    """Where the oldest postings of a ledger are in a cold segment."""
+
+    __slots__ = ("segment", "starts", "ends", "last_timestamp", "last_balance")
+
+    def __init__(self, segment: ColdSegment) -> None:
+        self.segment = segment
+        # record index of the first posting of each run in the segment
+        self.starts = array("Q")
+        # ledger position just past each run
+        self.ends = array("Q")
+        # timestamp and balance after the newest cold posting
+        self.last_timestamp = 0
+        self.last_balance = 0
+
+    def __len__(self) -> int:
+        return self.ends[-1] if self.ends else 0
+
+    def add(self, start: int, count: int) -> None:
+        if self.ends:
+            previous = self.ends[-2] if len(self.ends) > 1 else 0
+            if self.starts[-1] + self.ends[-1] - previous == start:
+                # straight after the last run in the segment; make it longer
+                self.ends[-1] += count
+                return
+        self.starts.append(start)
+        self.ends.append(len(self) + count)
+
+    def read(self, index: int) -> Tuple[int, int, int, int]:
+        run = bisect_right(self.ends, index)
+        previous = self.ends[run - 1] if run else 0
+        return self.segment.read(self.starts[run] + index - previous)
+
+    def read_from(
+        self, index: int, stop: int | None = None
+    ) -> Iterator[Tuple[int, int, int, int]]:
+        """Reads the postings from `index` on, up to `stop` if given."""
+        previous = 0
+        for start, end in zip(self.starts, self.ends):
+            if stop is not None:
+                if previous >= stop:
+                    break
+                end = min(end, stop)
+            if end > index:
+                skip = max(index - previous, 0)
+                yield from self.segment.read_run(start + skip, end - previous - skip)
+            previous = end
+
+
+class Ledger(Sequence[Transaction]):
+    __slots__ = ("_amounts", "_timestamps", "_descriptions", "_balances", "_cold")
+
+    # the columns only hold postings still in memory (hot). Any older ones are
+    # in a cold segment, and come first: posting i of the ledger is cold if
+    # i < len(_cold), and is hot posting i - len(_cold) otherwise
+
+    # amount of each posting, in cents
+    _amounts: array
+    # when each posting was made, in nanoseconds since the epoch; never decreases
+    _timestamps: array
+    # index of each posting's description in `descriptions`
+    _descriptions: array
+    # running total of _amounts: the balance right after each posting
+    _balances: array
+    # postings moved to cold storage, if any
+    _cold: ColdRuns | None
+
+    def __init__(self) -> None:
+        # many accounts never have a posting, so they share empty columns until
+        # their first one
+        self._amounts = _EMPTY_Q
+        self._timestamps = _EMPTY_Q
+        self._descriptions = _EMPTY_I
+        self._balances = _EMPTY_Q
+        self._cold = None
+
+    def __len__(self) -> int:
+        cold = self._cold
+        return len(self._amounts) + (len(cold) if cold is not None else 0)
+
+    def append(
+        self,
+        amount: int,
+        description: str,
+        timestamp: int | None = None,
+        fee: bool = False,
+    ) -> None:
+        if timestamp is None:
+            timestamp = time_ns()
+
+        if self._amounts:
+            if timestamp < self._timestamps[-1]:
+                # the clock went backwards; keep postings in order
+                timestamp = self._timestamps[-1]
+            balance = self._balances[-1] + amount
+        else:
+            balance = amount
+            cold = self._cold
+            if cold is not None:
+                timestamp = max(timestamp, cold.last_timestamp)
+                balance += cold.last_balance
+            self._amounts = array("q")
+            self._timestamps = array("q")
+            self._descriptions = array("I")
+            self._balances = array("q")
+
+        self._amounts.append(amount)
+        self._timestamps.append(timestamp)
+        self._descriptions.append(descriptions.intern(description, fee))
+        self._balances.append(balance)
+
+    @staticmethod
+    def append_each(
+        ledgers: Sequence["Ledger"],
+        amounts: Sequence[int],
+        description: str,
+        timestamp: int,
+    ) -> None:
+        """
+        Appends amounts[i] to ledgers[i] for every i, skipping zeros, all with the
+        same description and timestamp. Much cheaper than calling append for each,
+        as when posting to every account in the bank.
+        """
+        id = descriptions.intern(description)
+        for ledger, amount in zip(ledgers, amounts):
+            if not amount:
+                continue
+            timestamps = ledger._timestamps
+            if timestamps and timestamps[-1] <= timestamp:
+                ledger._amounts.append(amount)
+                timestamps.append(timestamp)
+                ledger._descriptions.append(id)
+                balances = ledger._balances
+                balances.append(balances[-1] + amount)
+            else:
+                # the first hot posting, or the clock went backwards
+                ledger.append(amount, description, timestamp)
+
+    def extend(self, amounts: array, timestamps: array, ids: array) -> None:
+        """
+        Appends postings already in columns, as when restoring them: their
+        timestamps in order and from the last posting on, and `ids` indexes into
+        `descriptions`.
+        """
+        if not amounts:
+            return
+        if self._amounts:
+            balance = self._balances[-1]
+        else:
+            cold = self._cold
+            balance = cold.last_balance if cold is not None else 0
+            self._amounts = array("q")
+            self._timestamps = array("q")
+            self._descriptions = array("I")
+            self._balances = array("q")
+        self._amounts.extend(amounts)
+        self._timestamps.extend(timestamps)
+        self._descriptions.extend(ids)
+        self._balances.extend(islice(accumulate(amounts, initial=balance), 1, None))
+
+    def truncate(self, length: int) -> None:
+        """Drops every posting after the first `length`."""
+        cold = self._cold
+        if cold is not None:
+            assert length >= len(cold), "Cannot truncate cold postings"
+            length -= len(cold)
+        del self._amounts[length:]
+        del self._timestamps[length:]
+        del self._descriptions[length:]
+        del self._balances[length:]
+
+    def spill(self, segment: ColdSegment, before: int) -> int:
+        """
+        Moves the postings made before `before` (nanoseconds since the epoch) to
+        cold storage. Call with the account locked. Returns how many moved.
+        """
+        count = bisect_left(self._timestamps, before)
+        if count == 0:
+            return 0
+
+        cold = self._cold
+        if cold is None:
+            cold = ColdRuns(segment)
+        assert cold.segment is segment, "Ledger already spills to another segment"
+        pack = RECORD.pack
+        start = segment.append(
+            b"".join(
+                pack(
+                    self._amounts[i],
+                    self._timestamps[i],
+                    self._balances[i],
+                    self._descriptions[i],
+                )
+                for i in range(count)
+            )
+        )
+        cold.add(start, count)
+        cold.last_timestamp = self._timestamps[count - 1]
+        cold.last_balance = self._balances[count - 1]
+        self._cold = cold
+
+        if count == len(self._amounts):
+            self._amounts = _EMPTY_Q
+            self._timestamps = _EMPTY_Q
+            self._descriptions = _EMPTY_I
+            self._balances = _EMPTY_Q
+        else:
+            self._amounts = self._amounts[count:]
+            self._timestamps = self._timestamps[count:]
+            self._descriptions = self._descriptions[count:]
+            self._balances = self._balances[count:]
+        return count
+
+    def columns(self, start: int = 0) -> Tuple[array, array, array]:
+        """
+        Returns the amounts, timestamps and description indexes of every posting
+        from `start` on, hot or cold.
+        """
+        amounts, timestamps, ids = array("q"), array("q"), array("I")
+        cold = self._cold
+        if cold is not None:
+            for amount, timestamp, _, id in cold.read_from(start):
+                amounts.append(amount)
+                timestamps.append(timestamp)
+                ids.append(id)
+            start = max(start - len(cold), 0)
+        amounts.extend(self._amounts[start:])
+        timestamps.extend(self._timestamps[start:])
+        ids.extend(self._descriptions[start:])
+        return amounts, timestamps, ids
+
+    def records(self, start: int, end: int) -> Tuple[array, array, array, array]:
+        """
+        Returns the amounts, timestamps, balances after, and description indexes
+        of postings `start` to `end` - 1, hot or cold. Call with the account
+        locked.
+        """
+        cold = self._cold
+        if cold is None or start >= len(cold):
+            hot = len(cold) if cold is not None else 0
+            return (
+                self._amounts[start - hot : end - hot],
+                self._timestamps[start - hot : end - hot],
+                self._balances[start - hot : end - hot],
+                self._descriptions[start - hot : end - hot],
+            )
+
+        amounts, timestamps, balances = array("q"), array("q"), array("q")
+        ids = array("I")
+        for amount, timestamp, balance, id in cold.read_from(start, end):
+            amounts.append(amount)
+            timestamps.append(timestamp)
+            balances.append(balance)
+            ids.append(id)
+        if end > len(cold):
+            amounts.extend(self._amounts[: end - len(cold)])
+            timestamps.extend(self._timestamps[: end - len(cold)])
+            balances.extend(self._balances[: end - len(cold)])
+            ids.extend(self._descriptions[: end - len(cold)])
+        return amounts, timestamps, balances, ids
+
+    def index_at(self, timestamp: int) -> int:
+        """Returns how many postings were made before `timestamp`."""
+        cold = self._cold
+        if cold is None:
+            return bisect_left(self._timestamps, timestamp)
+        if cold.last_timestamp < timestamp:
+            return len(cold) + bisect_left(self._timestamps, timestamp)
+        return bisect_left(range(len(cold)), timestamp, key=lambda i: cold.read(i)[1])
+
+    def amounts(self, start: int = 0) -> array:
+        """Returns the amount of every posting from `start` on, hot or cold."""
+        cold = self._cold
+        if cold is None:
+            return self._amounts[start:]
+        if start >= len(cold):
+            return self._amounts[start - len(cold) :]
+        return self.columns(start)[0]
+
+    def balance_at(self, timestamp: int) -> int:
+        """Returns the balance just after the last posting at or before `timestamp`."""
+        cold = self._cold
+        if cold is None or (self._timestamps and self._timestamps[0] <= timestamp):
+            index = bisect_right(self._timestamps, timestamp)
+            if index:
+                return self._balances[index - 1]
+            return cold.last_balance if cold is not None else 0
+
+        # only reads the cold postings the search lands on
+        index = bisect_right(range(len(cold)), timestamp, key=lambda i: cold.read(i)[1])
+        return cold.read(index - 1)[2] if index else 0
+
+    def net_flow(self, start: int, end: int) -> int:
+        """Returns the sum of the postings after `start`, up to and including `end`."""
+        return self.balance_at(end) - self.balance_at(start)
+
+    def _get(self, index: int) -> Transaction:
+        cold = self._cold
+        if cold is not None:
+            if index < len(cold):
+                amount, timestamp, _, id = cold.read(index)
+                return Transaction(amount, descriptions[id], timestamp)
+            index -= len(cold)
+        return Transaction(
+            self._amounts[index],
+            descriptions[self._descriptions[index]],
+            self._timestamps[index],
+        )
+
+    @overload
+    def __getitem__(self, index: int) -> Transaction: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Transaction]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ledger index out of range")
+        return self._get(index)
+
+    def __iter__(self) -> Iterator[Transaction]:
+        for i in range(len(self)):
+            yield self._get(i)
+
+    def __reversed__(self) -> Iterator[Transaction]:
+        for i in range(len(self) - 1, -1, -1):
+            yield self._get(i)
+
+    def nbytes(self) -> int:
+        """Returns the memory used by the hot posting columns, in bytes."""
+        return sum(
+            col.itemsize * col.buffer_info()[1]
+            for col in (
+                self._amounts,
+                self._timestamps,
+                self._descriptions,
+                self._balances,
+            )
+        )
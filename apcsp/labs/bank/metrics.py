@@ -0,0 +1,219 @@
+"""
+Opt-in timing of bank operations.
+
+Functions marked with `@timed(name)` record how long each call takes into a
+latency histogram while timing is switched on with `enable()`. Marking leaves
+the function untouched: `enable()` swaps in timing wrappers and `disable()`
+puts the originals back, so timing costs nothing while it is off.
+
+`Metrics.report()` formats the histograms as a table, and
+`Metrics.prometheus()` formats them in the Prometheus text format. `write`
+saves either one to a file.
+"""
+
+import inspect
+import sys
+import threading
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+from types import FunctionType
+from typing import Any, Callable, Dict, List, Tuple, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# upper bounds of the histogram buckets, in seconds: 1us, 2.5us, 5us, ... 10s
+BUCKETS = tuple(
+    round(scale * 10.0**exponent, 9)
+    for exponent in range(-6, 1)
+    for scale in (1, 2.5, 5)
+) + (10.0,)
+
+
+class Histogram(object):
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self) -> None:
+        # calls in each bucket; the last counts calls slower than every bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        # seconds
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket the q-th quantile falls in."""
+        wanted = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float("inf")
+
+
+class Metrics(object):
+    # histogram of each operation, by name
+    histograms: Dict[str, Histogram]
+
+    def __init__(self) -> None:
+        self.histograms = {}
+        # timed functions run on many threads
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def report(self) -> str:
+        """Returns a table of every operation, slowest in total first."""
+        rows = [["operation", "calls", "total ms", "mean us", "p50 us", "p99 us"]]
+        with self._lock:
+            histograms = sorted(
+                self.histograms.items(), key=lambda item: -item[1].total
+            )
+            for name, histogram in histograms:
+                rows.append(
+                    [
+                        name,
+                        f"{histogram.count:,}",
+                        f"{histogram.total * 1e3:,.1f}",
+                        f"{histogram.total / histogram.count * 1e6:,.1f}",
+                        f"<= {histogram.quantile(0.5) * 1e6:,.0f}",
+                        f"<= {histogram.quantile(0.99) * 1e6:,.0f}",
+                    ]
+                )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "".join(
+            "  ".join(
+                cell.ljust(width) if i == 0 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(row, widths))
+            )
+            + "\n"
+            for row in rows
+        )
+
+    def prometheus(self) -> str:
+        """Returns every histogram in the Prometheus text exposition format."""
+        lines: List[str] = [
+            "# HELP bank_operation_seconds Time taken by bank operations.",
+            "# TYPE bank_operation_seconds histogram",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self.histograms.items()):
+                label = f'operation="{name}"'
+                seen = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    seen += count
+                    lines.append(
+                        f'bank_operation_seconds_bucket{{{label},le="{bound:g}"}} {seen}'
+                    )
+                lines.append(
+                    f'bank_operation_seconds_bucket{{{label},le="+Inf"}}'
+                    f" {histogram.count}"
+                )
+                lines.append(f"bank_operation_seconds_sum{{{label}}} {histogram.total}")
+                lines.append(
+                    f"bank_operation_seconds_count{{{label}}} {histogram.count}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Saves the metrics to `path`: Prometheus format for .prom, else a table."""
+        text = self.prometheus() if path.endswith(".prom") else self.report()
+        with open(path, "w") as f:
+            f.write(text)
+
+
+# where timed functions record to, or None while timing is off
+_metrics: Metrics | None = None
+# name of every function marked with @timed
+_names: Dict[Callable, str] = {}
+# (module or class, attribute, original function) for each function enable()
+# replaced with a timing wrapper
+_replaced: List[Tuple[Any, str, Callable]] = []
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """
+    Marks a function to be timed as `name` while timing is on. It is left as it
+    is, so it costs nothing while timing is off.
+    """
+
+    def decorate(fn: F) -> F:
+        _names[fn] = name
+        return fn
+
+    return decorate
+
+
+def _wrap(fn: Callable, name: str, metrics: Metrics) -> Callable:
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def timed_async(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                metrics.observe(name, perf_counter() - start)
+
+        return timed_async
+
+    @wraps(fn)
+    def timed_call(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            metrics.observe(name, perf_counter() - start)
+
+    return timed_call
+
+
+def enable() -> Metrics:
+    """
+    Switches timing on, returning the metrics it records into. Every reference
+    to a marked function in this package's modules, and in their classes, is
+    swapped for a wrapper that times it, so import what you want timed first.
+    """
+    global _metrics
+    if _metrics is not None:
+        return _metrics
+    metrics = _metrics = Metrics()
+
+    package = __name__.rpartition(".")[0]
+    for module in list(sys.modules.values()):
+        module_name = getattr(module, "__name__", "")
+        if module_name != package and not module_name.startswith(package + "."):
+            continue
+        namespaces: List[Any] = [module]
+        namespaces += [
+            value
+            for value in vars(module).values()
+            if isinstance(value, type) and value.__module__ == module_name
+        ]
+        for namespace in namespaces:
+            for attribute, value in list(vars(namespace).items()):
+                name = _names.get(value) if isinstance(value, FunctionType) else None
+                if name is not None:
+                    setattr(namespace, attribute, _wrap(value, name, metrics))
+                    _replaced.append((namespace, attribute, value))
+    return metrics
+
+
+def disable() -> Metrics | None:
+    """Switches timing off, returning what was recorded, if anything."""
+    global _metrics
+    for namespace, attribute, fn in _replaced:
+        setattr(namespace, attribute, fn)
+    _replaced.clear()
+    metrics, _metrics = _metrics, None
+    return metrics
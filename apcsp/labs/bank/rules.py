@@ -0,0 +1,251 @@
+"""
+Velocity and anomaly rules on the posting stream.
+
+`RulesEngine` is a bank listener that checks every posting against a list of
+rules as it is made. A rule counts the postings it matches in each account over
+a sliding window, and raises an `Alert` when the count reaches its limit, such
+as ten transfers out within a minute.
+
+The window is approximated with two fixed buckets, the current one and the one
+before it, weighted by how much of the previous bucket still falls inside the
+window. That keeps four integers per account per rule, however many postings
+there are. Rules are looked up by the sign of the amount, whether it is an
+overdraft fee, and the first character of the description: a posting of a sign
+no rule matches, such as a deposit under the default rules, costs nothing more,
+and any other posting no rule could match costs one dictionary lookup.
+"""
+
+import threading
+from collections import deque
+from math import ceil
+from typing import Callable, Deque, Dict, List, Tuple
+
+from .account import BalanceAccount
+from .account_types import UserAccount, UserHoldableAccount
+from .bank import Bank, BankListener
+
+# alerts kept in RulesEngine.alerts, newest last
+ALERT_HISTORY = 1000
+
+
+class Rule(object):
+    __slots__ = (
+        "name",
+        "message",
+        "window",
+        "limit",
+        "matches",
+        "prefix",
+        "sign",
+        "fee",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        message: str,
+        window: float,
+        limit: int,
+        matches: Callable[[int, str], bool] | None,
+        prefix: str = "",
+        sign: int = 0,
+        fee: bool = False,
+    ) -> None:
+        """
+        message: what an alert says, like "Many transfers out"
+        window: length of the sliding window, in seconds
+        limit: matching postings within the window that raise an alert
+        matches: whether a posting (amount, description) counts, or None if
+        every posting with the prefix and sign does
+        prefix: what every matching description starts with, so other postings
+        are skipped without calling `matches`
+        sign: -1 if only withdrawals can match, 1 if only deposits can, else 0
+        fee: whether only overdraft fees the bank charged can match
+        """
+        assert window > 0 and limit > 0, "Window and limit must be positive"
+        self.name = name
+        self.message = message
+        # nanoseconds
+        self.window = int(window * 1_000_000_000)
+        self.limit = limit
+        self.matches = matches
+        self.prefix = prefix
+        self.sign = sign
+        self.fee = fee
+
+
+DEFAULT_RULES = [
+    Rule("velocity", "Many transfers out", 60, 10, None, "Transfer to ", -1),
+    Rule("overdrafts", "Repeated overdraft fees", 24 * 60 * 60, 3, None, fee=True),
+]
+
+
+class _Counter(object):
+    __slots__ = ("bucket", "current", "previous", "alerted")
+
+    def __init__(self, bucket: int) -> None:
+        # number of the current bucket: its start over the rule's window
+        self.bucket = bucket
+        # matches in the current bucket and in the one before it
+        self.current = 0
+        self.previous = 0
+        # the last bucket that raised an alert
+        self.alerted = -1
+
+
+class Alert(object):
+    __slots__ = ("account", "rule", "count", "timestamp")
+
+    def __init__(
+        self, account: BalanceAccount, rule: Rule, count: int, timestamp: int
+    ) -> None:
+        self.account = account
+        self.rule = rule
+        # matching postings in the window, as estimated
+        self.count = count
+        # of the posting that raised it, in nanoseconds since the epoch
+        self.timestamp = timestamp
+
+    def str(self) -> str:
+        return (
+            f"{self.rule.message}: {self.account.name} ({self.account.id}) had"
+            f" {self.count} within {self.rule.window / 1e9:g}s"
+        )
+
+
+class AlertLog(object):
+    """An on_alert that appends each alert to a file as a line. Close when done."""
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "a", buffering=1)
+        # alerts are raised on every thread that posts
+        self._lock = threading.Lock()
+
+    def __call__(self, alert: Alert) -> None:
+        with self._lock:
+            self._file.write(f"{alert.timestamp} {alert.rule.name} {alert.str()}\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class RulesEngine(BankListener):
+    # recent alerts, oldest first
+    alerts: Deque[Alert]
+
+    def __init__(
+        self,
+        rules: List[Rule] = DEFAULT_RULES,
+        on_alert: Callable[[Alert], None] | None = None,
+    ) -> None:
+        """on_alert: called with each alert as it is raised, on the posting thread"""
+        self.rules = rules
+        self.on_alert = on_alert
+        self.alerts = deque(maxlen=ALERT_HISTORY)
+        # each rule with its counters, by account. Postings to an account are
+        # made with it locked, so its counters need no lock of their own
+        self._rules: List[Tuple[Rule, Dict[BalanceAccount, _Counter]]] = [
+            (rule, {}) for rule in rules
+        ]
+        # for withdrawals, deposits and overdraft fees: the rules that could
+        # match, by the first character of the description, and the rules with
+        # no prefix for any other character. None if no rule could match
+        self._withdrawals = self._dispatch(-1, False)
+        self._deposits = self._dispatch(1, False)
+        self._fees = self._dispatch(-1, True)
+        # alerts raised so far
+        self.raised = 0
+
+    def _dispatch(
+        self, sign: int, fee: bool
+    ) -> Tuple[Dict[str, List[Tuple[Rule, Dict]]], List[Tuple[Rule, Dict]]] | None:
+        rules = [
+            (rule, counters)
+            for rule, counters in self._rules
+            if rule.sign != -sign and (fee or not rule.fee)
+        ]
+        if not rules:
+            return None
+        unprefixed = [(rule, counters) for rule, counters in rules if not rule.prefix]
+        table: Dict[str, List[Tuple[Rule, Dict]]] = {}
+        for rule, counters in rules:
+            if rule.prefix:
+                table.setdefault(rule.prefix[0], list(unprefixed)).append(
+                    (rule, counters)
+                )
+        return table, unprefixed
+
+    def attach(self, bank: Bank) -> None:
+        """Checks the bank's postings from now on; earlier ones are not counted."""
+        bank.listeners.append(self)
+
+    def on_post(
+        self,
+        account: BalanceAccount,
+        amount: int,
+        description: str,
+        timestamp: int,
+        fee: bool = False,
+    ) -> None:
+        if fee:
+            rules = self._fees
+        else:
+            rules = self._withdrawals if amount < 0 else self._deposits
+        if rules is None:
+            # most postings, such as deposits under the default rules
+            return
+        table, unprefixed = rules
+        for rule, counters in table.get(description[:1], unprefixed):
+            if not description.startswith(rule.prefix):
+                continue
+            matches = rule.matches
+            if matches is not None and not matches(amount, description):
+                continue
+            window = rule.window
+            bucket = timestamp // window
+            counter = counters.get(account)
+            if counter is None:
+                counter = counters[account] = _Counter(bucket)
+            elif bucket > counter.bucket:
+                # the current bucket becomes the previous one, unless a whole
+                # bucket has gone by with no matches
+                adjacent = bucket == counter.bucket + 1
+                counter.previous = counter.current if adjacent else 0
+                counter.current = 0
+                counter.bucket = bucket
+            # stamped before the current bucket by a slower thread, a posting is
+            # counted in it all the same
+            current = counter.current = counter.current + 1
+            if current + counter.previous < rule.limit:
+                # under the limit even counting the whole previous bucket
+                continue
+            if counter.alerted == counter.bucket:
+                # at most one alert per bucket
+                continue
+
+            # all of the current bucket, and the part of the previous one the
+            # window still covers. A late posting counts as made at the
+            # bucket's start
+            offset = max(timestamp - counter.bucket * window, 0)
+            estimate = current + counter.previous * (window - offset) / window
+            if estimate >= rule.limit:
+                counter.alerted = counter.bucket
+                self._alert(Alert(account, rule, ceil(estimate), timestamp))
+
+    def _alert(self, alert: Alert) -> None:
+        self.alerts.append(alert)
+        self.raised += 1
+        if self.on_alert is not None:
+            self.on_alert(alert)
+
+    def _forget(self, account: BalanceAccount) -> None:
+        for _, counters in self._rules:
+            counters.pop(account, None)
+
+    def on_close(self, account: UserHoldableAccount) -> None:
+        self._forget(account)
+
+    def on_delete(self, user: UserAccount) -> None:
+        for acc in user.accounts:
+            self._forget(acc)
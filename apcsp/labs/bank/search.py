@@ -0,0 +1,285 @@
+"""
+Full-text search over transaction descriptions.
+
+`SearchIndex` is a bank listener that keeps an inverted index from each word of
+a description to the postings that contain it, updated as postings are made.
+Queries are one or more words, all of which must match; a word ending in `*`
+matches every word starting with it. Results come back newest first, a page at
+a time. The index also lists each user's postings, so a search of one user's
+accounts reads no more of the bank than that user's history.
+"""
+
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import count, repeat
+from typing import TYPE_CHECKING, Dict, Iterator, List, Set, Tuple
+
+from .account import HISTORY_PAGE_SIZE, BalanceAccount
+from .account_types import UserAccount, UserHoldableAccount
+from .bank import BankListener
+from .ledger import Transaction, descriptions
+
+if TYPE_CHECKING:
+    from .bank import Bank
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def words(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+
+def _descending(postings: array, below: int | None) -> Iterator[int]:
+    start = len(postings) if below is None else bisect_left(postings, below)
+    for i in range(start - 1, -1, -1):
+        yield postings[i]
+
+
+def _unique(postings: Iterator[int]) -> Iterator[int]:
+    last = -1
+    for posting in postings:
+        if posting != last:
+            yield posting
+            last = posting
+
+
+class SearchIndex(BankListener):
+    # postings are numbered in the order they are indexed. For each one, the
+    # account it was made to (as an index into _accounts) and its position in
+    # that account's ledger
+    _posting_accounts: array
+    _posting_positions: array
+    # and its description, as an index into ledger.descriptions
+    _posting_descriptions: array
+    _accounts: List[BalanceAccount]
+    _account_numbers: Dict[BalanceAccount, int]
+    # postings indexed so far for each account, by account number
+    _indexed: array
+    # account numbers of closed accounts, whose postings are no longer found
+    _closed: Set[int]
+    # numbers of the postings containing each word, in increasing order
+    _postings: Dict[str, array]
+    # numbers of the postings to each user's accounts, in increasing order
+    _user_postings: Dict[UserAccount, array]
+    # words of each description seen, as most descriptions repeat
+    _words: Dict[str, List[str]]
+    # every word in _postings, sorted for prefix queries; None when out of date
+    _sorted_words: List[str] | None
+
+    def __init__(self) -> None:
+        self.bank: "Bank | None" = None
+        self._posting_accounts = array("I")
+        self._posting_positions = array("I")
+        self._posting_descriptions = array("I")
+        self._accounts = []
+        self._account_numbers = {}
+        self._indexed = array("I")
+        self._closed = set()
+        self._postings = {}
+        self._user_postings = {}
+        self._words = {}
+        self._sorted_words = None
+        # events arrive from every thread that posts
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._posting_accounts)
+
+    def attach(self, bank: "Bank") -> None:
+        """
+        Indexes every posting already in the bank, oldest first, then indexes
+        new ones as they are made. Attach before other threads use the bank.
+        """
+        assert self.bank is None, "Search index already attached"
+        with bank._lock:
+            accounts = list(bank._index.values())
+            with self._lock:
+                # merge the ledgers by timestamp, so older postings get lower numbers
+                postings = merge(
+                    *(
+                        zip(
+                            acc._transactions.columns()[1],
+                            repeat(self._number(acc)),
+                            count(),
+                        )
+                        for acc in accounts
+                    )
+                )
+                for _, number, position in postings:
+                    self._add(number, position)
+            self.bank = bank
+            bank.search = self
+            bank.listeners.append(self)
+
+    def detach(self) -> None:
+        if self.bank is None:
+            return
+        self.bank.listeners.remove(self)
+        self.bank.search = None
+        self.bank = None
+
+    def _number(self, account: BalanceAccount) -> int:
+        # called with _lock held
+        number = self._account_numbers.get(account)
+        if number is None:
+            number = self._account_numbers[account] = len(self._accounts)
+            self._accounts.append(account)
+            self._indexed.append(0)
+        return number
+
+    def _add(self, number: int, position: int) -> None:
+        # called with _lock held
+        account = self._accounts[number]
+        description = account._transactions._get(position).description
+        posting = len(self._posting_accounts)
+        self._posting_accounts.append(number)
+        self._posting_positions.append(position)
+        self._posting_descriptions.append(descriptions.intern(description))
+        self._indexed[number] = position + 1
+        owned = self._user_postings.get(account._owner)
+        if owned is None:
+            owned = self._user_postings[account._owner] = array("Q")
+        owned.append(posting)
+
+        found = self._words.get(description)
+        if found is None:
+            # each word once, so a posting is only listed once per word
+            found = self._words[description] = list(dict.fromkeys(words(description)))
+        for word in found:
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = array("Q")
+                self._sorted_words = None
+            postings.append(posting)
+
+    def _post(self, account: BalanceAccount) -> None:
+        # called with _lock held. Postings arrive in ledger order, so the next
+        # one for an account is just after the last one indexed
+        number = self._number(account)
+        self._add(number, self._indexed[number])
+
+    def on_open(self, account: UserHoldableAccount) -> None:
+        with self._lock:
+            number = self._number(account)
+            self._closed.discard(number)
+            # restored accounts arrive with their history
+            for position in range(self._indexed[number], len(account._transactions)):
+                self._add(number, position)
+
+    def on_close(self, account: UserHoldableAccount) -> None:
+        with self._lock:
+            number = self._account_numbers.get(account)
+            if number is not None:
+                self._closed.add(number)
+
+    def on_delete(self, user: UserAccount) -> None:
+        for acc in user.accounts:
+            self.on_close(acc)
+        with self._lock:
+            self._user_postings.pop(user, None)
+
+    def on_post(
+        self,
+        account: BalanceAccount,
+        amount: int,
+        description: str,
+        timestamp: int,
+        fee: bool = False,
+    ) -> None:
+        with self._lock:
+            self._post(account)
+
+    def on_batch(self, events: List[Tuple[str, tuple]]) -> None:
+        with self._lock:
+            for event, args in events:
+                if event == "post":
+                    self._post(args[0])
+        super().on_batch([(event, args) for event, args in events if event != "post"])
+
+    def _matching(self, word: str, below: int | None) -> Iterator[int]:
+        """Postings numbered below `below` that match one query word, descending."""
+        if not word.endswith("*"):
+            return _descending(self._postings.get(word, array("Q")), below)
+
+        prefix = word[:-1]
+        with self._lock:
+            if self._sorted_words is None:
+                self._sorted_words = sorted(self._postings)
+            sorted_words = self._sorted_words
+        start = bisect_left(sorted_words, prefix)
+        end = bisect_left(sorted_words, prefix + "\uffff", start)
+        streams = [
+            _descending(self._postings[w], below) for w in sorted_words[start:end]
+        ]
+        # a posting with two words sharing the prefix comes up twice in a row
+        return _unique(merge(*streams, reverse=True))
+
+    def _has_words(self, description: str, wanted: List[str]) -> bool:
+        found = self._words.get(description) or words(description)
+        for word in wanted:
+            if word.endswith("*"):
+                if not any(w.startswith(word[:-1]) for w in found):
+                    return False
+            elif word not in found:
+                return False
+        return True
+
+    def search(
+        self,
+        query: str,
+        user: UserAccount | None = None,
+        cursor: int | None = None,
+        size: int = HISTORY_PAGE_SIZE,
+    ) -> Tuple[List[Tuple[BalanceAccount, Transaction]], int | None]:
+        """
+        Returns up to `size` (account, transaction) pairs matching every word of
+        `query`, newest first, from `user`'s open accounts or the whole bank. Also
+        returns the cursor for the next (older) page, or None if there is none.
+        """
+        query_words: List[str] = []
+        for token in query.split():
+            token_words = words(token)
+            # a trailing * marks a prefix; other punctuation splits words as usual
+            if token.endswith("*") and token_words:
+                token_words[-1] += "*"
+            query_words += token_words
+        if not query_words:
+            return [], None
+
+        # walk the postings of the rarest exact word, and check the others
+        # against each posting's own words
+        exact = [w for w in query_words if not w.endswith("*")]
+        if exact:
+            lead = min(exact, key=lambda w: len(self._postings.get(w, ())))
+        else:
+            lead = query_words[0]
+        rest = [w for w in query_words if w != lead]
+        postings = self._matching(lead, cursor)
+        if user is not None:
+            # a user's own postings are usually far fewer than the bank's for
+            # any one word; walk those instead unless the lead word is rarer
+            owned = self._user_postings.get(user, array("Q"))
+            if not exact or len(owned) < len(self._postings.get(lead, ())):
+                postings = _descending(owned, cursor)
+                rest = query_words
+
+        page: List[Tuple[BalanceAccount, Transaction]] = []
+        for posting in postings:
+            number = self._posting_accounts[posting]
+            if number in self._closed:
+                continue
+            account = self._accounts[number]
+            if user is not None and account._owner is not user:
+                continue
+            description = descriptions[self._posting_descriptions[posting]]
+            if rest and not self._has_words(description, rest):
+                continue
+            if len(page) == size:
+                # there is at least one more; the next page starts after the last
+                return page, posting + 1
+            transaction = account._transactions[self._posting_positions[posting]]
+            page.append((account, transaction))
+        return page, None
@@ -0,0 +1,497 @@
+"""
+A JSON API for the bank core over HTTP.
+
+Run with `python -m apcsp.labs.bank.server`. Bodies and responses are JSON
+objects, and amounts are in cents:
+
+POST /register  {name, username, password, pin}     -> {token}
+POST /login     {username, password}                -> {token}
+POST /logout
+GET  /accounts                                      -> {accounts}
+POST /open      {type, name?, overdraft_source?}    -> account
+POST /close     {account}
+POST /deposit   {account, amount, description?, pin} -> account
+POST /withdraw  {account, amount, description?, pin} -> account
+POST /transfer  {source, dest, amount, pin}         -> account
+GET  /history   ?account=ID&cursor=N                -> {transactions, cursor}
+
+Everything but register and login needs an `Authorization: Bearer <token>`
+header. Tokens expire after SESSION_TTL, or SESSION_IDLE_TIMEOUT without a
+request. Moving money needs the PIN, unless it was given recently (see
+`BankState.use_pin_grant`); a PIN that is sent is always checked.
+
+Key derivation runs on the bank's pool and every other bank call on a worker
+thread, so the event loop never waits on hashing, locks or journal fsyncs.
+"""
+
+import asyncio
+import json
+import os
+import secrets
+import sys
+import traceback
+from argparse import ArgumentParser
+from http import HTTPStatus
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from . import hashing, metrics, util
+from .account_types import UserHoldableAccount
+from .bank import Bank, BankState
+from .coldstore import Archiver
+from .journal import Journal
+from .leases import IdLeases
+from .ledger import Transaction
+from .rules import AlertLog, RulesEngine
+
+# largest request body accepted, in bytes
+MAX_BODY = 64 * 1024
+
+# seconds a session lasts after login, and without a request
+SESSION_TTL = 12 * 60 * 60
+SESSION_IDLE_TIMEOUT = 30 * 60
+
+Params = Dict[str, Any]
+Handler = Callable[..., Awaitable[Params]]
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def _param(params: Params, name: str, kind: type, default: Any = ...) -> Any:
+    value = params.get(name)
+    if value is None:
+        if default is ...:
+            raise HTTPError(400, f"Missing {name}.")
+        return default
+    # bool is an int, but not an amount
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise HTTPError(400, f"Invalid {name}.")
+    return value
+
+
+def _name_param(params: Params, name: str) -> str:
+    value = _param(params, name, str)
+    if not value:
+        raise HTTPError(400, f"Empty {name}.")
+    return value
+
+
+def account_json(acc: UserHoldableAccount) -> Params:
+    return {"id": acc.id, "type": acc.type, "name": acc.name, "balance": acc.balance}
+
+
+def transaction_json(transaction: Transaction) -> Params:
+    return {
+        "amount": transaction.amount,
+        "description": transaction.description,
+        "timestamp": transaction.timestamp,
+    }
+
+
+def _response(status: int, body: Params, keep_alive: bool) -> bytes:
+    payload = json.dumps(body).encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(payload)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + payload
+
+
+class Session(object):
+    __slots__ = ("state", "started_at", "used_at")
+
+    def __init__(self, state: BankState) -> None:
+        self.state = state
+        self.started_at = self.used_at = monotonic()
+
+
+class BankServer(object):
+    # logged in sessions, by token
+    _sessions: Dict[str, Session]
+    # handler for each method and path, and whether it needs a session
+    _routes: Dict[Tuple[str, str], Tuple[Handler, bool]]
+
+    def __init__(
+        self,
+        bank: Bank,
+        session_ttl: float = SESSION_TTL,
+        session_idle_timeout: float = SESSION_IDLE_TIMEOUT,
+    ) -> None:
+        self.bank = bank
+        self.session_ttl = session_ttl
+        self.session_idle_timeout = session_idle_timeout
+        self._sessions = {}
+        self._swept_at = monotonic()
+        self._routes = {
+            ("POST", "/register"): (self._register, False),
+            ("POST", "/login"): (self._login, False),
+            ("POST", "/logout"): (self._logout, True),
+            ("GET", "/accounts"): (self._accounts, True),
+            ("POST", "/open"): (self._open, True),
+            ("POST", "/close"): (self._close, True),
+            ("POST", "/deposit"): (self._deposit, True),
+            ("POST", "/withdraw"): (self._withdraw, True),
+            ("POST", "/transfer"): (self._transfer, True),
+            ("GET", "/history"): (self._history, True),
+        }
+
+    async def start(self, host: str, port: int) -> asyncio.Server:
+        return await asyncio.start_server(self._serve, host, port)
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                    headers: Dict[str, str] = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get("content-length", 0))
+                    if not 0 <= length <= MAX_BODY:
+                        raise ValueError
+                except ValueError:
+                    writer.write(_response(400, {"error": "Bad request."}, False))
+                    break
+                body = await reader.readexactly(length)
+
+                status, response = await self._respond(method, target, headers, body)
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                writer.write(_response(status, response, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(
+        self, method: str, target: str, headers: Dict[str, str], body: bytes
+    ) -> Tuple[int, Params]:
+        url = urlsplit(target)
+        try:
+            route = self._routes.get((method, url.path))
+            if route is None:
+                if any(path == url.path for _, path in self._routes):
+                    raise HTTPError(405, "Method not allowed.")
+                raise HTTPError(404, "Not found.")
+
+            params: Params = dict(parse_qsl(url.query))
+            if body:
+                try:
+                    data = json.loads(body)
+                except ValueError:
+                    raise HTTPError(400, "Body must be JSON.")
+                if not isinstance(data, dict):
+                    raise HTTPError(400, "Body must be a JSON object.")
+                params.update(data)
+
+            handler, needs_session = route
+            if needs_session:
+                return 200, await handler(self._session(headers), params)
+            return 200, await handler(params)
+        except HTTPError as e:
+            return e.status, {"error": str(e)}
+        except (ValueError, RuntimeError) as e:
+            return 400, {"error": str(e)}
+        except Exception:
+            # a bug; answer anyway so the connection survives
+            traceback.print_exc(file=sys.stderr)
+            return 500, {"error": "Internal server error."}
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return (
+            now - session.started_at > self.session_ttl
+            or now - session.used_at > self.session_idle_timeout
+        )
+
+    def _end_session(self, token: str) -> None:
+        session = self._sessions.pop(token, None)
+        if session is not None:
+            session.state.logout()
+
+    def _session(self, headers: Dict[str, str]) -> BankState:
+        scheme, _, token = headers.get("authorization", "").partition(" ")
+        session = self._sessions.get(token) if scheme == "Bearer" else None
+        if session is None or session.state.user is None:
+            raise HTTPError(401, "Must be logged in.")
+        now = monotonic()
+        if self._expired(session, now):
+            self._end_session(token)
+            raise HTTPError(401, "Session expired.")
+        session.used_at = now
+        return session.state
+
+    def _start_session(self, state: BankState) -> Params:
+        now = monotonic()
+        if now - self._swept_at > self.session_idle_timeout:
+            # forget sessions that were never used again
+            for token, session in list(self._sessions.items()):
+                if self._expired(session, now):
+                    self._end_session(token)
+            self._swept_at = now
+        token = secrets.token_urlsafe(32)
+        self._sessions[token] = Session(state)
+        return {"token": token}
+
+    def _account(
+        self, state: BankState, params: Params, name: str
+    ) -> UserHoldableAccount:
+        acc = state.get_account(_param(params, name, str))
+        if acc is None:
+            raise HTTPError(404, "Invalid account ID.")
+        return acc
+
+    async def _check_pin(self, state: BankState, params: Params) -> None:
+        # a PIN that is given is always checked, even during a grant
+        if params.get("pin") is None and state.use_pin_grant():
+            return
+        if not await state.check_pin_async(_param(params, "pin", str)):
+            raise HTTPError(403, "Invalid PIN.")
+
+    async def _register(self, params: Params) -> Params:
+        name = _name_param(params, "name")
+        username = _name_param(params, "username")
+        password = _param(params, "password", str)
+        pin = _param(params, "pin", str)
+        state = BankState(self.bank)
+        # before deriving any keys
+        if state.username_taken(username):
+            raise RuntimeError("Username already taken")
+        await asyncio.wrap_future(
+            self.bank.pool.submit(state.register, name, username, password, pin)
+        )
+        return self._start_session(state)
+
+    async def _login(self, params: Params) -> Params:
+        state = BankState(self.bank)
+        user = await state.login_async(
+            _param(params, "username", str), _param(params, "password", str)
+        )
+        if user is None:
+            raise HTTPError(401, "Invalid username or password.")
+        return self._start_session(state)
+
+    async def _logout(self, state: BankState, params: Params) -> Params:
+        for token, session in list(self._sessions.items()):
+            if session.state is state:
+                self._end_session(token)
+        return {}
+
+    async def _accounts(self, state: BankState, params: Params) -> Params:
+        assert state.user is not None
+        return {"accounts": [account_json(acc) for acc in state.user.accounts]}
+
+    async def _open(self, state: BankState, params: Params) -> Params:
+        account_type = _param(params, "type", str)
+        name = _param(params, "name", str, None)
+        source = None
+        if params.get("overdraft_source") is not None:
+            source = self._account(state, params, "overdraft_source")
+        acc = await asyncio.to_thread(state.open_account, account_type, name, source)
+        return account_json(acc)
+
+    async def _close(self, state: BankState, params: Params) -> Params:
+        await asyncio.to_thread(state.close_account, _param(params, "account", str))
+        return {}
+
+    async def _deposit(self, state: BankState, params: Params) -> Params:
+        acc = self._account(state, params, "account")
+        amount = _param(params, "amount", int)
+        description = _param(params, "description", str, None)
+        await self._check_pin(state, params)
+        await asyncio.to_thread(acc.deposit, amount, description)
+        return account_json(acc)
+
+    async def _withdraw(self, state: BankState, params: Params) -> Params:
+        acc = self._account(state, params, "account")
+        amount = _param(params, "amount", int)
+        description = _param(params, "description", str, None)
+        await self._check_pin(state, params)
+        await asyncio.to_thread(acc.withdraw, amount, description)
+        return account_json(acc)
+
+    async def _transfer(self, state: BankState, params: Params) -> Params:
+        source = self._account(state, params, "source")
+        dest = state.find_account(_param(params, "dest", str))
+        if dest is None:
+            raise HTTPError(404, "Invalid destination account ID.")
+        amount = _param(params, "amount", int)
+        await self._check_pin(state, params)
+        await asyncio.to_thread(source.transfer, dest, amount)
+        return account_json(source)
+
+    async def _history(self, state: BankState, params: Params) -> Params:
+        acc = self._account(state, params, "account")
+        cursor = params.get("cursor")
+        try:
+            page, next_cursor = acc.history_page(
+                None if cursor is None else int(cursor)
+            )
+        except (TypeError, ValueError):
+            raise HTTPError(400, "Invalid cursor.") from None
+        return {
+            "transactions": [transaction_json(t) for t in page],
+            "cursor": next_cursor,
+        }
+
+
+class Client(object):
+    """A client for BankServer over one keep-alive connection."""
+
+    token: str | None
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self.token = None
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def request(
+        self, method: str, path: str, body: Params | None = None
+    ) -> Tuple[int, Params]:
+        """Returns the status and JSON response of one request."""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+        assert self._reader is not None
+        payload = b"" if body is None else json.dumps(body).encode("utf-8")
+        auth = f"Authorization: Bearer {self.token}\r\n" if self.token else ""
+        self._writer.write(
+            (
+                f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n{auth}"
+                f"Content-Length: {len(payload)}\r\n\r\n"
+            ).encode("latin-1")
+            + payload
+        )
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        return status, json.loads(await self._reader.readexactly(length))
+
+    async def call(self, method: str, path: str, body: Params | None = None) -> Params:
+        """request, raising HTTPError unless it succeeds."""
+        status, response = await self.request(method, path, body)
+        if status != 200:
+            raise HTTPError(status, response.get("error", ""))
+        if "token" in response:
+            self.token = response["token"]
+        return response
+
+
+async def serve(bank: Bank, host: str, port: int) -> None:
+    server = await BankServer(bank).start(host, port)
+    for sock in server.sockets:
+        host, port = sock.getsockname()[:2]
+        print(f"Listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = ArgumentParser(prog="python -m apcsp.labs.bank.server")
+    parser.add_argument(
+        "--data",
+        default="bank-data",
+        help="directory the bank is saved in (default: %(default)s)",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--cold-after",
+        type=float,
+        metavar="DAYS",
+        help="keep moving postings older than this out of memory into a file in --data",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="time bank operations and save the results to FILE on exit"
+        " (Prometheus format if it ends in .prom)",
+    )
+    parser.add_argument(
+        "--alerts",
+        metavar="FILE",
+        help="check postings against the rules in rules.py and append alerts to FILE",
+    )
+    parser.add_argument(
+        "--hasher",
+        metavar="SPEC",
+        help="hash new passwords and PINs with SPEC, like scrypt:n=16384,r=8,p=1;"
+        " older ones are rehashed at login (see hashing.py)",
+    )
+    args = parser.parse_args()
+    if args.hasher:
+        try:
+            hashing.set_default_hasher(args.hasher)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.metrics:
+        metrics.enable()
+
+    bank = Bank()
+    journal = Journal(args.data)
+    journal.attach(bank)
+    util.set_id_leases(IdLeases(os.path.join(args.data, "ids.json")))
+    alerts = None
+    if args.alerts:
+        alerts = AlertLog(args.alerts)
+        RulesEngine(on_alert=alerts).attach(bank)
+    archiver = None
+    if args.cold_after is not None:
+        archiver = Archiver(
+            bank, os.path.join(args.data, "cold.seg"), args.cold_after * 24 * 60 * 60
+        )
+        archiver.start()
+    try:
+        asyncio.run(serve(bank, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        journal.close()
+        if archiver is not None:
+            archiver.close()
+        bank.close()
+        if alerts is not None:
+            alerts.close()
+        recorded = metrics.disable()
+        if recorded is not None:
+            recorded.write(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""
+A bank split across worker processes.
+
+Users are hash-partitioned by username into shards. Each shard is a process
+that owns an ordinary `Bank` holding its users and their accounts, so
+logins and postings on different shards run on different cores. Each shard
+numbers its IDs `index` modulo the shard count, so an account ID alone says
+which shard holds it.
+
+A transfer within a shard is an ordinary transfer. A transfer between shards
+uses two-phase commit, with the calling process as coordinator:
+
+1. prepare: the destination shard checks the account exists and can take the
+   credit, and pins it open
+2. debit: the source shard withdraws the money, or refuses and the
+   destination is released
+3. commit: the destination shard posts the credit. If it refuses, the source
+   shard credits the money back
+"""
+
+import multiprocessing
+import os
+import threading
+import zlib
+from itertools import count
+from typing import Any, Dict, List, Tuple
+
+from . import util
+from .account import transfer_msg_for
+from .account_types import UserHoldableAccount
+from .bank import Bank, BankState
+from .journal import Journal
+from .leases import IdLeases
+
+# (id, type, name, owner username) of an account in a shard
+AccountInfo = Tuple[str, str, str, str]
+
+
+def owned_name(acc: UserHoldableAccount) -> str:
+    """format_name for an account seen from another user's account."""
+    return f"{acc.name} ({acc.id}) owned by {acc._owner.name} ({acc._owner.id})"
+
+
+def account_info(acc: UserHoldableAccount) -> AccountInfo:
+    return (acc.id, acc.type, acc.name, acc._owner.username)
+
+
+class Shard(object):
+    """The bank of one shard; runs in the shard's worker process."""
+
+    # destination accounts of prepared transfers, by transfer ID
+    _prepared: Dict[str, UserHoldableAccount]
+
+    def __init__(self, index: int, shards: int, directory: str | None) -> None:
+        util.set_id_stride(index, shards)
+        self.bank = Bank()
+        self.journal: Journal | None = None
+        if directory is not None:
+            self.journal = Journal(os.path.join(directory, f"shard-{index}"))
+            self.journal.attach(self.bank)
+            # IDs keep this shard's residue, and its own state file
+            util.set_id_leases(
+                IdLeases(os.path.join(directory, f"shard-{index}", "ids.json"))
+            )
+        self._prepared = {}
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+        self.bank.close()
+
+    def _state(self, username: str) -> BankState:
+        # a session for a user the caller already authenticated
+        state = BankState(self.bank)
+        state.user = self.bank.accounts.get(username)
+        if state.user is None:
+            raise RuntimeError("Unknown user.")
+        return state
+
+    def _find(self, account_id: str) -> UserHoldableAccount:
+        acc = self.bank.find_account(account_id)
+        if acc is None:
+            raise ValueError("Invalid account ID")
+        return acc
+
+    def register(self, name: str, username: str, password: str, pin: str) -> str:
+        return self.bank.register(name, username, password, pin).id
+
+    def delete(self, username: str) -> None:
+        user = self._state(username).user
+        assert user is not None
+        if any(acc in self._prepared.values() for acc in user.accounts):
+            raise RuntimeError("Account has a transfer in progress.")
+        self.bank.delete(username)
+
+    def user(self, username: str) -> Tuple[str, str] | None:
+        user = self.bank.accounts.get(username)
+        return (user.id, user.name) if user is not None else None
+
+    def login(self, username: str, password: str) -> bool:
+        return self.bank.login(username, password) is not None
+
+    def check_pin(self, username: str, pin: str) -> bool:
+        return self._state(username).check_pin(pin)
+
+    def set_pin(self, username: str, pin: str) -> None:
+        self._state(username).set_pin(pin)
+
+    def accounts(self, username: str) -> List[AccountInfo]:
+        user = self._state(username).user
+        assert user is not None
+        return [account_info(acc) for acc in user.accounts]
+
+    def account(self, account_id: str) -> AccountInfo | None:
+        acc = self.bank.find_account(account_id)
+        return account_info(acc) if acc is not None else None
+
+    def open_account(
+        self,
+        username: str,
+        account_type: str,
+        name: str | None,
+        overdraft_source: str | None,
+    ) -> AccountInfo:
+        state = self._state(username)
+        source = state.get_account(overdraft_source) if overdraft_source else None
+        if overdraft_source and source is None:
+            raise RuntimeError("Invalid account ID.")
+        return account_info(state.open_account(account_type, name, source))
+
+    def close_account(self, username: str, account_id: str) -> None:
+        if self.bank.find_account(account_id) in self._prepared.values():
+            raise RuntimeError("Account has a transfer in progress.")
+        self._state(username).close_account(account_id)
+
+    def balance(self, account_id: str) -> int:
+        return self._find(account_id).balance
+
+    def account_str(self, account_id: str) -> str:
+        return self._find(account_id).account_str()
+
+    def deposit(self, account_id: str, amount: int, description: str | None) -> None:
+        self._find(account_id).deposit(amount, description)
+
+    def withdraw(self, account_id: str, amount: int, description: str | None) -> None:
+        self._find(account_id).withdraw(amount, description)
+
+    def transfer(self, source_id: str, dest_id: str, amount: int) -> None:
+        self._find(source_id).transfer(self._find(dest_id), amount)
+
+    def prepare_credit(self, txid: str, account_id: str, amount: int) -> str:
+        """
+        Phase one: checks the destination can take `amount` and pins it open.
+        Returns its name for the source.
+        """
+        acc = self._find(account_id)
+        with acc._lock:
+            acc._check_post(amount)
+        self._prepared[txid] = acc
+        return owned_name(acc)
+
+    def abort_credit(self, txid: str) -> None:
+        self._prepared.pop(txid, None)
+
+    def debit(self, account_id: str, amount: int, dest_name: str) -> str:
+        """
+        Withdraws the money being sent to another shard. Returns the source's name
+        for the destination.
+        """
+        acc = self._find(account_id)
+        source_name = owned_name(acc)
+        to_msg, _ = transfer_msg_for(source_name, dest_name)
+        try:
+            acc.withdraw(amount, to_msg)
+        except ValueError as e:
+            raise ValueError(to_msg) from e
+        return source_name
+
+    def commit_credit(self, txid: str, amount: int, source_name: str) -> None:
+        """Phase two: credits the destination pinned by prepare_credit."""
+        acc = self._prepared.pop(txid)
+        _, from_msg = transfer_msg_for(source_name, owned_name(acc))
+        with acc._lock:
+            acc._post(amount, from_msg)
+
+    def refund(self, account_id: str, amount: int, dest_name: str) -> None:
+        """Credits back a debit whose credit the destination refused."""
+        acc = self._find(account_id)
+        to_msg, _ = transfer_msg_for(owned_name(acc), dest_name)
+        with acc._lock:
+            acc._post(amount, f"Refund: {to_msg}")
+
+
+def _serve(conn: Any, index: int, shards: int, directory: str | None) -> None:
+    shard = Shard(index, shards, directory)
+    try:
+        while True:
+            try:
+                op, args = conn.recv()
+            except EOFError:
+                break
+            if op == "stop":
+                break
+            try:
+                conn.send(("ok", getattr(shard, op)(*args)))
+            except Exception as e:
+                conn.send(("error", type(e).__name__, str(e)))
+    finally:
+        shard.close()
+        conn.close()
+
+
+class ShardedBank(object):
+    """Routes requests to the shard processes; safe to use from many threads."""
+
+    def __init__(self, shards: int, directory: str | None = None) -> None:
+        """
+        shards: number of worker processes
+        directory: where each shard keeps its journal, or None to keep nothing
+        """
+        assert shards > 0, "Need at least one shard"
+        # spawn rather than fork, so shards don't inherit this process's threads
+        context = multiprocessing.get_context("spawn")
+        self._conns: List[Any] = []
+        # one request at a time per pipe
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._processes: List[Any] = []
+        self._txids = count()
+        for i in range(shards):
+            conn, child = context.Pipe()
+            process = context.Process(
+                target=_serve,
+                args=(child, i, shards, directory),
+                name=f"bank-shard-{i}",
+                daemon=True,
+            )
+            process.start()
+            child.close()
+            self._conns.append(conn)
+            self._processes.append(process)
+
+    @property
+    def shards(self) -> int:
+        return len(self._conns)
+
+    def close(self) -> None:
+        for conn, lock in zip(self._conns, self._locks):
+            with lock:
+                conn.send(("stop", ()))
+        for process in self._processes:
+            process.join()
+        for conn in self._conns:
+            conn.close()
+
+    def shard_of_user(self, username: str) -> int:
+        return zlib.crc32(username.encode("utf-8")) % self.shards
+
+    def shard_of_account(self, account_id: str) -> int | None:
+        number = util.id_number(account_id)
+        return number % self.shards if number is not None else None
+
+    def _call(self, shard: int, op: str, *args) -> Any:
+        with self._locks[shard]:
+            self._conns[shard].send((op, args))
+            reply = self._conns[shard].recv()
+        if reply[0] == "ok":
+            return reply[1]
+        _, error, message = reply
+        raise (ValueError if error == "ValueError" else RuntimeError)(message)
+
+    def _user_call(self, username: str, op: str, *args) -> Any:
+        return self._call(self.shard_of_user(username), op, username, *args)
+
+    def _account_call(self, account_id: str, op: str, *args) -> Any:
+        shard = self.shard_of_account(account_id)
+        if shard is None:
+            raise ValueError("Invalid account ID")
+        return self._call(shard, op, account_id, *args)
+
+    def register(
+        self, name: str, username: str, password: str, pin: str
+    ) -> "RemoteUser":
+        shard = self.shard_of_user(username)
+        id = self._call(shard, "register", name, username, password, pin)
+        return RemoteUser(self, id, name, username)
+
+    def delete(self, username: str) -> None:
+        self._user_call(username, "delete")
+
+    def get_user(self, username: str) -> "RemoteUser | None":
+        user = self._user_call(username, "user")
+        return RemoteUser(self, user[0], user[1], username) if user else None
+
+    def login(self, username: str, password: str) -> "RemoteUser | None":
+        if not self._user_call(username, "login", password):
+            return None
+        return self.get_user(username)
+
+    def find_account(self, account_id: str) -> "RemoteAccount | None":
+        shard = self.shard_of_account(account_id)
+        if shard is None:
+            return None
+        info = self._call(shard, "account", account_id)
+        return RemoteAccount(self, *info) if info else None
+
+    def transfer(self, source_id: str, dest_id: str, amount: int) -> None:
+        source_shard = self.shard_of_account(source_id)
+        dest_shard = self.shard_of_account(dest_id)
+        if source_shard is None or dest_shard is None:
+            raise ValueError("Invalid account ID")
+        if source_shard == dest_shard:
+            self._call(source_shard, "transfer", source_id, dest_id, amount)
+            return
+
+        if amount < 0:
+            raise ValueError("Cannot transfer negative amount")
+
+        txid = f"{os.getpid()}-{next(self._txids)}"
+        dest_name = self._call(dest_shard, "prepare_credit", txid, dest_id, amount)
+        try:
+            source_name = self._call(
+                source_shard, "debit", source_id, amount, dest_name
+            )
+        except BaseException:
+            self._call(dest_shard, "abort_credit", txid)
+            raise
+        try:
+            self._call(dest_shard, "commit_credit", txid, amount, source_name)
+        except (ValueError, RuntimeError) as e:
+            # the destination answered, so it posted nothing; anything else (a
+            # lost shard) leaves the credit unknown and is not refunded
+            self._call(source_shard, "refund", source_id, amount, dest_name)
+            raise ValueError(f"Transfer refused and refunded: {e}") from e
+
+
+class RemoteUser(object):
+    def __init__(self, bank: ShardedBank, id: str, name: str, username: str) -> None:
+        self._bank = bank
+        self.id = id
+        self.name = name
+        self.username = username
+
+    @property
+    def accounts(self) -> List["RemoteAccount"]:
+        return [
+            RemoteAccount(self._bank, *info)
+            for info in self._bank._user_call(self.username, "accounts")
+        ]
+
+    def get_account(self, account_id: str) -> "RemoteAccount | None":
+        acc = self._bank.find_account(account_id)
+        return acc if acc is not None and acc.owner == self.username else None
+
+
+class RemoteAccount(object):
+    """An account held by a shard; its balance is fetched on every access."""
+
+    def __init__(
+        self, bank: ShardedBank, id: str, type: str, name: str, owner: str
+    ) -> None:
+        self._bank = bank
+        self.id = id
+        self.type = type
+        self.name = name
+        # username of the owner
+        self.owner = owner
+
+    @property
+    def balance(self) -> int:
+        return self._bank._account_call(self.id, "balance")
+
+    def account_str(self) -> str:
+        return self._bank._account_call(self.id, "account_str")
+
+    def deposit(self, amount: int, description: str | None = None) -> None:
+        self._bank._account_call(self.id, "deposit", amount, description)
+
+    def withdraw(self, amount: int, description: str | None = None) -> None:
+        self._bank._account_call(self.id, "withdraw", amount, description)
+
+    def transfer(self, other: "RemoteAccount", amount: int) -> None:
+        if self.id == other.id:
+            raise ValueError("Cannot transfer to self")
+        self._bank.transfer(self.id, other.id, amount)
+
+
+class ShardedBankState(object):
+    """BankState for a ShardedBank."""
+
+    user: RemoteUser | None
+
+    def __init__(self, bank: ShardedBank) -> None:
+        self.bank = bank
+        self.user = None
+
+    def login(self, username: str, password: str) -> RemoteUser | None:
+        acc = self.bank.login(username, password)
+        if acc:
+            self.user = acc
+        return acc
+
+    def logout(self) -> None:
+        self.user = None
+
+    def username_taken(self, username: str) -> bool:
+        return self.bank.get_user(username) is not None
+
+    def register(self, name: str, username: str, password: str, pin: str) -> RemoteUser:
+        self.user = self.bank.register(name, username, password, pin)
+        return self.user
+
+    def delete_user_account(self) -> None:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to delete an account.")
+
+        self.bank.delete(self.user.username)
+        self.user = None
+
+    def check_pin(self, pin: str) -> bool:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to check PIN.")
+
+        return self.bank._user_call(self.user.username, "check_pin", pin)
+
+    def set_pin(self, pin: str) -> None:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to change PIN.")
+
+        self.bank._user_call(self.user.username, "set_pin", pin)
+
+    def open_account(
+        self,
+        account_type: str,
+        name: str | None,
+        overdraft_source: RemoteAccount | None = None,
+    ) -> RemoteAccount:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to open an account.")
+
+        info = self.bank._user_call(
+            self.user.username,
+            "open_account",
+            account_type,
+            name,
+            overdraft_source.id if overdraft_source else None,
+        )
+        return RemoteAccount(self.bank, *info)
+
+    def close_account(self, account_id: str) -> None:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to close an account.")
+
+        self.bank._user_call(self.user.username, "close_account", account_id)
+
+    def find_account(self, account_id: str) -> RemoteAccount | None:
+        # the bank routes by ID, so there is no cheaper lookup for our own
+        return self.bank.find_account(account_id)
+
+    def get_account(self, account_id: str) -> RemoteAccount | None:
+        if self.user is None:
+            raise RuntimeError("Must be logged in to access an account.")
+
+        return self.user.get_account(account_id)
@@ -13,6 +13,7 @@ auth_menu = [
     MenuOption("", "Withdraw", money.withdraw),
     MenuOption("", "Transfer", money.transfer),
     MenuOption("", "View Transactions", money.view_transactions),
+    MenuOption("", "Search Transactions", money.search_transactions),
     MenuOption("Accounts", "Open new account", register.open_account),
     MenuOption("", "Close account", register.close_account),
     MenuOption("User", "Change name", profile.change_name),
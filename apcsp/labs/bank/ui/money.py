@@ -3,7 +3,13 @@ from colorama import Fore, Style  # type: ignore
 from ..account import format_name
 from ..bank import BankState
 from ..util import format_amount
-from .prompt import _error, press_any_key, prompt_float, prompt_str
+from .prompt import (
+    _error,
+    press_any_key,
+    press_n_for_more,
+    prompt_float,
+    prompt_str,
+)
 from .util import clear, print_accounts, title
 
 
@@ -20,6 +26,19 @@ def is_positive(val: str) -> bool:
     return True
 
 
+# ask for the user's PIN, unless they entered it recently
+def prompt_pin(state: BankState) -> None:
+    if state.use_pin_grant():
+        return
+
+    while True:
+        pin = prompt_str("PIN: ", hide=True)
+        if not state.check_pin(pin):
+            _error("Invalid PIN.")
+            continue
+        break
+
+
 def deposit(state: BankState):
     if state.user is None:
         _error("Must be logged in to deposit.")
@@ -44,12 +63,7 @@ def deposit(state: BankState):
             continue
         break
 
-    while True:
-        pin = prompt_str("PIN: ", hide=True)
-        if not state.user.check_pin(pin):
-            _error("Invalid PIN.")
-            continue
-        break
+    prompt_pin(state)
 
     try:
         account.deposit(int(amount * 100), desc or None)
@@ -92,12 +106,7 @@ def withdraw(state: BankState):
     amount = prompt_float("Amount: ", validate=is_positive)
     desc = prompt_str("Description (leave blank for none): ", optional=True)
 
-    while True:
-        pin = prompt_str("PIN: ", hide=True)
-        if not state.user.check_pin(pin):
-            _error("Invalid PIN.")
-            continue
-        break
+    prompt_pin(state)
 
     try:
         account.withdraw(int(amount * 100), desc or None)
@@ -172,12 +181,7 @@ def transfer(state: BankState):
         press_any_key()
         return True
 
-    while True:
-        pin = prompt_str("PIN: ", hide=True)
-        if not state.user.check_pin(pin):
-            _error("Invalid PIN.")
-            continue
-        break
+    prompt_pin(state)
 
     try:
         source.transfer(dest, int(amount * 100))
@@ -217,17 +221,60 @@ def view_transactions(state: BankState):
             continue
         break
 
-    while True:
-        pin = prompt_str("PIN: ", hide=True)
-        if not state.user.check_pin(pin):
-            _error("Invalid PIN.")
-            continue
-        break
+    prompt_pin(state)
 
     try:
-        print()
-        print(account.transactions_str())
+        cursor = None
+        while True:
+            # one page at a time, newest first
+            page, cursor = account.history_page(cursor)
+            print()
+            for t in page:
+                print(t.str())
+            if cursor is None:
+                press_any_key()
+                break
+            if not press_n_for_more(
+                "Press n for older transactions, any other key to continue"
+            ):
+                break
+        return True
+    except Exception as e:
+        print(Fore.RED + str(e) + Style.RESET_ALL)
         press_any_key()
+        return False
+
+
+def search_transactions(state: BankState):
+    if state.user is None:
+        _error("Must be logged in to search transactions.")
+        return True
+
+    clear()
+    print_accounts(state.user)
+    title("Search Transactions")
+
+    query = prompt_str("Search for (end a word with * to match its start): ")
+
+    prompt_pin(state)
+
+    try:
+        cursor = None
+        while True:
+            # one page at a time, newest first
+            page, cursor = state.search(query, cursor)
+            print()
+            if not page and cursor is None:
+                print("No matching transactions.")
+            for account, t in page:
+                print(f"{format_name(account)}: {t.str()}")
+            if cursor is None:
+                press_any_key()
+                break
+            if not press_n_for_more(
+                "Press n for older matches, any other key to continue"
+            ):
+                break
         return True
     except Exception as e:
         print(Fore.RED + str(e) + Style.RESET_ALL)
@@ -96,7 +96,7 @@ def change_pin(state: BankState) -> Any:
         break
 
     try:
-        state.user.set_pin(new_pin)
+        state.set_pin(new_pin)
         print(Fore.GREEN + "PIN changed." + Style.RESET_ALL)
         press_any_key()
         return True
@@ -75,3 +75,10 @@ def press_any_key(message="Press any key to continue") -> None:
         key = readkey()
         if key:
             break
+
+
+# ask whether to keep going; returns True if the user pressed n
+def press_n_for_more(message="Press n for more, any other key to continue") -> bool:
+    print()
+    print(Fore.GREEN + message + Style.RESET_ALL)
+    return readkey() in ("n", "N")
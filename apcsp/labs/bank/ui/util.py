@@ -8,6 +8,7 @@ from readchar import readkey  # type: ignore
 
 from ..account_types import UserAccount, UserHoldableAccount
 from ..bank import BankState
+from ..metrics import timed
 
 # arrow key escape sequences
 ARROW_UP: Final[str] = "\x1b[A"
@@ -75,6 +76,7 @@ def title(title: str) -> None:
 
 
 # print items and prices in a table
+@timed("print_accounts")
 def print_accounts(user: UserAccount, selected: int | None = None) -> None:
     banner(user)
     cols = columns(user)
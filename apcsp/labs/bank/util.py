@@ -1,14 +1,68 @@
-from typing import Dict, Literal
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, Literal
+
+if TYPE_CHECKING:
+    from .leases import IdLeases
 
 id_counters: Dict[str, int] = {}
+# guards id_counters, so threads never get the same ID
+id_lock = Lock()
+# every ID this process creates has a number equal to id_offset modulo id_stride,
+# so processes given different offsets never create the same ID
+id_offset = 0
+id_stride = 1
+# where blocks of ID numbers are leased from, or None to number from id_counters
+# alone, which starts over with each process
+id_leases: "IdLeases | None" = None
+# last number of the block leased in each namespace
+lease_ends: Dict[str, int] = {}
+
+
+def set_id_stride(offset: int, stride: int) -> None:
+    global id_offset, id_stride
+    assert 0 <= offset < stride, "Offset must be less than stride"
+    with id_lock:
+        id_offset, id_stride = offset, stride
+
+
+def set_id_leases(leases: "IdLeases | None") -> None:
+    """Leases ID numbers from `leases` from now on, or stops if it is None."""
+    global id_leases
+    with id_lock:
+        id_leases = leases
+        lease_ends.clear()
 
 
 def create_id(namespace: str) -> str:
     assert len(namespace) > 0, "Namespace cannot be empty"
-    if namespace not in id_counters:
-        id_counters[namespace] = -1
-    id_counters[namespace] += 1
-    return f"{namespace}{id_counters[namespace]}"
+    with id_lock:
+        number = id_counters.get(namespace, -1) + 1
+        number += (id_offset - number) % id_stride
+        if id_leases is not None and number > lease_ends.get(namespace, -1):
+            # a block with id_leases.block numbers this process may use
+            size = id_leases.block * id_stride
+            start = id_leases.lease(namespace, number, size)
+            lease_ends[namespace] = start + size - 1
+            number = start + (id_offset - start) % id_stride
+        id_counters[namespace] = number
+        return f"{namespace}{number}"
+
+
+def id_number(id: str) -> int | None:
+    """Returns the number at the end of an ID, or None if it has none."""
+    namespace = id.rstrip("0123456789")
+    if len(namespace) == len(id):
+        return None
+    return int(id[len(namespace) :])
+
+
+def reserve_id(id: str) -> None:
+    """Marks an existing ID as used so create_id never returns it."""
+    namespace = id.rstrip("0123456789")
+    assert len(namespace) > 0, "Namespace cannot be empty"
+    number = int(id[len(namespace) :])
+    with id_lock:
+        id_counters[namespace] = max(id_counters.get(namespace, -1), number)
 
 
 def sign(amount: float | int) -> str:
@@ -0,0 +1,273 @@
+"""
+Reproducible synthetic workloads for the bank core.
+
+A `Workload` describes a bank of `users` users holding `accounts` accounts,
+plus a list of operations to run against it. Each operation is drawn from a
+weighted mix. The user or account it touches is drawn from a Zipf
+distribution, so a few hot accounts get most of the traffic, as in a real
+bank. The same seed always gives the same bank and the same operations.
+
+`run` times every operation. `peaks` replays the operations under tracemalloc
+to find the peak memory each kind allocates. Run it with
+`python -m apcsp.labs.bank.bench workload`.
+"""
+
+import random
+import tracemalloc
+from bisect import bisect_left
+from itertools import accumulate
+from statistics import quantiles
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+from .account_types import (
+    CheckingAccount,
+    SavingsAccount,
+    UserAccount,
+    UserHoldableAccount,
+    derive_secrets,
+)
+from .bank import Bank
+
+PASSWORD = "password"
+PIN = "1234"
+# every account starts with this much, in cents, so withdrawals rarely fail
+STARTING_BALANCE = 1_000_000_00
+
+# relative weight of each operation in the default mix. Registering derives two
+# keys and logging in one, so they are kept rare
+DEFAULT_MIX: Dict[str, float] = {
+    "register": 0.02,
+    "login": 0.2,
+    "find_account": 20,
+    "deposit": 15,
+    "withdraw": 10,
+    "transfer": 40,
+    "history": 10,
+    "add_interest": 2,
+}
+
+# operation name, the user or account it acts on, another account, and an
+# amount (or interest rate)
+Operation = Tuple[str, int, int, int]
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Parses a mix like "transfer=40,login=1". Operations left out never run."""
+    mix: Dict[str, float] = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+class Zipf(object):
+    """Draws 0 to n - 1, each k in proportion to 1 / (k + 1) ** skew."""
+
+    def __init__(self, n: int, skew: float, rng: random.Random) -> None:
+        self._cumulative = list(accumulate((k + 1) ** -skew for k in range(n)))
+        self._rng = rng
+
+    def draw(self) -> int:
+        return bisect_left(self._cumulative, self._rng.random() * self._cumulative[-1])
+
+
+def _register(bank: Bank, accounts: List, i: int, j: int, amount: int) -> None:
+    bank.register(f"User {i}", f"user{i}", PASSWORD, PIN)
+
+
+def _login(bank: Bank, accounts: List, i: int, j: int, amount: int) -> None:
+    if bank.login(f"user{i}", PASSWORD) is None:
+        raise ValueError(f"Login failed for user{i}")
+
+
+def _find_account(bank: Bank, accounts: List, i: int, j: int, amount: int) -> None:
+    if bank.find_account(accounts[i].id) is None:
+        raise ValueError(f"Account {accounts[i].id} not found")
+
+
+def _deposit(bank: Bank, accounts: List, i: int, j: int, amount: int) -> None:
+    accounts[i].deposit(amount)
+
+
+def _withdraw(bank: Bank, accounts: List, i: int, j: int, amount: int) -> None:
+    accounts[i].withdraw(amount)
+
+
+def _transfer(bank: Bank, accounts: List, i: int, j: int, amount: int) -> None:
+    accounts[i].transfer(accounts[j], amount)
+
+
+def _history(bank: Bank, accounts: List, i: int, j: int, amount: int) -> None:
+    accounts[i].history_page()
+
+
+def _add_interest(bank: Bank, accounts: List, i: int, j: int, amount: int) -> None:
+    accounts[i].add_interest(amount)
+
+
+OPERATIONS: Dict[str, Callable[[Bank, List, int, int, int], None]] = {
+    "register": _register,
+    "login": _login,
+    "find_account": _find_account,
+    "deposit": _deposit,
+    "withdraw": _withdraw,
+    "transfer": _transfer,
+    "history": _history,
+    "add_interest": _add_interest,
+}
+
+
+class Workload(object):
+    operations: List[Operation]
+
+    def __init__(
+        self,
+        users: int,
+        accounts: int,
+        operations: int,
+        mix: Dict[str, float] = DEFAULT_MIX,
+        skew: float = 1.0,
+        seed: int = 0,
+    ) -> None:
+        """
+        users, accounts: size of the bank before the operations run
+        operations: how many operations to run
+        mix: relative weight of each operation
+        skew: Zipf exponent; 0 spreads traffic evenly, higher concentrates it
+        """
+        # account i belongs to user i % users. Each user's first account is a
+        # savings account, and the rest are checking accounts that overdraw
+        # from it
+        if not accounts >= users > 1:
+            raise ValueError("Need 2+ users and at least as many accounts")
+        self.users = users
+        self.accounts = accounts
+        self.mix = mix
+        self.skew = skew
+        self.seed = seed
+        self.operations = self._generate(operations, random.Random(seed))
+
+    def _generate(self, count: int, rng: random.Random) -> List[Operation]:
+        # shuffled, so the hottest accounts are a mix of types and owners
+        user_order = list(range(self.users))
+        account_order = list(range(self.accounts))
+        rng.shuffle(user_order)
+        rng.shuffle(account_order)
+        users = Zipf(self.users, self.skew, rng)
+        accounts = Zipf(self.accounts, self.skew, rng)
+
+        operations: List[Operation] = []
+        registered = self.users
+        names = list(self.mix)
+        for name in rng.choices(names, list(self.mix.values()), k=count):
+            if name == "register":
+                operations.append((name, registered, 0, 0))
+                registered += 1
+            elif name == "login":
+                operations.append((name, user_order[users.draw()], 0, 0))
+            elif name == "add_interest":
+                # each user's savings account has the same index as the user
+                rate = rng.randrange(1, 5000)
+                operations.append((name, user_order[users.draw()], 0, rate))
+            elif name == "transfer":
+                source = dest = account_order[accounts.draw()]
+                while dest == source:
+                    dest = account_order[accounts.draw()]
+                operations.append((name, source, dest, rng.randrange(1, 100_00)))
+            else:
+                account = account_order[accounts.draw()]
+                operations.append((name, account, 0, rng.randrange(1, 100_00)))
+        return operations
+
+    def build(self) -> Tuple[Bank, List[UserHoldableAccount]]:
+        """Returns a new bank in the starting state, and its accounts in order."""
+        bank = Bank()
+        # every user has the same password and PIN, so derive them just once
+        hasher, secrets = derive_secrets(PASSWORD, PIN)
+        users = [
+            UserAccount(f"User {i}", f"user{i}", PASSWORD, PIN, (hasher, secrets))
+            for i in range(self.users)
+        ]
+        accounts: List[UserHoldableAccount] = []
+        for i in range(self.accounts):
+            user = users[i % self.users]
+            if i < self.users:
+                acc: UserHoldableAccount = SavingsAccount(user)
+            else:
+                acc = CheckingAccount(user, None, accounts[i % self.users])
+            acc.deposit(STARTING_BALANCE)
+            accounts.append(acc)
+        for user in users:
+            bank._attach(user)
+        return bank, accounts
+
+    def run(self) -> Tuple[float, Dict[str, List[float]], Dict[str, int]]:
+        """
+        Runs the operations on a new bank. Returns the total time taken and the
+        time of each operation by name, in seconds, and how many of each failed.
+        """
+        bank, accounts = self.build()
+        latencies: Dict[str, List[float]] = {name: [] for name in self.mix}
+        failures: Dict[str, int] = {name: 0 for name in self.mix}
+        start = perf_counter()
+        for name, i, j, amount in self.operations:
+            operation = OPERATIONS[name]
+            began = perf_counter()
+            try:
+                operation(bank, accounts, i, j, amount)
+            except ValueError:
+                failures[name] += 1
+            latencies[name].append(perf_counter() - began)
+        took = perf_counter() - start
+        bank.close()
+        return took, latencies, failures
+
+    def peaks(self) -> Dict[str, int]:
+        """
+        Runs the operations on a new bank under tracemalloc. Returns the most
+        memory any one operation of each name allocated at once, in bytes.
+        """
+        bank, accounts = self.build()
+        peaks: Dict[str, int] = {name: 0 for name in self.mix}
+        tracemalloc.start()
+        try:
+            for name, i, j, amount in self.operations:
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                try:
+                    OPERATIONS[name](bank, accounts, i, j, amount)
+                except ValueError:
+                    pass
+                peak = tracemalloc.get_traced_memory()[1] - before
+                peaks[name] = max(peaks[name], peak)
+        finally:
+            tracemalloc.stop()
+        bank.close()
+        return peaks
+
+
+def summarize(
+    latencies: Dict[str, List[float]], failures: Dict[str, int], peaks: Dict[str, int]
+) -> Dict[str, Dict[str, float]]:
+    """
+    Returns the count, failures, throughput (per second spent in it), p50 and p99
+    latency (in seconds) and peak memory (in bytes) of each operation that ran.
+    """
+    summary: Dict[str, Dict[str, float]] = {}
+    for name, times in latencies.items():
+        if not times:
+            continue
+        cuts = quantiles(times, n=100) if len(times) > 1 else times * 99
+        summary[name] = {
+            "count": len(times),
+            "failed": failures[name],
+            "per_second": len(times) / sum(times),
+            "p50": cuts[49],
+            "p99": cuts[98],
+            "peak": peaks.get(name, 0),
+        }
+    return summary